@@ -0,0 +1,276 @@
+"""
+Approximate nearest neighbour indexes on a pgvector collection.
+
+langchain_postgres stores the embeddings of all collections in one `vector` column without a
+fixed dimension, which pgvector cannot index. The indexes are therefore partial expression
+indexes on `embedding::vector(<dimensions>)` per collection, and searches through
+`AnnIndex.search` use the same expression so the planner can pick them.
+
+    python ann_index.py create --type hnsw --m 16 --ef-construction 64
+    python ann_index.py status
+    python ann_index.py tune --values 20,40,80,160
+    python ann_index.py rebuild
+    python ann_index.py drop
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+from sqlalchemy import text
+
+from db import get_engine
+
+PGVECTOR_COLLECTION = os.getenv('PGVECTOR_COLLECTION')
+CONNECTION_STRING = os.getenv('DATABASE_URL')
+# 'hnsw', 'ivfflat' or 'none', with 'none' searches scan the collection without an index
+ANN_INDEX_TYPE = os.getenv('ANN_INDEX_TYPE', 'none')
+ANN_HNSW_M = int(os.getenv('ANN_HNSW_M', '16'))
+ANN_HNSW_EF_CONSTRUCTION = int(os.getenv('ANN_HNSW_EF_CONSTRUCTION', '64'))
+# 0 picks rows / 1000 up to 1M rows and sqrt(rows) above, as recommended by pgvector
+ANN_IVFFLAT_LISTS = int(os.getenv('ANN_IVFFLAT_LISTS', '0'))
+ANN_EF_SEARCH = int(os.getenv('ANN_EF_SEARCH', '40'))
+ANN_IVFFLAT_PROBES = int(os.getenv('ANN_IVFFLAT_PROBES', '10'))
+ANN_MAINTENANCE_WORK_MEM = os.getenv('ANN_MAINTENANCE_WORK_MEM', '1GB')
+
+INDEX_TYPES = ('hnsw', 'ivfflat')
+
+logger = logging.getLogger(__name__)
+
+
+def default_lists(rows):
+    if rows <= 1_000_000:
+        return max(10, rows // 1000)
+    return int(np.sqrt(rows))
+
+
+class CollectionUnavailable(ValueError):
+    """
+    Raised when the collection does not exist or holds no embeddings yet.
+    """
+
+
+def vector_literal(vector):
+    return '[' + ','.join(repr(float(value)) for value in vector) + ']'
+
+
+class AnnIndex():
+    """
+    Creates, rebuilds and queries the ANN index of one collection.
+
+    Attributes:
+        engine (sqlalchemy.engine.Engine): Engine of the pgvector database.
+        collection_name (str): Name of the langchain_postgres collection.
+        ef_search (int): Size of the HNSW candidate list at query time.
+        probes (int): Number of IVFFlat lists scanned at query time.
+    """
+
+    def __init__(self, engine, collection_name=PGVECTOR_COLLECTION, ef_search=ANN_EF_SEARCH, probes=ANN_IVFFLAT_PROBES) -> None:
+        self.engine = engine
+        self.collection_name = collection_name
+        self.ef_search = ef_search
+        self.probes = probes
+        # (collection id, dimensions), only valid as long as the collection keeps its id
+        self._dimensions = None
+
+    def collection_id(self):
+        # Not cached, a reindex drops the collection and creates it again with a new id
+        with self.engine.connect() as conn:
+            row = conn.execute(text("SELECT uuid FROM langchain_pg_collection WHERE name = :name"),
+                               {"name": self.collection_name}).fetchone()
+        if row is None:
+            raise CollectionUnavailable(f"Collection {self.collection_name} not found")
+        return str(row[0])
+
+    def dimensions(self, collection_id=None):
+        collection_id = collection_id or self.collection_id()
+        if self._dimensions is None or self._dimensions[0] != collection_id:
+            with self.engine.connect() as conn:
+                row = conn.execute(text("SELECT vector_dims(embedding) FROM langchain_pg_embedding WHERE collection_id = :id LIMIT 1"),
+                                   {"id": collection_id}).fetchone()
+            if row is None:
+                raise CollectionUnavailable(f"Collection {self.collection_name} is empty")
+            self._dimensions = (collection_id, int(row[0]))
+        return self._dimensions[1]
+
+    def index_name(self, index_type):
+        return f"ann_{index_type}_{self.collection_id().replace('-', '')[:16]}"
+
+    def _execute_autocommit(self, statements):
+        # CREATE and REINDEX ... CONCURRENTLY cannot run inside a transaction
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            for statement in statements:
+                conn.execute(text(statement))
+
+    def create(self, index_type=ANN_INDEX_TYPE, m=ANN_HNSW_M, ef_construction=ANN_HNSW_EF_CONSTRUCTION, lists=ANN_IVFFLAT_LISTS):
+        """
+        Creates the index without blocking writes, an existing index of the same type is replaced.
+        """
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index_type}, expected one of {', '.join(INDEX_TYPES)}")
+        if index_type == 'hnsw':
+            options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+        else:
+            options = f"lists = {int(lists or default_lists(self.count()))}"
+
+        name = self.index_name(index_type)
+        start = time.perf_counter()
+        self.drop(index_type)
+        self._execute_autocommit([
+            f"SET maintenance_work_mem = '{ANN_MAINTENANCE_WORK_MEM}'",
+            f"""CREATE INDEX CONCURRENTLY {name} ON langchain_pg_embedding
+                USING {index_type} ((embedding::vector({self.dimensions()})) vector_cosine_ops) WITH ({options})
+                WHERE collection_id = '{self.collection_id()}'""",
+        ])
+        logger.info(f"Created {index_type} index {name} ({options}) in {time.perf_counter() - start:.1f}s")
+        return name
+
+    def rebuild(self, index_type=ANN_INDEX_TYPE):
+        """
+        Rebuilds the index, e.g. after IVFFlat lists became unbalanced by many inserts.
+        """
+        name = self.index_name(index_type)
+        self._execute_autocommit([f"SET maintenance_work_mem = '{ANN_MAINTENANCE_WORK_MEM}'", f"REINDEX INDEX CONCURRENTLY {name}"])
+        return name
+
+    def drop(self, index_type=ANN_INDEX_TYPE):
+        self._execute_autocommit([f"DROP INDEX CONCURRENTLY IF EXISTS {self.index_name(index_type)}"])
+
+    def count(self):
+        with self.engine.connect() as conn:
+            return conn.execute(text("SELECT COUNT(*) FROM langchain_pg_embedding WHERE collection_id = :id"),
+                                {"id": self.collection_id()}).scalar()
+
+    def status(self):
+        """
+        Returns the ANN indexes of the collection with their definition and size.
+        """
+        with self.engine.connect() as conn:
+            rows = conn.execute(text("""
+                SELECT indexname, indexdef, pg_relation_size(indexname::regclass) FROM pg_indexes
+                WHERE tablename = 'langchain_pg_embedding' AND indexname LIKE :pattern
+            """), {"pattern": f"ann_%_{self.collection_id().replace('-', '')[:16]}"}).fetchall()
+        return {"collection": self.collection_name, "rows": self.count(),
+                "indexes": [{"name": name, "definition": definition, "bytes": size} for name, definition, size in rows]}
+
+    def _search_settings(self, ef_search, probes):
+        return [
+            text(f"SET LOCAL hnsw.ef_search = {int(ef_search or self.ef_search)}"),
+            text(f"SET LOCAL ivfflat.probes = {int(probes or self.probes)}"),
+        ]
+
+    def search(self, query_vector, k=4, ef_search=None, probes=None, exact=False, with_embeddings=False):
+        """
+        Returns the k nearest (Document, cosine distance) pairs of the collection.
+
+        Args:
+            exact (bool): Disable index scans, used as ground truth when tuning.
+            with_embeddings (bool): Return (Document, cosine distance, stored embedding) triples instead.
+        """
+        try:
+            collection_id = self.collection_id()
+            dimensions = self.dimensions(collection_id)
+        except CollectionUnavailable:
+            # A new or emptied collection has no neighbours, the answer is built without context
+            return []
+        with self.engine.begin() as conn:
+            for statement in self._search_settings(ef_search, probes):
+                conn.execute(statement)
+            if exact:
+                conn.execute(text("SET LOCAL enable_indexscan = off"))
+            rows = conn.execute(text(f"""
+                SELECT id, document, cmetadata, (embedding::vector({dimensions})) <=> CAST(:query AS vector({dimensions})) AS distance
+                       {', embedding::real[]' if with_embeddings else ''}
+                FROM langchain_pg_embedding
+                WHERE collection_id = :collection_id
+                ORDER BY (embedding::vector({dimensions})) <=> CAST(:query AS vector({dimensions}))
+                LIMIT :k
+            """), {"query": vector_literal(query_vector), "collection_id": collection_id, "k": k}).fetchall()
+        results = [(Document(page_content=row[1] or '', metadata={**(row[2] or {}), "_id": row[0]}), row[3]) for row in rows]
+        if with_embeddings:
+            return [(doc, distance, row[4]) for (doc, distance), row in zip(results, rows)]
+        return results
+
+    def sample_queries(self, n=50, seed=42):
+        """
+        Returns `n` stored embeddings of the collection, slightly perturbed, to use as queries.
+        """
+        with self.engine.connect() as conn:
+            rows = conn.execute(text("""
+                SELECT embedding::text FROM langchain_pg_embedding WHERE collection_id = :id ORDER BY random() LIMIT :n
+            """), {"id": self.collection_id(), "n": n}).fetchall()
+        rng = np.random.default_rng(seed)
+        vectors = np.array([json.loads(row[0]) for row in rows], dtype=np.float32)
+        return vectors + rng.normal(0, 0.01, vectors.shape).astype(np.float32)
+
+    def tune(self, values, k=10, queries=None, index_type=ANN_INDEX_TYPE):
+        """
+        Measures recall@k against exact search and the query latency for each ef_search (HNSW) or
+        probes (IVFFlat) value.
+
+        Returns:
+            list: One dictionary per value with recall, p50 and p95 latency in seconds.
+        """
+        queries = self.sample_queries() if queries is None else queries
+        truth = [{doc.metadata["_id"] for doc, _ in self.search(query, k, exact=True)} for query in queries]
+        results = []
+        for value in values:
+            settings = {"ef_search": value} if index_type == 'hnsw' else {"probes": value}
+            latencies, recalls = [], []
+            for query, expected in zip(queries, truth):
+                start = time.perf_counter()
+                found = {doc.metadata["_id"] for doc, _ in self.search(query, k, **settings)}
+                latencies.append(time.perf_counter() - start)
+                recalls.append(len(found & expected) / len(expected) if expected else 1.0)
+            results.append({**settings, "recall": float(np.mean(recalls)),
+                            "p50": float(np.percentile(latencies, 50)), "p95": float(np.percentile(latencies, 95))})
+        return results
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_ann_index(connection_string=CONNECTION_STRING, collection_name=PGVECTOR_COLLECTION):
+    """
+    Returns the process-wide AnnIndex of a collection.
+    """
+    key = (connection_string, collection_name)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = AnnIndex(get_engine(connection_string), collection_name)
+        return _indexes[key]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the ANN index of a pgvector collection.")
+    parser.add_argument('command', choices=['create', 'rebuild', 'drop', 'status', 'tune'])
+    parser.add_argument('--collection', default=PGVECTOR_COLLECTION)
+    parser.add_argument('--type', default=ANN_INDEX_TYPE if ANN_INDEX_TYPE in INDEX_TYPES else 'hnsw', choices=INDEX_TYPES)
+    parser.add_argument('--m', type=int, default=ANN_HNSW_M)
+    parser.add_argument('--ef-construction', type=int, default=ANN_HNSW_EF_CONSTRUCTION)
+    parser.add_argument('--lists', type=int, default=ANN_IVFFLAT_LISTS)
+    parser.add_argument('--values', default='10,20,40,80,160', help='ef_search or probes values measured by tune.')
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    index = get_ann_index(CONNECTION_STRING, args.collection)
+    if args.command == 'create':
+        index.create(args.type, args.m, args.ef_construction, args.lists)
+    elif args.command == 'rebuild':
+        index.rebuild(args.type)
+    elif args.command == 'drop':
+        index.drop(args.type)
+    elif args.command == 'tune':
+        print(json.dumps(index.tune([int(value) for value in args.values.split(',')], args.k, index_type=args.type), indent=2))
+        return
+    print(json.dumps(index.status(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', '3600'))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '1000'))
+# Minimum cosine similarity between two question embeddings to reuse an answer
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', '0.98'))
+# Minimum Jaccard overlap of the content words of two similar questions, the numbers have to be equal
+ANSWER_CACHE_MIN_OVERLAP = float(os.getenv('ANSWER_CACHE_MIN_OVERLAP', '0.8'))
+
+STOP_WORDS = frozenset('''
+    a about above after all also am an and any are as at be been before being below between both but by can could
+    did do does doing during each for from had has have having how i if in into is it its me more most my no nor
+    not of on or other our out over said say says should so some such than that the their them then there these
+    they this those through to too under up very was we were what when where which while who whom why will with
+    would you your
+'''.split())
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(question):
+    question = re.sub(r'\s+', ' ', question.strip().lower())
+    return question.rstrip('?!. ')
+
+
+def content_words(question):
+    return frozenset(word for word in re.findall(r'\w+', question.lower()) if word not in STOP_WORDS)
+
+
+def same_subject(words, other):
+    """
+    Returns whether two questions share their numbers and most of their content words.
+
+    Embeddings of questions differing in one name or number ("comments about X" and "comments about Y")
+    are often more similar than those of two phrasings of the same question.
+    """
+    if {word for word in words if word.isdigit()} != {word for word in other if word.isdigit()}:
+        return False
+    union = words | other
+    return not union or len(words & other) / len(union) >= ANSWER_CACHE_MIN_OVERLAP
+
+
+class AnswerCache():
+    """
+    Cache of RAG answers with exact lookups on the normalized question and approximate lookups by
+    question embedding similarity, an approximate hit also has to be about the same names and numbers.
+
+    Entries expire after `ttl` seconds, the least recently used ones are evicted above `max_entries`,
+    and all entries are dropped when the version of the vector collection changes.
+
+    Attributes:
+        embed_fn (callable): Function embedding a single question.
+        version_fn (callable): Function returning the current version of the vector collection.
+    """
+
+    def __init__(self, embed_fn, version_fn, ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_MAX_ENTRIES,
+                 similarity_threshold=ANSWER_CACHE_SIMILARITY) -> None:
+        self.embed_fn = embed_fn
+        self.version_fn = version_fn
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()  # normalized question -> (answer, unit vector, content words, created)
+        self._version = None
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.approximate_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def current_version(self):
+        version = self.version_fn()
+        with self._lock:
+            if version != self._version:
+                if self._entries:
+                    logger.info(f"Vector collection changed to version {version}, dropping {len(self._entries)} cached answers")
+                    self.invalidations += 1
+                self._entries.clear()
+                self._version = version
+        return version
+
+    def _embed(self, question):
+        vector = np.asarray(self.embed_fn(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, question):
+        """
+        Returns the cached answer for `question` or None.
+        """
+        self.current_version()
+        key = normalize_question(question)
+        now = time.monotonic()
+
+        with self._lock:
+            for expired in [k for k, (_, _, _, created) in self._entries.items() if now - created > self.ttl]:
+                del self._entries[expired]
+
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return self._entries[key][0]
+            if not self._entries:
+                self.misses += 1
+                return None
+
+        vector = self._embed(question)
+        words = content_words(question)
+        with self._lock:
+            keys = list(self._entries.keys())
+            if keys:
+                similarities = np.vstack([self._entries[k][1] for k in keys]) @ vector
+                for best in np.argsort(-similarities):
+                    if similarities[best] < self.similarity_threshold:
+                        break
+                    if same_subject(words, self._entries[keys[best]][2]):
+                        self._entries.move_to_end(keys[best])
+                        self.approximate_hits += 1
+                        return self._entries[keys[best]][0]
+            self.misses += 1
+        return None
+
+    def put(self, question, answer, version):
+        """
+        Stores an answer computed while the collection had `version`.
+        """
+        vector = self._embed(question)
+        with self._lock:
+            # The collection changed while the answer was generated
+            if version != self._version:
+                return
+            self._entries[normalize_question(question)] = (answer, vector, content_words(question), time.monotonic())
+            self._entries.move_to_end(normalize_question(question))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            hits = self.exact_hits + self.approximate_hits
+            lookups = hits + self.misses
+            return {
+                "exact_hits": self.exact_hits,
+                "approximate_hits": self.approximate_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "invalidations": self.invalidations,
+                "collection_version": self._version,
+            }
@@ -0,0 +1,225 @@
+"""
+Transcribes and indexes a whole directory or manifest of audio files, e.g. to backfill archived episodes.
+
+Files are processed on a thread pool. Uploads and indexing have their own limits, so many
+transcriptions can wait on Gladia while only a few files are uploaded or embedded at a time.
+Every finished or failed file is appended to a JSONL journal, and a restarted run skips the files
+the journal lists as done. Transcripts are kept in the transcript store like those of
+/analyze-audio, so files already transcribed by the service are neither transcribed nor indexed again.
+
+    python batch_transcribe.py archive/ --workers 8 --journal backfill.jsonl
+    python batch_transcribe.py episodes.txt --workers 8 --upload-workers 2 --index-workers 2
+
+A manifest is a text file with one path or URL per line, relative paths are resolved against its
+directory and lines starting with # are skipped.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from transcribe import transcribe, index_transcript
+from indexer import embed_texts, window_utterances
+from transcript_store import get_transcript_store
+
+AUDIO_EXTENSIONS = 'mp3,wav,m4a,flac,ogg,opus,aac,mp4,webm'
+
+
+def is_url(source):
+    return source.startswith(('http://', 'https://'))
+
+
+def list_sources(path, extensions):
+    """
+    Returns the audio files below a directory or the entries of a manifest, in order.
+    """
+    if os.path.isdir(path):
+        sources = []
+        for directory, _, filenames in os.walk(path):
+            sources.extend(os.path.abspath(os.path.join(directory, filename)) for filename in filenames
+                           if os.path.splitext(filename)[1].lstrip('.').lower() in extensions)
+        return sorted(sources)
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as manifest:
+        lines = [line.strip() for line in manifest]
+    return [line if is_url(line) else os.path.abspath(os.path.join(base, line))
+            for line in lines if line and not line.startswith('#')]
+
+
+def file_hash(path):
+    with open(path, 'rb') as file:
+        return hashlib.file_digest(file, 'sha256').hexdigest()
+
+
+class Journal():
+    """
+    Append-only JSONL record of the processed files, one line per finished or failed file.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def done(self):
+        """
+        Returns the sources whose last entry is done.
+        """
+        status = {}
+        try:
+            with open(self.path) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of a crashed run may be cut off
+                        continue
+                    status[entry["source"]] = entry["status"]
+        except FileNotFoundError:
+            pass
+        return {source for source, value in status.items() if value == 'done'}
+
+    def append(self, entry):
+        line = json.dumps({**entry, "finished_at": datetime.datetime.now().isoformat(timespec='seconds')})
+        with self._lock, open(self.path, 'a') as journal:
+            journal.write(line + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+
+class Progress():
+    """
+    Prints one line per processed file with the throughput and the estimated time left.
+    """
+
+    def __init__(self, total, skipped) -> None:
+        self.total = total
+        self.processed = skipped
+        self.finished = 0
+        self.failed = 0
+        self.audio_seconds = 0.0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def update(self, source, entry):
+        with self._lock:
+            self.processed += 1
+            self.finished += 1
+            if entry["status"] == 'done':
+                self.audio_seconds += entry.get("audio_seconds") or 0
+            else:
+                self.failed += 1
+            elapsed = time.monotonic() - self.started
+            rate = self.finished / elapsed
+            eta = datetime.timedelta(seconds=int((self.total - self.processed) / rate)) if rate else '?'
+            detail = f"in {entry['seconds']:.1f}s" if entry["status"] == 'done' else f"failed: {entry['error']}"
+            print(f"[{self.processed}/{self.total}] {os.path.basename(source) or source} {detail} | "
+                  f"{self.failed} failed | {rate * 3600:.1f} files/h | "
+                  f"{self.audio_seconds / elapsed:.1f}x realtime | ETA {eta}", flush=True)
+
+
+class BatchTranscriber():
+    """
+    Transcribes, indexes and stores audio files concurrently.
+
+    Attributes:
+        upload_slots (threading.BoundedSemaphore): Limits the uploads running at the same time.
+        index_slots (threading.BoundedSemaphore): Limits the files embedded and indexed at the same time.
+        index (bool): Add the utterance windows to the vector store.
+    """
+
+    def __init__(self, upload_workers=2, index_workers=2, index=True) -> None:
+        self.upload_slots = threading.BoundedSemaphore(upload_workers)
+        self.index_slots = threading.BoundedSemaphore(index_workers)
+        self.index = index
+        self.store = get_transcript_store()
+
+    def process(self, source):
+        """
+        Returns the journal entry of one file or URL.
+        """
+        start = time.monotonic()
+        try:
+            transcript_id, data, reused = self._process(source)
+        except Exception as e:
+            return {"source": source, "status": 'failed', "error": str(e), "seconds": time.monotonic() - start}
+        return {"source": source, "status": 'done', "transcript_id": transcript_id, "reused": reused, "utterances": len(data),
+                "audio_seconds": float(data['end'].max()) if len(data) else 0.0, "seconds": time.monotonic() - start}
+
+    def _process(self, source):
+        url = source if is_url(source) else ""
+        key = None
+        if self.store is not None:
+            key = self.store.url_key(url) if url else self.store.upload_key(file_hash(source))
+            transcript_id, data = self.store.get(key) if key else (None, None)
+            if data is not None:
+                # Stored transcripts were indexed when they were stored
+                return transcript_id, data, True
+
+        extension = os.path.splitext(source)[1].lstrip('.').lower()
+        # The file, or each of its segments with segmented transcription, is uploaded holding an upload slot
+        data = transcribe(source, extension, url, index=False, upload_slots=self.upload_slots)
+
+        if self.index:
+            with self.index_slots:
+                windows = window_utterances(data)
+                index_transcript(windows, embed_texts([window.page_content for window in windows]))
+        # Only indexed transcripts are stored under their key, the service skips indexing for those
+        transcript_id = self.store.put(data, key=key if self.index else None, source=source) if self.store is not None else None
+        return transcript_id, data, False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcribe and index a directory or manifest of audio files.")
+    parser.add_argument('input', help='Directory of audio files or manifest with one path or URL per line.')
+    parser.add_argument('--journal', default='batch_transcribe.jsonl', help='Progress journal, finished files are skipped when it is reused.')
+    parser.add_argument('--workers', type=int, default=4, help='Files processed at the same time, most of them wait for Gladia.')
+    parser.add_argument('--upload-workers', type=int, default=2)
+    parser.add_argument('--index-workers', type=int, default=2)
+    parser.add_argument('--extensions', default=AUDIO_EXTENSIONS, help='Audio file extensions picked up from a directory.')
+    parser.add_argument('--no-index', action='store_true', help='Only transcribe and store, do not add to the vector store.')
+    args = parser.parse_args()
+
+    sources = list_sources(args.input, set(args.extensions.lower().split(',')))
+    journal = Journal(args.journal)
+    done = journal.done()
+    pending = [source for source in sources if source not in done]
+    print(f"{len(sources)} files, {len(sources) - len(pending)} already done, {len(pending)} to process")
+    if not pending:
+        return
+
+    batch = BatchTranscriber(args.upload_workers, args.index_workers, index=not args.no_index)
+    if batch.store is None:
+        print("TRANSCRIPT_STORE_ENABLED is false, transcripts are not kept for reprocessing", file=sys.stderr)
+    progress = Progress(len(sources), len(sources) - len(pending))
+    recorded = set()
+
+    def record(future):
+        entry = future.result()
+        journal.append(entry)
+        progress.update(futures[future], entry)
+        recorded.add(future)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(batch.process, source): source for source in pending}
+        try:
+            for future in as_completed(futures):
+                record(future)
+        except KeyboardInterrupt:
+            cancelled = sum(future.cancel() for future in futures)
+            print(f"Interrupted, {cancelled} files not started, waiting for the files in progress", file=sys.stderr)
+            for future in as_completed([future for future in futures if not future.cancelled() and future not in recorded]):
+                record(future)
+
+    print(f"{progress.finished - progress.failed} done, {progress.failed} failed in "
+          f"{datetime.timedelta(seconds=int(time.monotonic() - progress.started))}")
+    if progress.failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
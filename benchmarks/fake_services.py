@@ -0,0 +1,363 @@
+"""
+Local stand-ins for the OpenAI and Gladia APIs with configurable latency.
+
+One HTTP server answers both APIs:
+
+    OpenAI  POST /v1/chat/completions      chat, streamed or not
+            POST /v1/embeddings            deterministic bag-of-words vectors, similar texts get similar vectors
+            POST /v1/images/generations    a small PNG as b64_json or url
+    Gladia  POST /v2/upload                returns an audio url
+            POST /v2/transcription         starts a fake transcription, calls back when configured
+            GET  /v2/transcription/<id>    'processing' until the processing latency passed, then 'done'
+    Audio   GET  /audio/<name>.wav         a few seconds of noise seeded by the name, with an ETag
+
+Point the service at it with OPEN_AI_BASE_URL=http://host:port/v1 and GLADIA_API_URL=http://host:port/v2.
+
+    python benchmarks/fake_services.py --port 8900 --latency chat=0.5 --latency gladia_processing=2
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import wave
+import zlib
+import struct
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+
+# Seconds per call, every value is varied by +-JITTER
+DEFAULT_LATENCY = {
+    'chat': 0.5,                # Until the first token
+    'chat_token': 0.01,         # Between two streamed tokens
+    'embeddings': 0.1,
+    'images': 2.0,
+    'gladia_upload': 0.2,
+    'gladia_request': 0.1,
+    'gladia_poll': 0.05,
+    'gladia_processing': 3.0,   # Until a transcription is done
+}
+JITTER = 0.1
+
+EMBEDDING_DIMENSIONS = {'text-embedding-3-large': 3072}
+DEFAULT_EMBEDDING_DIMENSIONS = 1536
+
+TOPICS = {
+    'painting': "the painting uses light and colour in a way that makes the portrait feel alive",
+    'museum': "the museum should open longer in the evening and make tickets cheaper for students",
+    'sculpture': "the bronze sculpture in the garden is much larger than I expected from the photos",
+    'exhibition': "the new exhibition about modern photography was crowded but worth the visit",
+    'architecture': "the architecture of the building itself is as interesting as the collection inside",
+    'education': "school groups learn a lot from the guided tours and the workshops for children",
+}
+
+
+def _png(width=8, height=8):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    rows = b''.join(b'\x00' + b'\x80\x40\xc0' * width for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+PNG = _png()
+
+
+def fake_wav(seed, seconds=5, rate=16000):
+    """
+    Returns a WAV file of quiet noise, every seed gives different audio so no two requests share a content hash.
+    """
+    rng = np.random.default_rng(int.from_bytes(hashlib.sha256(str(seed).encode('utf-8')).digest()[:8], 'little'))
+    samples = rng.integers(-256, 256, size=rate * seconds, dtype=np.int16)
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as audio:
+        audio.setnchannels(1)
+        audio.setsampwidth(2)
+        audio.setframerate(rate)
+        audio.writeframes(samples.astype('<i2').tobytes())
+    return buffer.getvalue()
+
+
+def fake_utterances(count, seed=0):
+    """
+    Returns Gladia utterances cycling through a few topics, so the topic model finds clusters.
+    """
+    rng = random.Random(seed)
+    names = list(TOPICS)
+    utterances = []
+    for i in range(count):
+        words = TOPICS[names[i % len(names)]].split()
+        rng.shuffle(words)
+        utterances.append({"text": ' '.join(words[:rng.randint(6, len(words))]).capitalize() + '.',
+                           "speaker": i % 3, "start": i * 4.0, "end": i * 4.0 + 3.5})
+    return utterances
+
+
+class FakeServices():
+    """
+    State and behaviour of the fake APIs.
+
+    Attributes:
+        latency (dict): Seconds per call type, see DEFAULT_LATENCY.
+        utterances (int): Number of utterances in every fake transcription.
+        base_url (str): Public URL of the server, used in returned audio, result and image urls.
+    """
+
+    def __init__(self, latency=None, utterances=120, jitter=JITTER) -> None:
+        self.latency = {**DEFAULT_LATENCY, **(latency or {})}
+        self.utterances = utterances
+        self.jitter = jitter
+        self.base_url = ''
+        self._transcriptions = {}
+        self._word_vectors = {}
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def sleep(self, kind):
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+        seconds = self.latency.get(kind, 0)
+        if seconds > 0:
+            time.sleep(seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def _word_vector(self, word, dimensions):
+        key = (word, dimensions)
+        if key not in self._word_vectors:
+            seed = int.from_bytes(hashlib.sha256(word.encode('utf-8')).digest()[:8], 'little')
+            self._word_vectors[key] = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+        return self._word_vectors[key]
+
+    def embed(self, text, dimensions):
+        words = re.findall(r'\w+', text.lower()) or ['']
+        vector = np.sum([self._word_vector(word, dimensions) for word in words], axis=0)
+        return (vector / (np.linalg.norm(vector) or 1)).tolist()
+
+    def start_transcription(self, audio_url, callback_url=None):
+        transcription_id = str(uuid.uuid4())
+        with self._lock:
+            self._transcriptions[transcription_id] = {"audio_url": audio_url, "started": time.monotonic()}
+        if callback_url:
+            threading.Timer(self.latency['gladia_processing'], self._callback, (callback_url, transcription_id)).start()
+        return transcription_id
+
+    def _callback(self, callback_url, transcription_id):
+        try:
+            requests.post(callback_url, json={"id": transcription_id, "event": "transcription.success"}, timeout=10)
+        except requests.RequestException:
+            pass
+
+    def transcription(self, transcription_id):
+        with self._lock:
+            entry = self._transcriptions.get(transcription_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry["started"] < self.latency['gladia_processing']:
+            return {"id": transcription_id, "status": "processing"}
+        return {"id": transcription_id, "status": "done",
+                "result": {"transcription": {"utterances": fake_utterances(self.utterances, seed=transcription_id)}}}
+
+
+def make_handler(services):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, data, status=200):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_body(self):
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                body = b''
+                while True:
+                    size = int(self.rfile.readline().strip(), 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        return body
+                    body += self.rfile.read(size)
+                    self.rfile.readline()
+            return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        def _json_body(self):
+            return json.loads(self._read_body() or b'{}')
+
+        def _send_audio(self, path, head=False):
+            name = path[len('/audio/'):]
+            audio = fake_wav(name)
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/wav')
+            self.send_header('Content-Length', str(len(audio)))
+            self.send_header('ETag', f'"{hashlib.sha256(audio).hexdigest()[:16]}"')
+            self.end_headers()
+            if not head:
+                self.wfile.write(audio)
+
+        def do_HEAD(self):
+            path = self.path.split('?')[0]
+            if path.startswith('/audio/'):
+                return self._send_audio(path, head=True)
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path.startswith('/audio/'):
+                return self._send_audio(path)
+            if path.startswith('/v2/transcription/'):
+                services.sleep('gladia_poll')
+                result = services.transcription(path.rsplit('/', 1)[-1])
+                return self._send_json(result, 200) if result else self._send_json({"message": "not found"}, 404)
+            if path == '/files/image.png':
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(PNG)))
+                self.end_headers()
+                return self.wfile.write(PNG)
+            if path == '/stats':
+                return self._send_json({"calls": services.calls, "latency": services.latency})
+            self._send_json({"message": "not found"}, 404)
+
+        def do_POST(self):
+            path = self.path.split('?')[0]
+            if path == '/v1/chat/completions':
+                return self._chat(self._json_body())
+            if path == '/v1/embeddings':
+                return self._embeddings(self._json_body())
+            if path == '/v1/images/generations':
+                return self._images(self._json_body())
+            if path == '/v2/upload':
+                self._read_body()
+                services.sleep('gladia_upload')
+                return self._send_json({"audio_url": f"{services.base_url}/files/{uuid.uuid4()}.wav"})
+            if path == '/v2/transcription':
+                data = self._json_body()
+                services.sleep('gladia_request')
+                callback_url = (data.get('callback_config') or {}).get('url') if data.get('callback') else None
+                transcription_id = services.start_transcription(data.get('audio_url'), callback_url)
+                return self._send_json({"id": transcription_id, "result_url": f"{services.base_url}/v2/transcription/{transcription_id}"})
+            self._read_body()
+            self._send_json({"message": "not found"}, 404)
+
+        def _chat(self, data):
+            answer = "<p>People mostly talk about the exhibition, the opening hours and the ticket prices.</p>"
+            prompt_tokens = sum(len(str(message.get('content', '')).split()) for message in data.get('messages', []))
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(answer.split()), "total_tokens": prompt_tokens + len(answer.split())}
+            completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+            model = data.get('model', 'gpt-4o')
+            services.sleep('chat')
+            if not data.get('stream'):
+                return self._send_json({
+                    "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+            def send(payload):
+                event = f"data: {payload}\n\n".encode('utf-8')
+                self.wfile.write(f"{len(event):x}\r\n".encode('ascii') + event + b"\r\n")
+                self.wfile.flush()
+
+            tokens = re.findall(r'\S+\s*', answer)
+            for i, token in enumerate(tokens):
+                if i:
+                    services.sleep('chat_token')
+                send(json.dumps({"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                                 "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}))
+            send(json.dumps({"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                             "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}))
+            send("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _embeddings(self, data):
+            inputs = data.get('input', [])
+            if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+                inputs = [inputs]
+            model = data.get('model', 'text-embedding-ada-002')
+            dimensions = data.get('dimensions') or EMBEDDING_DIMENSIONS.get(model, DEFAULT_EMBEDDING_DIMENSIONS)
+            services.sleep('embeddings')
+            embeddings = []
+            for i, text in enumerate(inputs):
+                # langchain sends token ids, they are embedded as words
+                text = ' '.join(str(token) for token in text) if isinstance(text, list) else text
+                embedding = services.embed(text, dimensions)
+                if data.get('encoding_format') == 'base64':
+                    embedding = base64.b64encode(np.asarray(embedding, dtype=np.float32).tobytes()).decode('ascii')
+                embeddings.append({"object": "embedding", "index": i, "embedding": embedding})
+            tokens = sum(len(str(text).split()) for text in inputs)
+            self._send_json({"object": "list", "data": embeddings, "model": model,
+                             "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+        def _images(self, data):
+            services.sleep('images')
+            if data.get('response_format') == 'b64_json':
+                image = {"b64_json": base64.b64encode(PNG).decode('ascii')}
+            else:
+                image = {"url": f"{services.base_url}/files/image.png"}
+            self._send_json({"created": int(time.time()), "data": [{**image, "revised_prompt": data.get('prompt', '')}]})
+
+    return Handler
+
+
+def start(host='127.0.0.1', port=8900, public_host=None, **kwargs):
+    """
+    Starts the fake services in a daemon thread.
+
+    Returns:
+        tuple: The ThreadingHTTPServer and the FakeServices behind it.
+    """
+    services = FakeServices(**kwargs)
+    server = ThreadingHTTPServer((host, port), make_handler(services))
+    server.daemon_threads = True
+    services.base_url = f"http://{public_host or host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, name='fake-services', daemon=True).start()
+    return server, services
+
+
+def parse_latency(values):
+    latency = {}
+    for value in values or []:
+        name, seconds = value.split('=', 1)
+        if name not in DEFAULT_LATENCY:
+            raise argparse.ArgumentTypeError(f"Unknown latency '{name}', expected one of {', '.join(DEFAULT_LATENCY)}")
+        latency[name] = float(seconds)
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI and Gladia APIs with configurable latency.")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--public-host', default='localhost', help='Host name used in the returned urls.')
+    parser.add_argument('--latency', action='append', metavar='NAME=SECONDS', help='Latency override, can be repeated.')
+    parser.add_argument('--utterances', type=int, default=120, help='Utterances per fake transcription.')
+    args = parser.parse_args()
+
+    server, services = start(args.host, args.port, args.public_host, latency=parse_latency(args.latency), utterances=args.utterances)
+    print(f"Fake services listening on {services.base_url}, latency {json.dumps(services.latency)}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Import-time guard for the Flask service.
+
+Imports main.py in a fresh interpreter, fails if it takes longer than --max-seconds or if one of the
+heavy modules which must only be loaded on first use or by the warm-up thread was imported.
+
+    python benchmarks/import_time.py --max-seconds 2
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which main.py must not import eagerly
+HEAVY_MODULES = [
+    'bertopic', 'umap', 'hdbscan', 'sentence_transformers', 'torch', 'sklearn',
+    'langchain_openai', 'langchain_postgres', 'langchain_community', 'openai', 'pandas', 'pyarrow',
+    'rag', 'indexer', 'topic_model', 'transcribe',
+]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "modules": sorted(sys.modules)}))
+"""
+
+
+def measure(runs):
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of main.py.")
+    parser.add_argument('--runs', type=int, default=5, help='Number of fresh interpreters to measure.')
+    parser.add_argument('--max-seconds', type=float, default=2.0, help='Maximum median import time.')
+    args = parser.parse_args()
+
+    results = measure(args.runs)
+    seconds = sorted(result["seconds"] for result in results)
+    median = seconds[len(seconds) // 2]
+    loaded = set(results[0]["modules"])
+    heavy = [module for module in HEAVY_MODULES if module in loaded]
+
+    print(json.dumps({"median_seconds": median, "min_seconds": seconds[0], "max_seconds": seconds[-1], "heavy_modules": heavy}, indent=2))
+
+    failures = []
+    if median > args.max_seconds:
+        failures.append(f"median import time {median:.2f}s is above {args.max_seconds:.2f}s")
+    if heavy:
+        failures.append(f"heavy modules imported eagerly: {', '.join(heavy)}")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
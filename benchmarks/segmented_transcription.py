@@ -0,0 +1,113 @@
+"""
+Stitching and concurrency check of segmented transcription against a fake transcription backend.
+
+A synthetic recording of alternating speakers is planned with segmented_transcription.plan_segments
+at its pauses. The fake backend returns the utterances of each segment like Gladia would: relative
+to the segment start, cut at the segment edges, with speakers numbered from 0 in order of
+appearance and after a latency proportional to the segment length. The stitched transcript is
+compared with the original one and the wall time of every worker count is printed as JSON.
+
+    python benchmarks/segmented_transcription.py --duration 10800 --workers 1,4,8 --realtime-factor 0.0005
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from segmented_transcription import SegmentedTranscriber, plan_segments
+
+
+def synthetic_recording(duration, speakers, seed):
+    """
+    Returns utterances of alternating speakers covering `duration` seconds and the pauses between them.
+    """
+    rng = random.Random(seed)
+    utterances, silences = [], []
+    position, speaker = 0.0, 0
+    while True:
+        length = rng.uniform(2, 25)
+        if position + length > duration:
+            break
+        utterances.append({"text": f"utterance {len(utterances)}", "speaker": speaker, "start": position, "end": position + length})
+        pause = rng.choice([0.2, 0.3, 0.8, 1.5, 3.0])
+        if pause >= 0.5:
+            silences.append((position + length, position + length + pause))
+        position += length + pause
+        speaker = rng.choice([other for other in range(speakers) if other != speaker])
+    return utterances, silences
+
+
+class FakeSegmentBackend():
+    """
+    Transcribes segments of a synthetic recording after `realtime_factor` seconds per second of audio.
+    """
+
+    def __init__(self, utterances, realtime_factor) -> None:
+        self.utterances = utterances
+        self.realtime_factor = realtime_factor
+
+    def __call__(self, source, segment):
+        time.sleep((segment.end - segment.start) * self.realtime_factor)
+        local_speakers = {}
+        result = []
+        for utterance in self.utterances:
+            start, end = max(utterance['start'], segment.start), min(utterance['end'], segment.end)
+            if end <= start:
+                continue
+            text = utterance['text'] if (start, end) == (utterance['start'], utterance['end']) else f"{utterance['text']} (cut)"
+            speaker = local_speakers.setdefault(utterance['speaker'], len(local_speakers))
+            result.append({"text": text, "speaker": speaker, "start": start - segment.start, "end": end - segment.start})
+        return result
+
+
+def check(expected, stitched):
+    """
+    Returns the differences between the original and the stitched utterances and the speaker labels used.
+
+    A speaker who does not talk in an overlap gets a new label in the next segment, so there may be
+    more labels than speakers, but no label may be given to two speakers.
+    """
+    errors = []
+    if [u['text'] for u in stitched] != [u['text'] for u in expected]:
+        errors.append(f"{len(stitched)} utterances stitched, {len(expected)} expected or texts differ")
+    speaker_map = {}
+    for original, result in zip(expected, stitched):
+        if abs(original['start'] - result['start']) > 1e-6 or abs(original['end'] - result['end']) > 1e-6:
+            errors.append(f"{original['text']} at {result['start']:.2f}, expected {original['start']:.2f}")
+        if speaker_map.setdefault(result['speaker'], original['speaker']) != original['speaker']:
+            errors.append(f"{original['text']}: speaker {result['speaker']} is {speaker_map[result['speaker']]} and {original['speaker']}")
+    return errors, len(speaker_map)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stitching and concurrency check of segmented transcription.")
+    parser.add_argument('--duration', type=float, default=3 * 3600, help='Length of the synthetic recording in seconds.')
+    parser.add_argument('--speakers', type=int, default=3)
+    parser.add_argument('--segment-length', type=float, default=600)
+    parser.add_argument('--overlap', type=float, default=30)
+    parser.add_argument('--workers', default='1,4,8')
+    parser.add_argument('--realtime-factor', type=float, default=0.0005, help='Fake transcription seconds per second of audio.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    utterances, silences = synthetic_recording(args.duration, args.speakers, args.seed)
+    segments = plan_segments(args.duration, silences, args.segment_length, args.overlap)
+    backend = FakeSegmentBackend(utterances, args.realtime_factor)
+    report = {"duration": args.duration, "utterances": len(utterances), "speakers": args.speakers, "segments": len(segments), "runs": []}
+    for workers in [int(value) for value in args.workers.split(',')]:
+        transcriber = SegmentedTranscriber(backend, max_workers=workers, segment_length=args.segment_length, overlap=args.overlap)
+        start = time.perf_counter()
+        result = transcriber.transcribe('synthetic', segments)
+        elapsed = time.perf_counter() - start
+        errors, labels = check(utterances, result['result']['transcription']['utterances'])
+        report["runs"].append({"workers": workers, "seconds": elapsed, "speaker_labels": labels, "errors": errors[:10]})
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if any(run["errors"] for run in report["runs"]) else 0)
+
+
+if __name__ == '__main__':
+    main()
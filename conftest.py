@@ -0,0 +1,9 @@
+import os
+import tempfile
+
+# Clients created at import time need settings, the tests never reach the services
+os.environ.setdefault('OPEN_AI_API_KEY', 'test')
+os.environ.setdefault('S3_URL', 'localhost:9000')
+os.environ.setdefault('S3_SECURE', 'false')
+# main creates its job store on import
+os.environ.setdefault('JOBS_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='jobs-'), 'jobs.sqlite3'))
@@ -0,0 +1,191 @@
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field, asdict
+
+import numpy as np
+import tiktoken
+
+RAG_FETCH_K = int(os.getenv('RAG_FETCH_K', '100'))
+RAG_CONTEXT_TOKENS = int(os.getenv('RAG_CONTEXT_TOKENS', '6000'))
+RAG_MMR_LAMBDA = float(os.getenv('RAG_MMR_LAMBDA', '0.5'))
+RAG_DEDUP_THRESHOLD = float(os.getenv('RAG_DEDUP_THRESHOLD', '0.95'))
+RAG_TOKENIZER_MODEL = os.getenv('RAG_TOKENIZER_MODEL', 'gpt-4o')
+
+DOC_SEPARATOR = "\n\n"
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ContextStats:
+    """
+    Measurements of a single context assembly.
+    """
+    candidates: int = 0
+    duplicates_dropped: int = 0
+    budget_dropped: int = 0
+    chunks_sent: int = 0
+    tokens_sent: int = 0
+    timings: dict = field(default_factory=dict)
+
+
+def get_tokenizer(model=RAG_TOKENIZER_MODEL):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def remove_near_duplicates(doc_vectors, threshold):
+    """
+    Returns the indices of the documents kept, a document is dropped if its cosine similarity to an
+    earlier (higher ranked) kept document is above `threshold`.
+    """
+    similarities = doc_vectors @ doc_vectors.T
+    kept = []
+    for i in range(len(doc_vectors)):
+        if not kept or similarities[i, kept].max() <= threshold:
+            kept.append(i)
+    return kept
+
+
+def mmr_order(query_vector, doc_vectors, lambda_mult):
+    """
+    Orders documents by Maximal Marginal Relevance, trading relevance to the query against
+    similarity to the documents already selected.
+    """
+    relevance = doc_vectors @ query_vector
+    similarities = doc_vectors @ doc_vectors.T
+    selected = []
+    max_similarity = np.full(len(doc_vectors), -np.inf)
+    remaining = np.ones(len(doc_vectors), dtype=bool)
+    for _ in range(len(doc_vectors)):
+        redundancy = np.where(np.isinf(max_similarity), 0, max_similarity)
+        scores = np.where(remaining, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        remaining[best] = False
+        max_similarity = np.maximum(max_similarity, similarities[best])
+    return selected
+
+
+class ContextBuilder():
+    """
+    Assembles the RAG context: over-fetches candidates, removes near-duplicates, orders them by MMR
+    and packs them up to a token budget.
+
+    Attributes:
+        vectorstore (PGVector): Vector store the candidates are retrieved from.
+        embeddings (Embeddings): Embeddings of the vector store, used for the question.
+        fetch_k (int): Number of candidates retrieved per question.
+        token_budget (int): Maximum number of context tokens sent to the LLM.
+        mmr_lambda (float): 1 orders by relevance only, 0 by diversity only.
+        dedup_threshold (float): Cosine similarity above which a candidate counts as duplicate.
+        search_fn (callable): Function (query vector, k) -> [(Document, distance, stored embedding)], the candidates
+            are compared with their stored embeddings. A search returning (Document, distance) pairs, like the
+            vector store search used by default, makes the candidates be embedded again.
+    """
+
+    def __init__(self, vectorstore, embeddings, fetch_k=RAG_FETCH_K, token_budget=RAG_CONTEXT_TOKENS,
+                 mmr_lambda=RAG_MMR_LAMBDA, dedup_threshold=RAG_DEDUP_THRESHOLD, tokenizer=None, search_fn=None) -> None:
+        self.vectorstore = vectorstore
+        self.search_fn = search_fn or vectorstore.similarity_search_with_score_by_vector
+        self.embeddings = embeddings
+        self.fetch_k = fetch_k
+        self.token_budget = token_budget
+        self.mmr_lambda = mmr_lambda
+        self.dedup_threshold = dedup_threshold
+        self._tokenizer = tokenizer
+        self._lock = threading.Lock()
+        self._totals = {"requests": 0, "tokens_sent": 0, "chunks_sent": 0, "duplicates_dropped": 0, "budget_dropped": 0}
+        self.last_stats = None
+
+    def count_tokens(self, text):
+        if self._tokenizer is None:
+            self._tokenizer = get_tokenizer()
+        return len(self._tokenizer.encode(text))
+
+    def retrieve(self, query_vector):
+        """
+        Returns the candidates and their stored embeddings, None if the search does not return them.
+        """
+        results = self.search_fn(query_vector, k=self.fetch_k)
+        docs = [result[0] for result in results]
+        if results and all(len(result) > 2 for result in results):
+            return docs, [result[2] for result in results]
+        return docs, None
+
+    def build(self, question):
+        """
+        Returns the context for `question` and the ContextStats of its assembly.
+        """
+        stats = ContextStats()
+        timer = time.perf_counter()
+
+        def lap(stage):
+            nonlocal timer
+            now = time.perf_counter()
+            stats.timings[stage] = now - timer
+            timer = now
+
+        query_vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        lap('embed_query')
+
+        docs, doc_vectors = self.retrieve(query_vector.tolist())
+        stats.candidates = len(docs)
+        lap('retrieve')
+
+        if docs:
+            if doc_vectors is None:
+                doc_vectors = self.embeddings.embed_documents([doc.page_content for doc in docs])
+                lap('embed_candidates')
+            doc_vectors = _normalize(np.asarray(doc_vectors, dtype=np.float32))
+
+            kept = remove_near_duplicates(doc_vectors, self.dedup_threshold)
+            stats.duplicates_dropped = len(docs) - len(kept)
+            docs, doc_vectors = [docs[i] for i in kept], doc_vectors[kept]
+            lap('dedupe')
+
+            docs = [docs[i] for i in mmr_order(_normalize(query_vector), doc_vectors, self.mmr_lambda)]
+            lap('mmr')
+
+        packed = []
+        separator_tokens = self.count_tokens(DOC_SEPARATOR)
+        for doc in docs:
+            tokens = self.count_tokens(doc.page_content) + (separator_tokens if packed else 0)
+            # Chunks that do not fit are skipped, a shorter one further down may still fit
+            if stats.tokens_sent + tokens > self.token_budget:
+                stats.budget_dropped += 1
+                continue
+            packed.append(doc.page_content)
+            stats.tokens_sent += tokens
+        stats.chunks_sent = len(packed)
+        lap('pack')
+
+        self._record(stats)
+        return DOC_SEPARATOR.join(packed), stats
+
+    def _record(self, stats):
+        logger.info(f"RAG context: {stats.tokens_sent} tokens in {stats.chunks_sent}/{stats.candidates} chunks, "
+                    f"{stats.duplicates_dropped} duplicates and {stats.budget_dropped} over budget dropped, "
+                    f"timings {({stage: round(seconds, 4) for stage, seconds in stats.timings.items()})}")
+        with self._lock:
+            self._totals["requests"] += 1
+            for key in ("tokens_sent", "chunks_sent", "duplicates_dropped", "budget_dropped"):
+                self._totals[key] += getattr(stats, key)
+            self.last_stats = stats
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._totals,
+                "token_budget": self.token_budget,
+                "last": asdict(self.last_stats) if self.last_stats else None,
+            }
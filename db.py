@@ -0,0 +1,115 @@
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+
+logger = logging.getLogger(__name__)
+
+
+def _posts_url():
+    if not os.getenv('POSTGRES_HOST'):
+        return None
+    return (f"postgresql+psycopg2://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}"
+            f"@{os.getenv('POSTGRES_HOST')}:{os.getenv('POSTGRES_PORT')}/{os.getenv('POSTGRES_DB_NAME')}")
+
+
+# Vector store, indexer state and comments
+DATABASE_URL = os.getenv('DATABASE_URL')
+# Posts export, may be a different database than the vector store
+POSTS_DATABASE_URL = _posts_url()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool counting checkouts and the checkouts which had to wait for a free connection.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        # All connections are checked out and no overflow connection may be opened
+        must_wait = self._max_overflow > -1 and self._overflow >= self._max_overflow and self._pool.empty()
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                if must_wait:
+                    self.waits += 1
+                    self.wait_time += elapsed
+                    self.max_wait_time = max(self.max_wait_time, elapsed)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "size": self.size(),
+                "max_overflow": self._max_overflow,
+                "checked_out": self.checkedout(),
+                "idle": self.checkedin(),
+                "overflow": self.overflow(),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "max_wait_time": self.max_wait_time,
+            }
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(url=None):
+    """
+    Returns the process-wide pooled engine for `url`, DATABASE_URL by default.
+
+    Connections are checked with a ping before use and recycled after DB_POOL_RECYCLE seconds.
+    """
+    url = url or DATABASE_URL
+    if not url:
+        raise ValueError("DATABASE_URL is not set")
+    with _engines_lock:
+        if url not in _engines:
+            _engines[url] = create_engine(
+                url,
+                poolclass=InstrumentedQueuePool,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW,
+                pool_timeout=DB_POOL_TIMEOUT,
+                pool_recycle=DB_POOL_RECYCLE,
+                pool_pre_ping=True,
+            )
+        return _engines[url]
+
+
+def get_posts_engine():
+    """
+    Returns the pooled engine of the database the posts are exported to, configured with POSTGRES_*.
+    """
+    if POSTS_DATABASE_URL is None:
+        raise ValueError("POSTGRES_HOST is not set, the posts database is not configured")
+    return get_engine(POSTS_DATABASE_URL)
+
+
+def pool_stats():
+    """
+    Returns the pool metrics of every engine created in this process.
+    """
+    with _engines_lock:
+        engines = list(_engines.values())
+    return {engine.url.render_as_string(hide_password=True): engine.pool.stats() for engine in engines}
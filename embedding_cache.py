@@ -0,0 +1,176 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Embedding model shared by the vector store and the topic model, the pgvector collection was built with ada-002
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'text-embedding-ada-002')
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', 'embeddings.sqlite3')
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', '500000'))
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache():
+    """
+    Disk-backed embedding cache keyed by (model, dimensions, sha256(text)) with LRU eviction.
+
+    Attributes:
+        path (str): Path of the SQLite database file.
+        max_entries (int): Number of embeddings kept before the least recently used ones are evicted.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    dimensions INTEGER NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, dimensions, text_hash)
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model, dimensions, hashes):
+        """
+        Returns a dictionary of text hash -> cached vector for the hashes found in the cache.
+        """
+        found = {}
+        dimensions = dimensions or 0
+        with self._lock, self._conn:
+            # SQLite limits the number of bound parameters per statement
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND dimensions = ? AND text_hash IN ({placeholders})",
+                    (model, dimensions, *batch)
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+                self._conn.execute(
+                    f"UPDATE embeddings SET last_used = ? WHERE model = ? AND dimensions = ? AND text_hash IN ({placeholders})",
+                    (time.time(), model, dimensions, *batch)
+                )
+        return found
+
+    def put_many(self, model, dimensions, items):
+        """
+        Stores (text hash, vector) pairs and evicts the least recently used entries above max_entries.
+        """
+        dimensions = dimensions or 0
+        now = time.time()
+        rows = [(model, dimensions, key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items]
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, dimensions, text_hash, vector, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._entries += self._conn.total_changes - before
+            overflow = self._entries - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (overflow,)
+                )
+                self._entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                self.evictions += overflow
+
+    def embed(self, model, dimensions, texts, embed_fn):
+        """
+        Returns embeddings for `texts`, only the texts missing from the cache are passed to `embed_fn`.
+
+        Args:
+            model (str): Name of the embedding model.
+            dimensions (int): Number of dimensions requested from the model, None for the model default.
+            texts (list): Texts to embed.
+            embed_fn (callable): Function embedding a list of texts.
+
+        Returns:
+            list: List of float32 numpy arrays in the order of `texts`.
+        """
+        hashes = [text_hash(text) for text in texts]
+        found = self.get_many(model, dimensions, list(set(hashes)))
+
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+
+        hits = sum(1 for key in hashes if key in found)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(texts) - hits
+
+        if missing:
+            vectors = embed_fn(list(missing.values()))
+            new = {key: np.asarray(vector, dtype=np.float32) for key, vector in zip(missing.keys(), vectors)}
+            self.put_many(model, dimensions, new.items())
+            found.update(new)
+
+        return [found[key] for key in hashes]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": self._entries,
+                "evictions": self.evictions,
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    LangChain embeddings wrapper which serves repeated texts from an EmbeddingCache.
+    """
+
+    def __init__(self, embeddings, cache=None) -> None:
+        self.embeddings = embeddings
+        self.cache = cache or get_cache()
+        self.model = embeddings.model
+        self.dimensions = getattr(embeddings, 'dimensions', None)
+
+    def embed_documents(self, texts):
+        vectors = self.cache.embed(self.model, self.dimensions, list(texts), self.embeddings.embed_documents)
+        return [vector.tolist() for vector in vectors]
+
+    def embed_query(self, text):
+        vectors = self.cache.embed(self.model, self.dimensions, [text], lambda texts: [self.embeddings.embed_query(texts[0])])
+        return vectors[0].tolist()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the process-wide EmbeddingCache.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+        return _cache
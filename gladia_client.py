@@ -0,0 +1,297 @@
+import logging
+import os
+import random
+import secrets
+import threading
+import time
+import uuid
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+GLADIA_API_KEY = os.getenv('GLADIA_API_KEY')
+GLADIA_API_URL = os.getenv('GLADIA_API_URL', 'https://api.gladia.io/v2').rstrip('/')
+GLADIA_POOL_SIZE = int(os.getenv('GLADIA_POOL_SIZE', '10'))
+GLADIA_REQUEST_TIMEOUT = float(os.getenv('GLADIA_REQUEST_TIMEOUT', '60'))
+GLADIA_POLL_INITIAL_DELAY = float(os.getenv('GLADIA_POLL_INITIAL_DELAY', '1'))
+GLADIA_POLL_MAX_DELAY = float(os.getenv('GLADIA_POLL_MAX_DELAY', '30'))
+GLADIA_TRANSCRIPTION_TIMEOUT = float(os.getenv('GLADIA_TRANSCRIPTION_TIMEOUT', '3600'))
+# Public URL of the /gladia-callback endpoint, enables callback mode when set
+GLADIA_CALLBACK_URL = os.getenv('GLADIA_CALLBACK_URL')
+GLADIA_CALLBACK_SECRET = os.getenv('GLADIA_CALLBACK_SECRET') or secrets.token_urlsafe(16)
+# In callback mode the result is still polled at this interval in case a callback gets lost
+GLADIA_CALLBACK_FALLBACK_POLL = float(os.getenv('GLADIA_CALLBACK_FALLBACK_POLL', '60'))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class TranscriptionError(Exception):
+    """Raised when Gladia rejects a request or a transcription ends in an error state."""
+
+
+class TranscriptionTimeout(TranscriptionError):
+    """Raised when a transcription is not done within the configured timeout."""
+
+
+class GladiaUnavailable(TranscriptionError):
+    """Raised on rate limits, server errors and connection failures, which are worth retrying."""
+
+    def __init__(self, message, retry_after=None) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def retry_after_seconds(value):
+    """
+    Parses a Retry-After header given in seconds or as an HTTP date, None if missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class MultipartFileStream():
+    """
+    Streams a single file as a multipart/form-data body without reading it into memory.
+
+    The body is sent with a Content-Length when the file size is known and chunked otherwise.
+    """
+
+    def __init__(self, fileobj, field_name, filename, content_type, size=None) -> None:
+        self.boundary = uuid.uuid4().hex
+        self.fileobj = fileobj
+        self.size = size
+        self._head = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode()
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self._parts = self._iter_parts()
+        self._buffer = b""
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        if self.size is None:
+            raise TypeError("Size of the streamed file is unknown")
+        return len(self._head) + self.size + len(self._tail)
+
+    def _iter_parts(self):
+        yield self._head
+        while True:
+            chunk = self.fileobj.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        yield self._tail
+
+    def __iter__(self):
+        if self._buffer:
+            yield self._buffer
+            self._buffer = b""
+        yield from self._parts
+
+    def read(self, size=-1):
+        # File-like interface used by http.client when the body is sent with a Content-Length
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._parts, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class GladiaClient():
+    """
+    Client for the Gladia v2 API sharing one pooled keep-alive session.
+
+    Attributes:
+        api_key (str): Gladia API key.
+        base_url (str): Base URL of the Gladia v2 API.
+        session (requests.Session): Session reused by all requests.
+    """
+
+    def __init__(self, api_key=GLADIA_API_KEY, base_url=GLADIA_API_URL, pool_size=GLADIA_POOL_SIZE,
+                 request_timeout=GLADIA_REQUEST_TIMEOUT) -> None:
+        self.api_key = api_key
+        self.base_url = base_url
+        self.request_timeout = request_timeout
+
+        # Connection errors and gateway errors are retried by urllib3, POSTs are not replayed
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=['GET'])
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'x-gladia-key': api_key})
+
+    def _request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.request_timeout)
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.RetryError) as e:
+            raise GladiaUnavailable(f"Request to {url} failed: {e}") from e
+        except requests.RequestException as e:
+            raise TranscriptionError(f"Request to {url} failed: {e}") from e
+        if response.status_code == 429 or response.status_code >= 500:
+            raise GladiaUnavailable(f"Gladia returned {response.status_code} for {url}: {response.text}",
+                                    retry_after_seconds(response.headers.get('Retry-After')))
+        if response.status_code >= 400:
+            raise TranscriptionError(f"Gladia returned {response.status_code} for {url}: {response.text}")
+        return response.json()
+
+    def upload(self, fileobj, filename, content_type, size=None):
+        """
+        Uploads an audio file object and returns the Gladia audio url.
+
+        The file is streamed in chunks of UPLOAD_CHUNK_SIZE bytes, `size` is sent as Content-Length if known.
+        """
+        body = MultipartFileStream(fileobj, 'audio', filename, content_type, size)
+        headers = {'Content-Type': body.content_type}
+        if size is None:
+            # Without __len__ requests falls back to chunked transfer encoding
+            body = iter(body)
+        response_data = self._request('POST', f"{self.base_url}/upload", data=body, headers=headers)
+        return response_data['audio_url']
+
+    def request_transcription(self, audio_url, callback_url=None):
+        """
+        Requests a diarized transcription of `audio_url`.
+
+        Returns:
+            tuple: Tuple containing the transcription id and the result url.
+        """
+        data = {
+            'audio_url': audio_url,
+            'diarization': True
+        }
+        if callback_url:
+            data['callback'] = True
+            data['callback_config'] = {'url': callback_url, 'method': 'POST'}
+        response_data = self._request('POST', f"{self.base_url}/transcription", json=data)
+        return response_data['id'], response_data['result_url']
+
+    def get_transcription(self, result_url):
+        return self._request('GET', result_url)
+
+    def _check_status(self, poll_response):
+        status = poll_response.get('status')
+        if status == 'done':
+            return True
+        if status == 'error':
+            raise TranscriptionError(f"Transcription failed with error code {poll_response.get('error_code')}")
+        return False
+
+    def wait_for_transcription(self, result_url, transcription_id=None, timeout=GLADIA_TRANSCRIPTION_TIMEOUT):
+        """
+        Waits until the transcription is done and returns the result.
+
+        Polls `result_url` with exponential backoff and jitter. If a callback was registered for
+        `transcription_id`, the result is fetched as soon as the callback arrives and polling only
+        happens every GLADIA_CALLBACK_FALLBACK_POLL seconds. Rate limits and server errors are
+        retried until the timeout, after the Retry-After delay when Gladia sends one.
+
+        Raises:
+            TranscriptionError: If the transcription ends in an error state or Gladia rejects the request.
+            TranscriptionTimeout: If the transcription is not done after `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        event = _callback_events.get(transcription_id) if transcription_id else None
+        attempt = 0
+
+        try:
+            while True:
+                unavailable = None
+                try:
+                    poll_response = self.get_transcription(result_url)
+                    if self._check_status(poll_response):
+                        return poll_response
+                    status = poll_response.get('status')
+                except GladiaUnavailable as e:
+                    unavailable, status = e, 'unavailable'
+                    logger.warning(f"Polling failed, retrying: {e}")
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TranscriptionTimeout(f"Transcription not done after {timeout} seconds") from unavailable
+
+                if event is not None and unavailable is None:
+                    if event.wait(min(remaining, GLADIA_CALLBACK_FALLBACK_POLL)):
+                        event.clear()
+                else:
+                    delay = min(GLADIA_POLL_MAX_DELAY, GLADIA_POLL_INITIAL_DELAY * 2 ** attempt)
+                    delay = random.uniform(delay / 2, delay)
+                    if unavailable is not None and unavailable.retry_after is not None:
+                        delay = unavailable.retry_after
+                    time.sleep(min(remaining, delay))
+                    attempt += 1
+                logger.info(f"Polling for results ({status})...")
+        finally:
+            if transcription_id:
+                _callback_events.pop(transcription_id, None)
+
+    def transcribe_url(self, audio_url, timeout=GLADIA_TRANSCRIPTION_TIMEOUT):
+        """
+        Requests a transcription of `audio_url` and waits for the result, using callback mode when configured.
+        """
+        if GLADIA_CALLBACK_URL:
+            callback_url = f"{GLADIA_CALLBACK_URL}?{urlencode({'token': GLADIA_CALLBACK_SECRET})}"
+            transcription_id, result_url = self.request_transcription(audio_url, callback_url)
+            # A callback arriving before the event exists is caught by the first poll
+            _callback_events.setdefault(transcription_id, threading.Event())
+        else:
+            transcription_id, result_url = self.request_transcription(audio_url)
+        return self.wait_for_transcription(result_url, transcription_id, timeout)
+
+
+# Transcription id -> Event set by the callback endpoint
+_callback_events = {}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the process-wide GladiaClient.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = GladiaClient()
+        return _client
+
+
+def handle_callback(token, payload):
+    """
+    Wakes up the job waiting for the transcription referenced in a Gladia callback.
+
+    Returns:
+        bool: False if the token does not match GLADIA_CALLBACK_SECRET.
+    """
+    if not token or not secrets.compare_digest(token, GLADIA_CALLBACK_SECRET):
+        return False
+    transcription_id = (payload or {}).get('id') or (payload or {}).get('request_id')
+    event = _callback_events.get(transcription_id)
+    if event is not None:
+        event.set()
+    else:
+        logger.info(f"Received callback for unknown transcription {transcription_id}")
+    return True
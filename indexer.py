@@ -1,13 +1,44 @@
 from langchain_community.document_loaders import DataFrameLoader
+from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings
 from langchain_postgres.vectorstores import PGVector
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from embedding_cache import CachedEmbeddings, EMBEDDING_MODEL
+from db import get_engine
+from metrics import time_stage
+from openai_client import http_client
+from concurrent.futures import Future
+from sqlalchemy import text
 import os
-import psycopg2
+import queue
+import threading
+import time
+import logging
+import numpy as np
 import pandas as pd
 
 OPEN_AI_API_KEY = os.getenv('OPEN_AI_API_KEY')
+OPEN_AI_BASE_URL = os.getenv('OPEN_AI_BASE_URL')
 PGVECTOR_COLLECTION = os.getenv('PGVECTOR_COLLECTION')
+COMMENTS_BATCH_SIZE = int(os.getenv('COMMENTS_BATCH_SIZE', '500'))
+CONNECTION_STRING = os.getenv('DATABASE_URL')
+# Single /add-vector requests arriving within this window are embedded and inserted together
+ADD_VECTOR_BATCH_WAIT_MS = float(os.getenv('ADD_VECTOR_BATCH_WAIT_MS', '20'))
+ADD_VECTOR_BATCH_SIZE = int(os.getenv('ADD_VECTOR_BATCH_SIZE', '256'))
+# Seconds a collection version read from Postgres is reused
+COLLECTION_VERSION_TTL = float(os.getenv('COLLECTION_VERSION_TTL', '5'))
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# Consecutive transcript utterances are merged into windows of about this many characters
+TRANSCRIPT_WINDOW_CHARS = int(os.getenv('TRANSCRIPT_WINDOW_CHARS', '800'))
+# A pause longer than this many seconds between two utterances starts a new window
+TRANSCRIPT_WINDOW_MAX_GAP = float(os.getenv('TRANSCRIPT_WINDOW_MAX_GAP', '30'))
+# Start a new window whenever the speaker changes
+TRANSCRIPT_WINDOW_BY_SPEAKER = os.getenv('TRANSCRIPT_WINDOW_BY_SPEAKER', 'false').lower() == 'true'
+# Speaker of the utterances whose speaker is missing
+UNKNOWN_SPEAKER = -1
+
+logger = logging.getLogger(__name__)
 
 def load_dataframe(dataframe):
     loader = DataFrameLoader(dataframe, page_content_column="text")
@@ -16,48 +47,409 @@ def load_dataframe(dataframe):
 
 def split(data):
     text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000, chunk_overlap=200, add_start_index=True
+        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, add_start_index=True
     )
     all_splits = text_splitter.split_documents(data)
     return all_splits
 
+def get_embeddings():
+    # Texts embedded before are served from the local embedding cache
+    return CachedEmbeddings(OpenAIEmbeddings(model=EMBEDDING_MODEL, openai_api_key=OPEN_AI_API_KEY, openai_api_base=OPEN_AI_BASE_URL,
+                                             http_client=http_client, max_retries=0))
+
+def embed_texts(texts):
+    """
+    Embeds texts in batch with EMBEDDING_MODEL.
+
+    Returns:
+        numpy.ndarray: float32 matrix with one row per text.
+    """
+    with time_stage('embedding'):
+        return np.asarray(get_embeddings().embed_documents(list(texts)), dtype=np.float32)
+
 def create_and_get_vectorstore(docs, connection_string, collection_name=PGVECTOR_COLLECTION, pre_delete_collection=False):
-    embeddings = OpenAIEmbeddings(openai_api_key=OPEN_AI_API_KEY)
-    vecdb = PGVector.from_documents(
-        embedding=embeddings,
-        documents=docs,
-        collection_name=collection_name,
-        connection=connection_string,
-        pre_delete_collection=pre_delete_collection
-    )
+    if pre_delete_collection:
+        embeddings = get_embeddings()
+        vecdb = PGVector.from_documents(
+            embedding=embeddings,
+            documents=docs,
+            collection_name=collection_name,
+            connection=get_engine(connection_string),
+            pre_delete_collection=pre_delete_collection
+        )
+    else:
+        vecdb = get_vectorstore(connection_string, collection_name)
+        vecdb.add_documents(docs)
+    bump_collection_version(connection_string, collection_name)
     print('Added vectors to ', collection_name)
     return vecdb
 
 def get_vectorstore_raw(connection_string, collection_name=PGVECTOR_COLLECTION):
-    embeddings = OpenAIEmbeddings(openai_api_key=OPEN_AI_API_KEY)
+    embeddings = get_embeddings()
     vectorstore = PGVector(
         embeddings=embeddings,
         collection_name=collection_name,
-        connection=connection_string,
+        connection=get_engine(connection_string),
     )
     return vectorstore
 
+_vectorstores = {}
+_vectorstores_lock = threading.Lock()
+
+def get_vectorstore(connection_string=CONNECTION_STRING, collection_name=PGVECTOR_COLLECTION):
+    # Process-wide vectorstore per collection, shares its engine and connections between requests
+    key = (connection_string, collection_name)
+    with _vectorstores_lock:
+        if key not in _vectorstores:
+            _vectorstores[key] = get_vectorstore_raw(connection_string, collection_name)
+        return _vectorstores[key]
+
 def add_data(dataframe, connection_string, collection_name=PGVECTOR_COLLECTION, pre_delete_collection=False):
     # Returns vectorstore after adding data to pgvector, WARNING: it will delete and overwrite the collection
     data = load_dataframe(dataframe)
     splits = split(data)
-    vectorstore = create_and_get_vectorstore(splits, connection_string, collection_name, pre_delete_collection)
+    with time_stage('vector_insert'):
+        vectorstore = create_and_get_vectorstore(splits, connection_string, collection_name, pre_delete_collection)
     return vectorstore
 
-def preprocess_comments(connection_string, collection_name=PGVECTOR_COLLECTION):
+def _speaker(value):
+    # Older CSVs and the segmented fallback can leave the speaker empty
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return UNKNOWN_SPEAKER
+
+def window_utterances(dataframe, target_chars=TRANSCRIPT_WINDOW_CHARS, max_gap=TRANSCRIPT_WINDOW_MAX_GAP,
+                      by_speaker=TRANSCRIPT_WINDOW_BY_SPEAKER):
+    """
+    Merges consecutive transcript utterances into windows of about `target_chars` characters.
+
+    A window is closed when adding the next utterance would exceed `target_chars`, when the pause
+    before the next utterance is longer than `max_gap` seconds or, with `by_speaker`, when the
+    speaker changes. Utterances longer than `target_chars` form a window of their own and are
+    split like any other long document when they are indexed. Utterances without a speaker are
+    attributed to UNKNOWN_SPEAKER.
+
+    Args:
+        dataframe (pandas.DataFrame): Utterances with 'text' and 'speaker' and optionally 'start' and 'end' seconds.
+
+    Returns:
+        list: Documents with the speakers, time range and utterance range of the window as metadata.
+    """
+    has_times = 'start' in dataframe.columns and 'end' in dataframe.columns
+    windows, current = [], []
+
+    def close():
+        if not current:
+            return
+        lines = [f"Speaker {speaker}: {row['text']}" for _, row, speaker in current]
+        metadata = {
+            "speakers": sorted({speaker for _, _, speaker in current}),
+            "first_utterance": int(current[0][0]),
+            "last_utterance": int(current[-1][0]),
+        }
+        if has_times:
+            metadata["start"] = float(current[0][1]['start'])
+            metadata["end"] = float(current[-1][1]['end'])
+        windows.append(Document(page_content="\n".join(lines), metadata=metadata))
+        current.clear()
+
+    size = 0
+    for position, (_, row) in enumerate(dataframe.iterrows()):
+        speaker = _speaker(row['speaker'])
+        length = len(row['text']) + len(f"Speaker {speaker}: ") + 1
+        if current:
+            _, previous, previous_speaker = current[-1]
+            if (size + length > target_chars
+                    or (has_times and row['start'] - previous['end'] > max_gap)
+                    or (by_speaker and speaker != previous_speaker)):
+                close()
+                size = 0
+        current.append((position, row, speaker))
+        size += length
+    close()
+    return windows
+
+def add_embedded_documents(docs, embeddings, connection_string, collection_name=PGVECTOR_COLLECTION):
+    """
+    Adds documents with their precomputed embeddings, one row of `embeddings` per document.
+
+    Documents longer than a chunk are split and only their chunks are embedded again.
+    """
+    vectorstore = get_vectorstore(connection_string, collection_name)
+    texts, vectors, metadatas, long_docs = [], [], [], []
+    for doc, vector in zip(docs, embeddings):
+        if len(doc.page_content) <= CHUNK_SIZE:
+            texts.append(doc.page_content)
+            vectors.append(np.asarray(vector).tolist())
+            metadatas.append({**doc.metadata, "start_index": 0})
+        else:
+            long_docs.append(doc)
+
+    splits = split(long_docs)
+    if splits:
+        texts.extend(chunk.page_content for chunk in splits)
+        vectors.extend(vectorstore.embeddings.embed_documents([chunk.page_content for chunk in splits]))
+        metadatas.extend(chunk.metadata for chunk in splits)
+
+    if texts:
+        with time_stage('vector_insert'):
+            vectorstore.add_embeddings(texts, vectors, metadatas)
+        bump_collection_version(connection_string, collection_name)
+    print('Added vectors to ', collection_name)
+    return vectorstore
+
+_collection_versions = {}
+_collection_versions_lock = threading.Lock()
+# Connection strings whose vector_collection_version table was created by this process
+_version_tables = set()
+
+def _ensure_version_table(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS vector_collection_version (
+            collection_name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL
+        )
+    """))
+
+def bump_collection_version(connection_string=CONNECTION_STRING, collection_name=PGVECTOR_COLLECTION):
+    """
+    Increments the version of a collection, called whenever vectors are added or replaced.
+    """
+    with get_engine(connection_string).begin() as conn:
+        _ensure_version_table(conn)
+        _version_tables.add(connection_string)
+        version = conn.execute(text("""
+            INSERT INTO vector_collection_version (collection_name, version) VALUES (:collection_name, 1)
+            ON CONFLICT (collection_name) DO UPDATE SET version = vector_collection_version.version + 1
+            RETURNING version
+        """), {"collection_name": collection_name}).scalar()
+    with _collection_versions_lock:
+        _collection_versions[(connection_string, collection_name)] = (version, time.monotonic())
+    return version
+
+def get_collection_version(connection_string=CONNECTION_STRING, collection_name=PGVECTOR_COLLECTION):
+    """
+    Returns the version of a collection, reads from Postgres at most every COLLECTION_VERSION_TTL seconds.
+    """
+    key = (connection_string, collection_name)
+    with _collection_versions_lock:
+        cached = _collection_versions.get(key)
+    if cached and time.monotonic() - cached[1] < COLLECTION_VERSION_TTL:
+        return cached[0]
+
+    with get_engine(connection_string).begin() as conn:
+        # Created once per process, not on every read of the /ask path
+        if connection_string not in _version_tables:
+            _ensure_version_table(conn)
+            _version_tables.add(connection_string)
+        version = conn.execute(
+            text("SELECT version FROM vector_collection_version WHERE collection_name = :collection_name"),
+            {"collection_name": collection_name}
+        ).scalar()
+    version = version or 0
+    with _collection_versions_lock:
+        _collection_versions[key] = (version, time.monotonic())
+    return version
+
+def _get_index_state(engine, collection_name):
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS comment_index_state (
+                collection_name TEXT PRIMARY KEY,
+                last_updated_at TIMESTAMP,
+                last_id TEXT
+            )
+        """))
+        row = conn.execute(
+            text("SELECT last_updated_at, last_id FROM comment_index_state WHERE collection_name = :collection_name"),
+            {"collection_name": collection_name}
+        ).fetchone()
+    return tuple(row) if row else (None, None)
+
+def _set_index_state(conn, collection_name, last_updated_at, last_id):
+    conn.execute(text("""
+        INSERT INTO comment_index_state (collection_name, last_updated_at, last_id) VALUES (:collection_name, :last_updated_at, :last_id)
+        ON CONFLICT (collection_name) DO UPDATE SET last_updated_at = EXCLUDED.last_updated_at, last_id = EXCLUDED.last_id
+    """), {"collection_name": collection_name, "last_updated_at": last_updated_at, "last_id": last_id})
+
+def _delete_stale_comment_vectors(conn, collection_name, comment_ids, keep_ids):
+    # Removes the chunks of changed comments which were not just written, e.g. the tail of a comment
+    # that got shorter, and the duplicates written before indexing was incremental
+    conn.execute(text("""
+        DELETE FROM langchain_pg_embedding e USING langchain_pg_collection c
+        WHERE e.collection_id = c.uuid AND c.name = :collection_name AND e.cmetadata->>'id' = ANY(:comment_ids)
+          AND NOT e.id = ANY(:keep_ids)
+    """), {"collection_name": collection_name, "comment_ids": comment_ids, "keep_ids": keep_ids})
+
+def index_comments(df, vectorstore, collection_name=PGVECTOR_COLLECTION):
+    """
+    Upserts the chunks of comments and returns their ids. Chunk ids are derived from the comment id,
+    so indexing the same comment twice overwrites its vectors.
+    """
+    splits = split(load_dataframe(df))
+    ids = [f"{collection_name}:comment:{doc.metadata['id']}:{doc.metadata['start_index']}" for doc in splits]
+    if splits:
+        vectorstore.add_documents(splits, ids=ids)
+    return ids
+
+def preprocess_comments(connection_string, collection_name=PGVECTOR_COLLECTION, batch_size=COMMENTS_BATCH_SIZE):
+    """
+    Indexes comments created or updated since the last run.
+
+    Comments are read in batches through a server-side cursor ordered by (updated_at, id), the
+    position of the last indexed comment is stored in the comment_index_state table. The chunks of
+    a batch are upserted before the stale chunks of its comments are deleted and the position is
+    advanced in one transaction, so a failed batch leaves the previous vectors and is read again by
+    the next run.
+
+    Comments without updated_at sort first and are only picked up while the position is still
+    before them, an edited comment has to set updated_at to be indexed again.
+    """
+    indexed_comments = 0
+    indexed_chunks = 0
     try:
-        # Load comments table
-        conn = psycopg2.connect(connection_string)
-        query = "SELECT id, content FROM comments"
-        df = pd.read_sql(query, conn)
-        df = df.rename(columns={'content': 'text'})
-        vecdb = add_data(df, connection_string, collection_name)
-        conn.close()
+        engine = get_engine(connection_string)
+        last_updated_at, last_id = _get_index_state(engine, collection_name)
+        vectorstore = get_vectorstore(connection_string, collection_name)
+
+        # stream_results keeps the rows in a server-side cursor, only one batch is held in memory
+        with engine.connect() as read_conn:
+            result = read_conn.execution_options(stream_results=True, max_row_buffer=batch_size).execute(text("""
+                SELECT id, content, COALESCE(updated_at, TIMESTAMP '1970-01-01') AS position FROM comments
+                WHERE CAST(:last_updated_at AS TIMESTAMP) IS NULL
+                   OR (COALESCE(updated_at, TIMESTAMP '1970-01-01'), id) > (CAST(:last_updated_at AS TIMESTAMP), :last_id)
+                ORDER BY COALESCE(updated_at, TIMESTAMP '1970-01-01'), id
+            """), {"last_updated_at": last_updated_at, "last_id": last_id})
+
+            for rows in result.partitions(batch_size):
+                df = pd.DataFrame(rows, columns=['id', 'text', 'updated_at'])
+                df['id'] = df['id'].astype(str)
+                # Comments whose content was removed keep no vectors
+                comment_ids = df['id'].tolist()
+                df = df[df['text'].notna()]
+
+                ids = index_comments(df[['id', 'text']], vectorstore, collection_name) if not df.empty else []
+                last_id, last_updated_at = rows[-1][0], rows[-1][2]
+                with engine.begin() as conn:
+                    _delete_stale_comment_vectors(conn, collection_name, comment_ids, ids)
+                    _set_index_state(conn, collection_name, last_updated_at, str(last_id))
+                indexed_chunks += len(ids)
+                indexed_comments += len(df)
+                bump_collection_version(connection_string, collection_name)
+                print(f"Indexed {indexed_comments} comments ({indexed_chunks} chunks)")
     except Exception as e:
         return {"status": "error", "message": f"Error executing query: {e}"}
-    return True
+    return {"status": "success", "comments": indexed_comments, "chunks": indexed_chunks}
+
+def add_documents(contents, metadatas=None, connection_string=CONNECTION_STRING, collection_name=PGVECTOR_COLLECTION):
+    """
+    Splits and adds many texts with one embedding request and one multi-row insert.
+
+    Returns:
+        list: Ids of the added chunks.
+    """
+    metadatas = metadatas or [{} for _ in contents]
+    splits = split([Document(page_content=content, metadata=metadata) for content, metadata in zip(contents, metadatas)])
+    if not splits:
+        return []
+    ids = get_vectorstore(connection_string, collection_name).add_documents(splits)
+    bump_collection_version(connection_string, collection_name)
+    return ids
+
+
+class VectorBatcher():
+    """
+    Micro-batcher which collects single document adds for up to `max_wait` seconds and writes them together.
+
+    Attributes:
+        collection_name (str): Collection the documents are added to.
+        max_batch_size (int): Maximum number of documents per batch.
+        max_wait (float): Seconds a batch waits for more documents after its first one.
+    """
+
+    def __init__(self, connection_string=CONNECTION_STRING, collection_name=PGVECTOR_COLLECTION,
+                 max_batch_size=ADD_VECTOR_BATCH_SIZE, max_wait=ADD_VECTOR_BATCH_WAIT_MS / 1000) -> None:
+        self.connection_string = connection_string
+        self.collection_name = collection_name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='vector-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, content, metadata=None):
+        """
+        Queues a document and returns a Future resolving to the ids of its chunks.
+        """
+        future = Future()
+        self._queue.put((content, metadata or {}, future))
+        return future
+
+    def _run(self):
+        while True:
+            # The thread serves every later request, an unexpected error must not end it
+            try:
+                self._next_batch()
+            except Exception as e:
+                logger.error(f"Vector batch of {self.collection_name} failed: {e}")
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        try:
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush(batch)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+
+    def _flush(self, batch):
+        # The batch index links every chunk back to the request it came from
+        docs, accepted = [], []
+        for content, metadata, future in batch:
+            try:
+                docs.append(Document(page_content=content, metadata=dict(metadata, _batch_index=len(accepted))))
+            except Exception as e:
+                # Only the request with the invalid document fails
+                future.set_exception(e)
+                continue
+            accepted.append((content, metadata, future))
+        batch = accepted
+        if not batch:
+            return
+        try:
+            splits = split(docs)
+            owners = [doc.metadata.pop('_batch_index') for doc in splits]
+            ids = get_vectorstore(self.connection_string, self.collection_name).add_documents(splits) if splits else []
+            if ids:
+                bump_collection_version(self.connection_string, self.collection_name)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        results = [[] for _ in batch]
+        for owner, doc_id in zip(owners, ids):
+            results[owner].append(doc_id)
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+def get_batcher(collection_name=PGVECTOR_COLLECTION):
+    with _batchers_lock:
+        if collection_name not in _batchers:
+            _batchers[collection_name] = VectorBatcher(collection_name=collection_name)
+        return _batchers[collection_name]
@@ -0,0 +1,255 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from metrics import JOB_STAGE_SECONDS
+
+JOBS_DB_PATH = os.getenv('JOBS_DB_PATH', 'jobs.sqlite3')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+JOB_QUEUE_LIMIT = int(os.getenv('JOB_QUEUE_LIMIT', '20'))
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+# Owners of the runners created by this process
+_local_owners = set()
+
+
+def _owner_id():
+    # The random part tells apart processes reusing a pid, e.g. pid 1 of a restarted container
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _owner_alive(owner, current):
+    """
+    Returns whether the process which created a job may still run it, jobs of other hosts are assumed alive.
+    """
+    if owner == current or owner in _local_owners:
+        return True
+    if owner is None:
+        # Created before jobs had an owner
+        return False
+    host, pid, _ = owner.rsplit(':', 2)
+    if host != socket.gethostname():
+        return True
+    if int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueueFull(Exception):
+    """Raised when the number of pending jobs reached JOB_QUEUE_LIMIT."""
+
+
+class JobStore():
+    """
+    SQLite backed store for job state, per-stage progress and results.
+
+    Attributes:
+        path (str): Path of the SQLite database file.
+    """
+
+    def __init__(self, path=JOBS_DB_PATH) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    stages TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    owner TEXT
+                )
+            """)
+            if 'owner' not in [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create(self, kind, stages, owner=None):
+        job_id = str(uuid.uuid4())
+        now = _now()
+        stages = [{"name": name, "status": STATUS_QUEUED, "started_at": None, "finished_at": None} for name in stages]
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, status, stages, created_at, updated_at, owner) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, STATUS_QUEUED, json.dumps(stages), now, now, owner)
+            )
+        return job_id
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, kind, status, stages, result, error, created_at, updated_at FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "kind": row[1],
+            "status": row[2],
+            "stages": json.loads(row[3]),
+            "result": json.loads(row[4]) if row[4] is not None else None,
+            "error": row[5],
+            "created_at": row[6],
+            "updated_at": row[7],
+        }
+
+    def update(self, job_id, status=None, stage=None, stage_status=None, result=None, error=None):
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT status, stages FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            current_status, stages = row[0], json.loads(row[1])
+            if stage is not None:
+                for entry in stages:
+                    if entry["name"] == stage:
+                        entry["status"] = stage_status
+                        if stage_status == STATUS_RUNNING:
+                            entry["started_at"] = _now()
+                        else:
+                            entry["finished_at"] = _now()
+            conn.execute(
+                "UPDATE jobs SET status = ?, stages = ?, result = COALESCE(?, result), error = COALESCE(?, error), updated_at = ? WHERE id = ?",
+                (status or current_status, json.dumps(stages),
+                 json.dumps(result) if result is not None else None, error, _now(), job_id)
+            )
+
+    def fail_orphaned(self, owner, reason):
+        """
+        Marks the unfinished jobs of processes which no longer run as failed, they can never finish.
+        Jobs of `owner` and of other live processes sharing the database are left alone.
+
+        Returns:
+            list: The ids of the failed jobs.
+        """
+        with self._lock, self._connect() as conn:
+            rows = conn.execute("SELECT id, owner FROM jobs WHERE status IN (?, ?)", (STATUS_QUEUED, STATUS_RUNNING)).fetchall()
+            orphaned = [job_id for job_id, job_owner in rows if not _owner_alive(job_owner, owner)]
+            conn.executemany(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                [(STATUS_FAILED, reason, _now(), job_id) for job_id in orphaned]
+            )
+        return orphaned
+
+
+class JobContext():
+    """
+    Handle passed to a job function to report per-stage progress.
+    """
+
+    def __init__(self, store, job_id) -> None:
+        self.store = store
+        self.job_id = job_id
+
+    @contextmanager
+    def stage(self, name):
+        self.store.update(self.job_id, stage=name, stage_status=STATUS_RUNNING)
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.store.update(self.job_id, stage=name, stage_status=STATUS_FAILED)
+            raise
+        finally:
+            JOB_STAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+        self.store.update(self.job_id, stage=name, stage_status=STATUS_DONE)
+
+
+class JobRunner():
+    """
+    Runs jobs on a bounded thread pool and records their state in a JobStore.
+
+    Attributes:
+        store (JobStore): Store for job state and results.
+        max_workers (int): Number of jobs executed concurrently.
+        max_pending (int): Maximum number of queued and running jobs.
+        owner (str): Host, pid and a random id of this runner, recorded with its jobs.
+    """
+
+    def __init__(self, store, max_workers=JOB_WORKERS, max_pending=JOB_QUEUE_LIMIT) -> None:
+        self.store = store
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.owner = _owner_id()
+        _local_owners.add(self.owner)
+        self.store.fail_orphaned(self.owner, "Interrupted by a server restart")
+
+    def submit(self, kind, stages, fn, *args, on_done=None, **kwargs):
+        """
+        Queue `fn(job, *args, **kwargs)` and return the job id right away.
+
+        Args:
+            kind (str): Job type, e.g. 'analyze-audio'.
+            stages (list): Names of the stages reported by `fn`.
+            fn (callable): Job function, receives a JobContext as first argument.
+            on_done (callable): Optional cleanup hook, called when the job finished or failed.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise JobQueueFull(f"Too many pending jobs ({self._pending})")
+            self._pending += 1
+
+        job_id = self.store.create(kind, stages, owner=self.owner)
+        self._executor.submit(self._run, job_id, fn, args, kwargs, on_done)
+        return job_id
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def _run(self, job_id, fn, args, kwargs, on_done):
+        try:
+            self.store.update(job_id, status=STATUS_RUNNING)
+            result = fn(JobContext(self.store, job_id), *args, **kwargs)
+            self.store.update(job_id, status=STATUS_DONE, result=result)
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}\n{traceback.format_exc()}")
+            self.store.update(job_id, status=STATUS_FAILED, error=str(e))
+        finally:
+            with self._lock:
+                self._pending -= 1
+            if on_done is not None:
+                try:
+                    on_done()
+                except Exception as e:
+                    logger.warning(f"Cleanup of job {job_id} failed: {e}")
@@ -1,14 +1,21 @@
-from flask import Flask, request, jsonify
-from transcribe import transcribe, upload_audio
-from topic_model import TopicModel
-import pandas as pd
+from flask import Flask, Response, request, jsonify, stream_with_context
+from jobs import JobStore, JobRunner, JobQueueFull
+from pipeline import analyze_audio, reprocess_transcript, ANALYSIS_STAGES, REPROCESS_STAGES
+from uploads import SpoolingRequest, detach_upload, upload_hash
 from waitress import serve
-from rag import answer_query
 from flask_cors import CORS
-from indexer import preprocess_comments, add_data
+from gladia_client import handle_callback
+from warmup import components
+from metrics import render, register_stats, REQUEST_SECONDS
+import json
+import logging
 import os
+import time
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+app.request_class = SpoolingRequest
 
 CORS(app)
 cors = CORS(app, resources={
@@ -20,12 +27,95 @@ cors = CORS(app, resources={
 
 PGVECTOR_COLLECTION = os.getenv('PGVECTOR_COLLECTION')
 CONNECTION_STRING = os.getenv('DATABASE_URL')
+ADD_VECTOR_TIMEOUT = float(os.getenv('ADD_VECTOR_TIMEOUT', '60'))
+
+job_runner = JobRunner(JobStore())
+
+
+@app.before_request
+def start_timer():
+    request.started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # Streamed responses are observed when their headers are sent
+    if hasattr(request, 'started'):
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.labels(endpoint, request.method, str(response.status_code)).observe(time.perf_counter() - request.started)
+    return response
 
 @app.route('/health', methods=['GET'])
 def health():
+    # Liveness only, heavy components are reported by /ready
     return jsonify({"status": "ok"}), 200
 
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    is_ready, state = components.status()
+    return jsonify({"ready": is_ready, "components": state}), 200 if is_ready else 503
+
+
+def embedding_cache_stats():
+    from embedding_cache import get_cache
+    return get_cache().stats()
+
+
+def db_pool_stats():
+    from db import pool_stats
+    return pool_stats()
+
+
+def rag_context_stats():
+    # Components which are not loaded yet have no stats
+    return components.get('rag').get_context_builder().stats() if components.is_warm('rag') else None
+
+
+def answer_cache_stats():
+    return components.get('rag').get_answer_cache().stats() if components.is_warm('rag') else None
+
+
+def transcript_store_stats():
+    from transcript_store import get_transcript_store
+    store = get_transcript_store()
+    return store.stats() if store else None
+
+
+def vector_snapshot_stats():
+    if not components.is_warm('rag') or components.get('rag').RAG_RETRIEVAL_BACKEND != 'snapshot':
+        return None
+    from vector_snapshot import get_snapshot
+    return get_snapshot().stats()
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        "embedding_cache": embedding_cache_stats(),
+        "rag_context": rag_context_stats(),
+        "answer_cache": answer_cache_stats(),
+        "db_pool": db_pool_stats(),
+        "vector_snapshot": vector_snapshot_stats(),
+        "transcript_store": transcript_store_stats(),
+    }), 200
+
+
+# The /stats numbers are exported as gauges on /metrics
+register_stats('embedding_cache', embedding_cache_stats)
+register_stats('rag_context', rag_context_stats)
+register_stats('answer_cache', answer_cache_stats)
+register_stats('db_pool', db_pool_stats, label='engine')
+register_stats('vector_snapshot', vector_snapshot_stats)
+register_stats('transcript_store', transcript_store_stats)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    body, content_type = render()
+    return Response(body, content_type=content_type)
+
+
 @app.route('/analyze-audio', methods=['POST'])
 def transcription():
     if 'audio_file' not in request.files:
@@ -35,44 +125,73 @@ def transcription():
     audio_extension = audio_file.filename.split('.')[-1]
 
     if audio_file:
-        file_path = f"temp.{audio_extension}"
-        audio_file.save(file_path)
-
-        data = transcribe(file_path, audio_extension)
-        print(data.head())
-
-        # If transcription is successful, start topic modeling
-        if data is not None:
-            topic_model = TopicModel(data['text'].values)
-            posts = topic_model.get_posts()
-            return jsonify({"posts": posts}), 200
-        else:
-            return jsonify({"error": "Transcription failed"}), 400
+        # The upload stays in memory or in an anonymous spool file and is streamed to Gladia by the job
+        audio_stream, _ = detach_upload(audio_file)
+
+        try:
+            job_id = job_runner.submit('analyze-audio', ANALYSIS_STAGES, analyze_audio,
+                                       audio_stream, audio_extension, content_hash=upload_hash(audio_stream),
+                                       on_done=audio_stream.close)
+        except JobQueueFull as e:
+            audio_stream.close()
+            return jsonify({"error": str(e)}), 503
+        return jsonify({"job_id": job_id, "status_url": f"/jobs/{job_id}"}), 202
     else:
         return jsonify({"error": "Invalid file"}), 400
 
 
 @app.route('/analyze-url', methods=['POST'])
 def transcribe_url():
-    print(request, request.json)
-    if 'audio_url' not in request.json:
+    if not request.json or 'audio_url' not in request.json:
         return jsonify({"error": "No audio url part"}), 400
 
     audio_url = request.json['audio_url']
 
     if audio_url:
-        data = transcribe("", "", audio_url)
-        # If transcription is successful, start topic modeling
-        if data is not None:
-            topic_model = TopicModel(data['text'].values)
-            posts = topic_model.get_posts()
-            return jsonify({"posts": posts}), 200
-        else:
-            return jsonify({"error": "Transcription failed"}), 400
+        try:
+            job_id = job_runner.submit('analyze-url', ANALYSIS_STAGES, analyze_audio, audio_url=audio_url)
+        except JobQueueFull as e:
+            return jsonify({"error": str(e)}), 503
+        return jsonify({"job_id": job_id, "status_url": f"/jobs/{job_id}"}), 202
     else:
         return jsonify({"error": "Invalid file"}), 400
 
 
+@app.route('/transcripts', methods=['GET'])
+def list_transcripts():
+    from transcript_store import get_transcript_store
+    store = get_transcript_store()
+    if store is None:
+        return jsonify({"error": "Transcript store is disabled"}), 404
+    return jsonify({"transcripts": store.manifest(limit=request.args.get('limit', 100, type=int))}), 200
+
+
+@app.route('/transcripts/<transcript_id>/reprocess', methods=['POST'])
+def reprocess(transcript_id):
+    index = bool((request.get_json(silent=True) or {}).get('index', False))
+    try:
+        job_id = job_runner.submit('reprocess', REPROCESS_STAGES, reprocess_transcript, transcript_id, index=index)
+    except JobQueueFull as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify({"job_id": job_id, "status_url": f"/jobs/{job_id}"}), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_runner.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
+
+
+@app.route('/gladia-callback', methods=['POST'])
+def gladia_callback():
+    # Gladia posts here when a transcription requested in callback mode is finished
+    if not handle_callback(request.args.get('token'), request.get_json(silent=True)):
+        return jsonify({"error": "Invalid token"}), 403
+    return jsonify({"status": "ok"}), 200
+
+
 @app.route('/ask', methods=['POST'])
 def ask():
     data = request.json
@@ -81,43 +200,114 @@ def ask():
         return jsonify({"error": "Question is required"}), 400
 
     # Run the RAG pipeline
-    result = answer_query(question)
+    result = components.get('rag').answer_query(question)
 
     return jsonify({"answer": result})
 
 
+def sse_event(data, event=None):
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+
+def stream_events(chunks, started):
+    # Formats answer chunks as Server-Sent Events and reports the time to the first token
+    ttft = None
+    try:
+        for chunk in chunks:
+            if ttft is None:
+                ttft = time.perf_counter() - started
+                logger.info(f"/ask/stream time to first token: {ttft:.3f}s")
+            yield sse_event({"token": chunk})
+    except Exception as e:
+        yield sse_event({"error": str(e)}, event="error")
+        return
+    yield sse_event({"time_to_first_token": ttft, "total_time": time.perf_counter() - started}, event="done")
+
+
+@app.route('/ask/stream', methods=['POST'])
+def ask_stream():
+    data = request.json or {}
+    question = data.get('question', '')
+    if not question:
+        return jsonify({"error": "Question is required"}), 400
+
+    started = time.perf_counter()
+    stream_answer = components.get('rag').stream_answer
+    response = Response(stream_with_context(stream_events(stream_answer(question), started)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @app.route('/preprocess-comments', methods=['POST'])
 def prepare_vectors():
     try:
-        preprocess_comments(CONNECTION_STRING)
-        return jsonify({"status": "success", "message": "Comments added to the vectorstore successfully."}), 200
+        result = components.get('indexer').preprocess_comments(CONNECTION_STRING)
+        if result["status"] == "error":
+            return jsonify(result), 500
+        return jsonify({"status": "success", "message": f"{result['comments']} new or updated comments added to the vectorstore successfully."}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+def is_valid_content(content):
+    return isinstance(content, str) and content.strip() != ''
+
+
 @app.route('/add-vector', methods=['POST'])
 def add_vector():
     try:
         # Check if the request has the JSON body with 'content'
-        if not request.json or 'content' not in request.json:
-            return jsonify({"status": "error", "message": "Content is required"}), 400
-        
-        # Get the content from the request
-        content = request.json['content']
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not is_valid_content(data.get('content')):
+            return jsonify({"status": "error", "message": "Content is required and must be a non-empty string"}), 400
+        metadata = data.get('metadata') or {}
+        if not isinstance(metadata, dict):
+            return jsonify({"status": "error", "message": "Metadata must be an object"}), 400
 
-        # Convert content to a DataFrame
-        df = pd.DataFrame([{"text": content}])
+        # Get the content from the request
+        content = data['content']
 
-        # Add the processed content to the vectorstore
-        connection_string = os.getenv('DATABASE_URL')
-        add_data(df, connection_string, collection_name=PGVECTOR_COLLECTION, pre_delete_collection=False)
+        # Concurrent single adds are embedded and inserted together by the batcher
+        components.get('indexer').get_batcher(PGVECTOR_COLLECTION).submit(content, metadata).result(timeout=ADD_VECTOR_TIMEOUT)
 
         return jsonify({"status": "success", "message": "Content added to the vectorstore successfully."}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+
+@app.route('/add-vectors', methods=['POST'])
+def add_vectors():
+    try:
+        # Expects {"documents": [{"content": "...", "metadata": {...}}, ...]}, plain strings are accepted as well
+        data = request.get_json(silent=True)
+        documents = data.get('documents') if isinstance(data, dict) else None
+        if not documents or not isinstance(documents, list):
+            return jsonify({"status": "error", "message": "A non-empty list of documents is required"}), 400
+
+        contents, metadatas = [], []
+        for document in documents:
+            if isinstance(document, str):
+                document = {"content": document}
+            if not isinstance(document, dict) or not is_valid_content(document.get('content')):
+                return jsonify({"status": "error", "message": "Every document needs a content, a non-empty string"}), 400
+            if not isinstance(document.get('metadata') or {}, dict):
+                return jsonify({"status": "error", "message": "The metadata of a document must be an object"}), 400
+            contents.append(document['content'])
+            metadatas.append(document.get('metadata') or {})
+
+        ids = components.get('indexer').add_documents(contents, metadatas, CONNECTION_STRING, PGVECTOR_COLLECTION)
+
+        return jsonify({"status": "success", "message": f"{len(contents)} documents added to the vectorstore successfully.", "chunks": len(ids)}), 200
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
     
 if __name__ == '__main__':
+    # Heavy components load in the background while the server already answers /health
+    components.start_warmup()
+
     # Production server
     serve(app, host="0.0.0.0", port=8080)
 
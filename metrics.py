@@ -0,0 +1,136 @@
+"""
+Prometheus metrics of the service, exposed on /metrics.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+
+# Stages range from milliseconds (CSV build) to many minutes (transcription wait)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, float('inf'))
+
+logger = logging.getLogger(__name__)
+
+registry = CollectorRegistry()
+
+STAGE_SECONDS = Histogram(
+    'pipeline_stage_seconds', 'Duration of the steps of audio analysis, indexing and answering.',
+    ['stage'], buckets=STAGE_BUCKETS, registry=registry
+)
+STAGE_ERRORS = Counter(
+    'pipeline_stage_errors_total', 'Steps which raised an exception.', ['stage'], registry=registry
+)
+JOB_STAGE_SECONDS = Histogram(
+    'job_stage_seconds', 'Duration of the stages reported by background jobs.',
+    ['stage'], buckets=STAGE_BUCKETS, registry=registry
+)
+REQUEST_SECONDS = Histogram(
+    'http_request_seconds', 'Duration of HTTP requests until the response is returned.',
+    ['endpoint', 'method', 'status'], registry=registry
+)
+OPENAI_TOKENS = Counter(
+    'openai_tokens_total', 'OpenAI tokens as reported in the usage of the responses.',
+    ['model', 'kind'], registry=registry
+)
+OPENAI_REQUESTS = Counter(
+    'openai_requests_total', 'OpenAI API calls sent upstream, calls answered by an identical call in flight are not counted.', ['operation', 'model'], registry=registry
+)
+OPENAI_THROTTLED = Counter(
+    'openai_throttled_total', 'OpenAI calls delayed by the local rate limiter or rejected with 429 by the API.',
+    ['model', 'source'], registry=registry
+)
+OPENAI_THROTTLE_SECONDS = Counter(
+    'openai_throttle_seconds_total', 'Seconds OpenAI calls waited for the local rate limiter.', ['model'], registry=registry
+)
+OPENAI_RETRIES = Counter(
+    'openai_retries_total', 'Retried OpenAI calls by the status code or error of the failed attempt.',
+    ['model', 'reason'], registry=registry
+)
+OPENAI_COALESCED = Counter(
+    'openai_coalesced_total', 'OpenAI calls answered by an identical call already in flight.', ['model'], registry=registry
+)
+
+
+@contextmanager
+def time_stage(stage):
+    """
+    Observes the duration of the block in pipeline_stage_seconds, failures are counted as well.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+def record_usage(model, usage):
+    """
+    Counts the prompt and completion tokens of an OpenAI response usage, an object or a dictionary.
+    """
+    if usage is None:
+        return
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        tokens = usage.get(kind) if isinstance(usage, dict) else getattr(usage, kind, None)
+        if tokens:
+            OPENAI_TOKENS.labels(model, kind.replace('_tokens', '')).inc(tokens)
+
+
+class StatsCollector():
+    """
+    Exports the numbers of the existing stats() functions, e.g. the embedding cache hit rate, as gauges.
+
+    A stats function returns a dictionary of numbers, or with `label` a dictionary of label value -> dictionary of numbers.
+    """
+
+    def __init__(self) -> None:
+        self._sources = []
+        self._lock = threading.Lock()
+
+    def add(self, name, stats_fn, label=None):
+        with self._lock:
+            self._sources.append((name, stats_fn, label))
+
+    def collect(self):
+        with self._lock:
+            sources = list(self._sources)
+        for name, stats_fn, label in sources:
+            # A failing source, e.g. an unreachable database, must not fail the whole scrape
+            try:
+                stats, up = stats_fn(), 1
+            except Exception as e:
+                logger.warning(f"Stats of {name} failed: {e}")
+                stats, up = None, 0
+            yield GaugeMetricFamily(f"{name}_stats_up", f"1 if the stats of {name} could be collected", value=up)
+            if not stats:
+                continue
+            groups = stats.items() if label else [(None, stats)]
+            families = {}
+            for label_value, values in groups:
+                for key, value in values.items():
+                    if isinstance(value, bool) or not isinstance(value, (int, float)):
+                        continue
+                    if key not in families:
+                        families[key] = GaugeMetricFamily(f"{name}_{key}", f"{key} of {name}", labels=[label] if label else [])
+                    families[key].add_metric([str(label_value)] if label else [], value)
+            yield from families.values()
+
+
+stats_collector = StatsCollector()
+registry.register(stats_collector)
+
+
+def register_stats(name, stats_fn, label=None):
+    stats_collector.add(name, stats_fn, label)
+
+
+def render():
+    """
+    Returns the metrics in the Prometheus text format and its content type.
+    """
+    return generate_latest(registry), CONTENT_TYPE_LATEST
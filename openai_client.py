@@ -1,29 +1,364 @@
-from openai import OpenAI
-import os 
+"""
+Shared gateway to the OpenAI API.
+
+Every OpenAI client of the service (the SDK client below, the langchain chat model and embeddings
+and the BERTopic embedding backend) sends its requests through `http_client`, whose transport:
+
+- waits for a token bucket per model, with one bucket for requests and one for tokens per minute,
+  configured with OPENAI_RATE_LIMITS or learned from the x-ratelimit-* headers of the responses
+- retries 429, 5xx and connection errors with jittered exponential backoff, honouring Retry-After,
+  and holds back all calls of a model while the API asks to wait
+- answers identical non-streamed requests in flight with one API call
+- counts every API call and the tokens of its usage once, calls answered by a call in flight are not counted
+
+The SDK clients are created with max_retries=0 so a call is not retried twice.
+"""
+from openai import OpenAI, DefaultHttpxClient
+from metrics import time_stage, record_usage, OPENAI_REQUESTS, OPENAI_THROTTLED, OPENAI_THROTTLE_SECONDS, OPENAI_RETRIES, OPENAI_COALESCED
+import base64
+import email.utils
+import hashlib
+import httpx
+import json
+import logging
+import os
+import random
+import threading
+import time
 
 OPEN_AI_PROJECT_ID = os.getenv('OPEN_AI_PROJECT_ID')
 OPEN_AI_ORGANIZATION_ID = os.getenv('OPEN_AI_ORGANIZATION_ID')
 OPEN_AI_API_KEY = os.getenv('OPEN_AI_API_KEY')
+# Alternative API endpoint, e.g. the fake services of the benchmarks
+OPEN_AI_BASE_URL = os.getenv('OPEN_AI_BASE_URL')
+# Requests and tokens per minute per model as model=rpm/tpm, e.g. "gpt-4o=500/30000,dall-e-3=5/0", 0 is unlimited.
+# Models without an entry use the limits reported by the API in its x-ratelimit-limit-* headers
+OPENAI_RATE_LIMITS = os.getenv('OPENAI_RATE_LIMITS', '')
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '5'))
+OPENAI_BACKOFF_BASE = float(os.getenv('OPENAI_BACKOFF_BASE', '0.5'))
+OPENAI_BACKOFF_MAX = float(os.getenv('OPENAI_BACKOFF_MAX', '60'))
+OPENAI_POOL_SIZE = int(os.getenv('OPENAI_POOL_SIZE', '20'))
+# Completion tokens reserved for a chat request without max_tokens, corrected by the usage of the response
+COMPLETION_TOKENS_ESTIMATE = 256
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# Operation label of the API paths in openai_requests_total
+OPERATIONS = {'chat/completions': 'chat', 'completions': 'completion', 'embeddings': 'embeddings', 'images/generations': 'image'}
+
+logger = logging.getLogger(__name__)
+
+
+def parse_rate_limits(value):
+    limits = {}
+    for entry in filter(None, (part.strip() for part in value.split(','))):
+        model, _, rates = entry.partition('=')
+        requests_per_minute, _, tokens_per_minute = rates.partition('/')
+        limits[model.strip()] = (float(requests_per_minute or 0), float(tokens_per_minute or 0))
+    return limits
+
+
+def estimate_tokens(body):
+    """
+    Estimates the tokens a request counts against the TPM limit, about 4 characters per token.
+    """
+    if 'messages' in body:
+        characters = 0
+        for message in body['messages']:
+            content = message.get('content') or ''
+            if isinstance(content, list):
+                content = ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+            characters += len(content)
+        return characters // 4 + (body.get('max_tokens') or COMPLETION_TOKENS_ESTIMATE)
+    if 'input' in body:
+        inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+        # langchain sends token ids, lists of ints, instead of texts
+        if inputs and isinstance(inputs[0], int):
+            return len(inputs)
+        return sum(len(value) if isinstance(value, list) else len(value) // 4 for value in inputs)
+    return 0
+
+
+def operation(url):
+    path = url.path.rstrip('/')
+    for suffix, name in OPERATIONS.items():
+        if path.endswith(f"/{suffix}"):
+            return name
+    return path.rsplit('/', 1)[-1] or 'unknown'
+
+
+def retry_after(headers):
+    """
+    Returns the delay the API asks for in seconds, None if the response does not say.
+    """
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class TokenBucket():
+    """
+    Bucket refilled with `per_minute` units per minute up to `per_minute`.
+
+    Reservations may take the bucket below zero, the caller then waits until it is refilled, so
+    requests larger than the bucket still pass one at a time.
+    """
+
+    def __init__(self, per_minute) -> None:
+        self.per_minute = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """
+        Takes `amount` units and returns the seconds until the bucket is no longer in debt.
+        """
+        self._refill(now)
+        self.level -= amount
+        return max(0.0, -self.level * 60 / self.per_minute)
+
+    def sync(self, remaining, now):
+        # The API counts the calls of all processes sharing the key
+        self._refill(now)
+        self.level = min(self.level, remaining)
+
+
+class RateLimiter():
+    """
+    Request and token buckets of every model.
+    """
+
+    def __init__(self, limits=None) -> None:
+        self.limits = parse_rate_limits(OPENAI_RATE_LIMITS) if limits is None else limits
+        self._buckets = {}
+        self._blocked_until = {}
+        self._lock = threading.Lock()
 
-client = OpenAI( 
+    def _model_buckets(self, model):
+        if model not in self._buckets:
+            requests_per_minute, tokens_per_minute = self.limits.get(model, (0, 0))
+            self._buckets[model] = [TokenBucket(requests_per_minute) if requests_per_minute else None,
+                                    TokenBucket(tokens_per_minute) if tokens_per_minute else None]
+        return self._buckets[model]
+
+    def acquire(self, model, tokens):
+        """
+        Waits until the model has capacity for one request of `tokens` tokens.
+        """
+        with self._lock:
+            now = time.monotonic()
+            requests_bucket, tokens_bucket = self._model_buckets(model)
+            wait = max(
+                self._blocked_until.get(model, 0) - now,
+                requests_bucket.reserve(1, now) if requests_bucket else 0,
+                tokens_bucket.reserve(tokens, now) if tokens_bucket and tokens else 0,
+            )
+        if wait > 0:
+            OPENAI_THROTTLED.labels(model, 'local').inc()
+            OPENAI_THROTTLE_SECONDS.labels(model).inc(wait)
+            time.sleep(wait)
+
+    def refund(self, model, tokens):
+        """
+        Corrects the token bucket by the difference between estimated and used tokens.
+        """
+        with self._lock:
+            tokens_bucket = self._model_buckets(model)[1]
+            if tokens_bucket:
+                tokens_bucket.level = min(tokens_bucket.per_minute, tokens_bucket.level + tokens)
+
+    def block(self, model, seconds):
+        with self._lock:
+            self._blocked_until[model] = max(self._blocked_until.get(model, 0), time.monotonic() + seconds)
+
+    def observe(self, model, headers):
+        """
+        Adopts the limits of the x-ratelimit headers for models without configured limits and
+        lowers the buckets to the remaining requests and tokens reported by the API.
+        """
+        with self._lock:
+            now = time.monotonic()
+            buckets = self._model_buckets(model)
+            for i, kind in enumerate(('requests', 'tokens')):
+                try:
+                    limit = float(headers.get(f'x-ratelimit-limit-{kind}', 0))
+                    remaining = float(headers.get(f'x-ratelimit-remaining-{kind}', limit))
+                except ValueError:
+                    continue
+                if buckets[i] is None and limit and model not in self.limits:
+                    buckets[i] = TokenBucket(limit)
+                if buckets[i] is not None and limit:
+                    buckets[i].sync(remaining, now)
+
+
+class _InflightCall():
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+def _copy_response(response, content):
+    # The content is already decoded, the copy must not be decoded again
+    headers = [(name, value) for name, value in response.headers.multi_items() if name.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')]
+    return httpx.Response(response.status_code, headers=headers, content=content)
+
+
+class GatewayTransport(httpx.HTTPTransport):
+    """
+    httpx transport adding rate limiting, retries and coalescing to the OpenAI requests.
+    """
+
+    def __init__(self, limiter=None, max_retries=OPENAI_MAX_RETRIES, **kwargs) -> None:
+        kwargs.setdefault('limits', httpx.Limits(max_connections=OPENAI_POOL_SIZE, max_keepalive_connections=OPENAI_POOL_SIZE))
+        super().__init__(**kwargs)
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def handle_request(self, request):
+        content = request.read()
+        try:
+            body = json.loads(content) if content else {}
+        except ValueError:
+            # Multipart uploads, e.g. image edits
+            body = {}
+        if not isinstance(body, dict):
+            body = {}
+        model = body.get('model', 'unknown')
+        tokens = estimate_tokens(body)
+        if body.get('stream'):
+            response = self._send(request, model, tokens)
+            # The usage of a streamed response arrives with its last chunk, only the call is counted
+            OPENAI_REQUESTS.labels(operation(request.url), model).inc()
+            return response
+
+        key = hashlib.sha256(b'\0'.join([request.method.encode(), str(request.url).encode(),
+                                         request.headers.get('authorization', '').encode(), content])).hexdigest()
+        with self._inflight_lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _InflightCall()
+        if not leader:
+            call.done.wait()
+            OPENAI_COALESCED.labels(model).inc()
+            if call.error is not None:
+                raise call.error
+            return _copy_response(*call.response)
+
+        try:
+            response = self._send(request, model, tokens)
+            call.response = (response, response.read())
+            response.close()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+            call.done.set()
+        self._record(request, model, tokens, *call.response)
+        return _copy_response(*call.response)
+
+    def _record(self, request, model, estimated, response, content):
+        """
+        Counts the call and its token usage and corrects the token bucket by the used tokens.
+        """
+        OPENAI_REQUESTS.labels(operation(request.url), model).inc()
+        if response.status_code != 200:
+            return
+        try:
+            usage = json.loads(content).get('usage') or {}
+        except (ValueError, AttributeError):
+            return
+        record_usage(model, usage)
+        if usage.get('total_tokens') is not None:
+            self.limiter.refund(model, estimated - usage['total_tokens'])
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+
+    def _send(self, request, model, tokens):
+        """
+        Sends the request when the rate limiter allows it and retries it on throttling and server errors.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(model, tokens)
+            try:
+                response = super().handle_request(request)
+            except httpx.TransportError as e:
+                if attempt == self.max_retries:
+                    raise
+                reason, delay = type(e).__name__, self._backoff(attempt)
+            else:
+                self.limiter.observe(model, response.headers)
+                if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                    return response
+                response.read()
+                response.close()
+                if response.status_code == 429 and b'insufficient_quota' in response.content:
+                    # Retrying does not help when the quota is used up
+                    return response
+                requested = retry_after(response.headers)
+                # Jitter keeps the waiting calls from retrying all at the same moment
+                delay = min(OPENAI_BACKOFF_MAX, requested * random.uniform(1, 1.2)) if requested is not None else self._backoff(attempt)
+                reason = str(response.status_code)
+                if response.status_code == 429:
+                    OPENAI_THROTTLED.labels(model, 'server').inc()
+                    self.limiter.block(model, delay)
+            OPENAI_RETRIES.labels(model, reason).inc()
+            logger.info(f"Retrying {model} request in {delay:.1f}s after {reason} (attempt {attempt + 1}/{self.max_retries})")
+            time.sleep(delay)
+            request.stream = httpx.ByteStream(request.content)
+
+
+# Shared by every OpenAI client of the process, its transport keeps the limits of all of them
+http_client = DefaultHttpxClient(transport=GatewayTransport())
+
+client = OpenAI(
     organization=OPEN_AI_ORGANIZATION_ID,
     project=OPEN_AI_PROJECT_ID,
-    api_key=OPEN_AI_API_KEY
+    api_key=OPEN_AI_API_KEY,
+    base_url=OPEN_AI_BASE_URL,
+    http_client=http_client,
+    max_retries=0
 )
 
 def prompt_chatgpt(messages, model='gpt-3.5-turbo'):
-    return client.chat.completions.create(
-      model=model,
-      messages=messages
-    )
-
-def prompt_dalle(prompt):
-    url = client.images.generate(
-      model="dall-e-3",
-      prompt=prompt,
-      size="1024x1024",
-      quality="standard",
-      n=1,
-    ).data[0].url
-    print(f"Generated Image: {url}")
-    return url
\ No newline at end of file
+    with time_stage('llm_call'):
+        response = client.chat.completions.create(
+          model=model,
+          messages=messages
+        )
+    return response
+
+def generate_image(prompt):
+    # Returns the PNG bytes of the generated image, saves downloading it again from a DALL-E URL
+    with time_stage('dalle'):
+        b64_image = client.images.generate(
+          model="dall-e-3",
+          prompt=prompt,
+          size="1024x1024",
+          quality="standard",
+          response_format="b64_json",
+          n=1,
+        ).data[0].b64_json
+    return base64.b64decode(b64_image)
@@ -0,0 +1,104 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_STAGES = ['transcribe', 'embed', 'index', 'topic_model', 'posts']
+REPROCESS_STAGES = ['load', 'embed', 'index', 'topic_model', 'posts']
+
+
+def analyze_audio(job, audio_file="", audio_extension="", audio_url="", content_hash=None):
+    """
+    Job function for /analyze-audio and /analyze-url: transcribes the audio and generates posts from its topics.
+
+    Args:
+        job (jobs.JobContext): Handle used to report stage progress.
+        audio_file (str or file): Path or binary file object of the uploaded audio, empty when `audio_url` is given.
+        audio_extension (str): Extension of the uploaded audio file.
+        audio_url (str): Public URL of the audio file.
+        content_hash (str): sha256 of the uploaded audio, used to find an earlier transcript of the same file.
+
+    Returns:
+        dict: Dictionary containing the generated posts and the id of the stored transcript.
+    """
+    # Imported here so the service starts without loading langchain and bertopic
+    from transcribe import transcribe, index_transcript
+    from indexer import embed_texts, window_utterances
+    from topic_model import TopicModel
+    from transcript_store import get_transcript_store
+
+    store = get_transcript_store()
+    with job.stage('transcribe'):
+        key = None
+        if store is not None:
+            key = store.upload_key(content_hash) if content_hash else store.url_key(audio_url) if audio_url else None
+        # A transcript found in the store was indexed when it was stored
+        transcript_id, data = store.get(key) if key else (None, None)
+        cached = data is not None
+        if cached:
+            logger.info(f"Reusing the stored transcript {key}")
+        else:
+            data = transcribe(audio_file, audio_extension, audio_url, index=False)
+            if data is None:
+                raise RuntimeError("Transcription failed")
+
+    # Utterances for the topic model and utterance windows for the vector store are embedded in one batch
+    with job.stage('embed'):
+        windows = [] if cached else window_utterances(data)
+        embeddings = embed_texts(data['text'].tolist() + [window.page_content for window in windows])
+        utterance_embeddings, window_embeddings = embeddings[:len(data)], embeddings[len(data):]
+
+    with job.stage('index'):
+        if not cached:
+            index_transcript(windows, window_embeddings)
+            if store is not None:
+                transcript_id = store.put(data, key=key, source=audio_url or None)
+
+    with job.stage('topic_model'):
+        topic_model = TopicModel(data['text'].values, embeddings=utterance_embeddings)
+
+    with job.stage('posts'):
+        posts = topic_model.get_posts()
+
+    return {"posts": posts, "transcript_id": transcript_id}
+
+
+def reprocess_transcript(job, transcript_id, index=False):
+    """
+    Job function for /transcripts/<id>/reprocess: generates posts again from a stored transcript.
+
+    Args:
+        job (jobs.JobContext): Handle used to report stage progress.
+        transcript_id (str): Id of the transcript in the transcript store.
+        index (bool): Also add the utterance windows to the vector store again, e.g. after the
+            collection was recreated or the window settings changed.
+
+    Returns:
+        dict: Dictionary containing the generated posts and the id of the transcript.
+    """
+    from transcribe import index_transcript
+    from indexer import embed_texts, window_utterances
+    from topic_model import TopicModel
+    from transcript_store import get_transcript_store
+
+    store = get_transcript_store()
+    with job.stage('load'):
+        data = store.load(transcript_id) if store is not None else None
+        if data is None:
+            raise ValueError(f"Transcript {transcript_id} not found")
+
+    with job.stage('embed'):
+        windows = window_utterances(data) if index else []
+        embeddings = embed_texts(data['text'].tolist() + [window.page_content for window in windows])
+        utterance_embeddings, window_embeddings = embeddings[:len(data)], embeddings[len(data):]
+
+    with job.stage('index'):
+        if index:
+            index_transcript(windows, window_embeddings)
+
+    with job.stage('topic_model'):
+        topic_model = TopicModel(data['text'].values, embeddings=utterance_embeddings)
+
+    with job.stage('posts'):
+        posts = topic_model.get_posts()
+
+    return {"posts": posts, "transcript_id": transcript_id}
@@ -1,18 +1,25 @@
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_openai import ChatOpenAI
-from indexer import get_vectorstore_raw, add_data
+from indexer import get_vectorstore, get_collection_version
+from context_builder import ContextBuilder
+from ann_index import get_ann_index
+from vector_snapshot import get_snapshot
+from answer_cache import AnswerCache
+from metrics import time_stage
+from openai_client import http_client
+import functools
 import os
+import threading
 
 OPEN_AI_API_KEY = os.getenv('OPEN_AI_API_KEY')
+OPEN_AI_BASE_URL = os.getenv('OPEN_AI_BASE_URL')
 PGVECTOR_COLLECTION = os.getenv('PGVECTOR_COLLECTION') 
 CONNECTION_STRING = os.getenv('DATABASE_URL')
-
-vectorstore = get_vectorstore_raw(CONNECTION_STRING, PGVECTOR_COLLECTION)
-retriever = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 500})
-
-llm = ChatOpenAI(model_name="gpt-4o", openai_api_key=OPEN_AI_API_KEY)
+RAG_MODEL = "gpt-4o"
+# 'pgvector' searches Postgres, 'snapshot' a memory-mapped local copy of the collection
+RAG_RETRIEVAL_BACKEND = os.getenv('RAG_RETRIEVAL_BACKEND', 'pgvector')
 
 template = """You are representing InsightsOut, a platform for intellectuals to engage in meaningful discourse about art and museums. InsightsOut is an online platform where individuals come together to discuss topics that impact their daily and professional lives through social media like posts and comments. As an intelligent and unbiased representative from InsightsOut, your task is to answer the following question based on the information available in the provided discussions. The discussions represents the comments by users on a given topic.
 
@@ -35,17 +42,94 @@ Answer:
 
 prompt = ChatPromptTemplate.from_template(template)
 
-def format_docs(docs):
-    docs = "\n\n".join(doc.page_content for doc in docs)
-    print(len(docs))
-    return docs
+# The vector store, caches and chain are created on first use, not at import time
+_context_builder = None
+_answer_cache = None
+_rag_chain = None
+_init_lock = threading.Lock()
+
+def _init():
+    global _context_builder, _answer_cache, _rag_chain
+    with _init_lock:
+        if _rag_chain is None:
+            vectorstore = get_vectorstore(CONNECTION_STRING, PGVECTOR_COLLECTION)
+            # Both searches return the stored embeddings, the candidates are not embedded again
+            if RAG_RETRIEVAL_BACKEND == 'snapshot':
+                snapshot = get_snapshot(CONNECTION_STRING, PGVECTOR_COLLECTION)
+                snapshot.refresh()
+                snapshot.start_refresh()
+                search_fn = functools.partial(snapshot.search, with_embeddings=True)
+            else:
+                # With an ANN index the search has to use the indexed expression, see ann_index.py
+                search_fn = functools.partial(get_ann_index(CONNECTION_STRING, PGVECTOR_COLLECTION).search, with_embeddings=True)
+            # Over-fetches candidates, drops near-duplicates and packs them up to RAG_CONTEXT_TOKENS
+            _context_builder = ContextBuilder(vectorstore, vectorstore.embeddings, search_fn=search_fn)
+            # Answers are reused for equal or very similar questions until the collection changes
+            _answer_cache = AnswerCache(vectorstore.embeddings.embed_query,
+                                        lambda: get_collection_version(CONNECTION_STRING, PGVECTOR_COLLECTION))
+            llm = ChatOpenAI(model_name=RAG_MODEL, openai_api_key=OPEN_AI_API_KEY, openai_api_base=OPEN_AI_BASE_URL,
+                             http_client=http_client, max_retries=0)
+            _rag_chain = build_rag_chain(llm)
+
+def get_context_builder():
+    if _context_builder is None:
+        _init()
+    return _context_builder
+
+def get_answer_cache():
+    if _answer_cache is None:
+        _init()
+    return _answer_cache
 
-rag_chain = (
-    {"context": retriever | format_docs, "question": RunnablePassthrough()}
-    | prompt
-    | llm
-    | StrOutputParser()
-)
+def get_rag_chain():
+    if _rag_chain is None:
+        _init()
+    return _rag_chain
+
+def build_context(question):
+    with time_stage('rag_context'):
+        context, _ = get_context_builder().build(question)
+    return context
+
+def build_rag_chain(llm, context_fn=build_context):
+    # The LLM and the context function can be replaced, e.g. by a fake streaming chat model
+    return (
+        {"context": RunnableLambda(context_fn), "question": RunnablePassthrough()}
+        | prompt
+        | llm
+        | StrOutputParser()
+    )
 
 def answer_query(question):
-    return rag_chain.invoke(question)
+    answer_cache = get_answer_cache()
+    answer = answer_cache.get(question)
+    if answer is not None:
+        return answer
+    version = answer_cache.current_version()
+    # The calls and tokens are counted by the gateway in openai_client
+    with time_stage('rag_answer'):
+        answer = get_rag_chain().invoke(question)
+    answer_cache.put(question, answer, version)
+    return answer
+
+def stream_answer(question, chain=None):
+    """
+    Yields the answer in chunks as the LLM produces them, a cached answer is yielded at once.
+    """
+    if chain is not None:
+        yield from chain.stream(question)
+        return
+
+    answer_cache = get_answer_cache()
+    answer = answer_cache.get(question)
+    if answer is not None:
+        yield answer
+        return
+    version = answer_cache.current_version()
+    chunks = []
+    # Streamed responses carry no token usage, the gateway only counts the call
+    with time_stage('rag_answer'):
+        for chunk in get_rag_chain().stream(question):
+            chunks.append(chunk)
+            yield chunk
+    answer_cache.put(question, "".join(chunks), version)
@@ -0,0 +1,283 @@
+"""
+Transcription of long recordings as overlapping segments transcribed concurrently.
+
+The recording is cut at silences found by ffmpeg's silencedetect filter near every
+SEGMENT_LENGTH seconds. Each segment is extended by SEGMENT_OVERLAP seconds on both sides,
+transcribed as its own Gladia job, and the utterances are stitched back together:
+
+- `start` and `end` are shifted by the offset of the segment.
+- Each segment keeps only the utterances whose midpoint lies between its cut points, which
+  drops the duplicates from the overlaps.
+- Gladia numbers the speakers of every job from 0, so the speakers of a segment are matched
+  to those of the previous segment by how long they talk at the same time in the shared
+  overlap. A speaker who does not talk in an overlap gets a new label, a longer SEGMENT_OVERLAP
+  gives fewer of those.
+"""
+import contextlib
+import functools
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from gladia_client import get_client
+from metrics import time_stage
+
+SEGMENTED_TRANSCRIPTION_ENABLED = os.getenv('SEGMENTED_TRANSCRIPTION_ENABLED', 'false').lower() == 'true'
+# Recordings shorter than this many seconds are transcribed as one job
+SEGMENT_MIN_DURATION = float(os.getenv('SEGMENT_MIN_DURATION', '1800'))
+# Lowest bitrate expected of a recording, 1000 is 8 kbit/s. Files smaller than SEGMENT_MIN_DURATION
+# seconds at this rate are transcribed as one job without probing their duration
+SEGMENT_MIN_BYTES_PER_SECOND = float(os.getenv('SEGMENT_MIN_BYTES_PER_SECOND', '1000'))
+SEGMENT_LENGTH = float(os.getenv('SEGMENT_LENGTH', '600'))
+SEGMENT_OVERLAP = float(os.getenv('SEGMENT_OVERLAP', '30'))
+SEGMENT_WORKERS = int(os.getenv('SEGMENT_WORKERS', '4'))
+# Cut points are searched in silences within this many seconds of every SEGMENT_LENGTH boundary
+SEGMENT_SEARCH_WINDOW = float(os.getenv('SEGMENT_SEARCH_WINDOW', '60'))
+SEGMENT_SILENCE_DB = float(os.getenv('SEGMENT_SILENCE_DB', '-35'))
+SEGMENT_SILENCE_MIN = float(os.getenv('SEGMENT_SILENCE_MIN', '0.5'))
+FFMPEG = os.getenv('FFMPEG_PATH', 'ffmpeg')
+FFPROBE = os.getenv('FFPROBE_PATH', 'ffprobe')
+
+SILENCE_PATTERN = re.compile(r'silence_(start|end): (-?[\d.]+)')
+
+logger = logging.getLogger(__name__)
+
+# start and end are the extracted range, own_start and own_end the cut points of the segment
+Segment = namedtuple('Segment', ['index', 'start', 'end', 'own_start', 'own_end'])
+
+
+def probe_duration(source):
+    """
+    Returns the duration of an audio file or URL in seconds, None if ffprobe cannot read it.
+    """
+    try:
+        result = subprocess.run(
+            [FFPROBE, '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', source],
+            capture_output=True, text=True, timeout=120, check=True
+        )
+        return float(result.stdout.strip())
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        logger.info(f"Could not probe the duration of {source}: {e}")
+        return None
+
+
+def detect_silences(source, noise_db=SEGMENT_SILENCE_DB, min_silence=SEGMENT_SILENCE_MIN):
+    """
+    Returns the (start, end) pairs of the silences of an audio file or URL.
+    """
+    result = subprocess.run(
+        [FFMPEG, '-hide_banner', '-nostats', '-i', source, '-vn',
+         '-af', f'silencedetect=noise={noise_db}dB:d={min_silence}', '-f', 'null', '-'],
+        capture_output=True, text=True, check=True
+    )
+    silences, start = [], None
+    for kind, value in SILENCE_PATTERN.findall(result.stderr):
+        if kind == 'start':
+            start = max(0.0, float(value))
+        elif start is not None:
+            silences.append((start, float(value)))
+            start = None
+    return silences
+
+
+def plan_segments(duration, silences, segment_length=SEGMENT_LENGTH, overlap=SEGMENT_OVERLAP, search_window=SEGMENT_SEARCH_WINDOW):
+    """
+    Splits `duration` seconds into segments of about `segment_length` seconds.
+
+    Every cut is placed in the middle of the silence closest to the planned boundary, or at the
+    boundary itself if there is no silence within `search_window` seconds.
+    """
+    midpoints = sorted((start + end) / 2 for start, end in silences)
+    cuts = [0.0]
+    # The last segment may be up to a quarter longer instead of leaving a short remainder
+    while duration - cuts[-1] > segment_length * 1.25:
+        target = cuts[-1] + segment_length
+        candidates = [point for point in midpoints if abs(point - target) <= search_window and point > cuts[-1] + 2 * overlap]
+        cuts.append(min(candidates, key=lambda point: abs(point - target)) if candidates else target)
+    cuts.append(duration)
+    return [
+        Segment(i, max(0.0, own_start - overlap), min(duration, own_end + overlap), own_start, own_end)
+        for i, (own_start, own_end) in enumerate(zip(cuts, cuts[1:]))
+    ]
+
+
+def extract_segment(source, segment, directory):
+    """
+    Writes the range of `segment` as mono 16 kHz FLAC and returns its path.
+    """
+    path = os.path.join(directory, f"segment_{segment.index:04d}.flac")
+    subprocess.run(
+        [FFMPEG, '-v', 'error', '-y', '-ss', f"{segment.start:.3f}", '-i', source, '-t', f"{segment.end - segment.start:.3f}",
+         '-vn', '-ac', '1', '-ar', '16000', '-c:a', 'flac', path],
+        capture_output=True, check=True
+    )
+    return path
+
+
+def gladia_transcribe_segment(source, segment, upload_slots=None):
+    """
+    Extracts `segment` from `source`, transcribes it with Gladia and returns its utterances.
+
+    Args:
+        upload_slots (threading.Semaphore): Held while the segment is uploaded, e.g. to share the
+            upload limit of a batch run.
+    """
+    directory = tempfile.mkdtemp(prefix='segment_')
+    try:
+        with time_stage('segment_extract'):
+            path = extract_segment(source, segment, directory)
+        client = get_client()
+        with upload_slots or contextlib.nullcontext(), open(path, 'rb') as audio:
+            audio_url = client.upload(audio, os.path.basename(path), 'audio/flac', os.fstat(audio.fileno()).st_size)
+        transcription = client.transcribe_url(audio_url)
+        return transcription['result']['transcription']['utterances']
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _shift(utterance, offset):
+    shifted = dict(utterance, start=utterance['start'] + offset, end=utterance['end'] + offset)
+    if 'words' in utterance:
+        shifted['words'] = [dict(word, start=word['start'] + offset, end=word['end'] + offset) for word in utterance['words']]
+    return shifted
+
+
+def _match_speakers(previous, current, speaker_map, start, end):
+    """
+    Maps the local speakers of `current` to the global speakers of `previous`, by the time both
+    talk at the same moment within the overlap [start, end].
+    """
+    shared = defaultdict(float)
+    for before in previous:
+        for after in current:
+            overlap = min(before['end'], after['end'], end) - max(before['start'], after['start'], start)
+            if overlap > 0:
+                shared[(before['speaker'], after['speaker'])] += overlap
+    matched_global, matched_local = set(), set()
+    for (global_speaker, local_speaker), _ in sorted(shared.items(), key=lambda item: -item[1]):
+        if global_speaker in matched_global or local_speaker in matched_local:
+            continue
+        speaker_map[local_speaker] = global_speaker
+        matched_global.add(global_speaker)
+        matched_local.add(local_speaker)
+
+
+def stitch(segments, segment_utterances):
+    """
+    Joins the utterances of the segments into the utterances of the whole recording.
+
+    Args:
+        segments (list): Segments as returned by `plan_segments`.
+        segment_utterances (list): Utterances of each segment, with times relative to the segment start.
+
+    Returns:
+        list: Utterances ordered by start with absolute times and speakers numbered across segments.
+    """
+    stitched = []
+    previous, previous_segment = [], None
+    next_speaker = 0
+    for segment, utterances in zip(segments, segment_utterances):
+        shifted = [_shift(utterance, segment.start) for utterance in utterances]
+        speaker_map = {}
+        if previous:
+            _match_speakers(previous, shifted, speaker_map, segment.start, min(previous_segment.end, segment.end))
+        # Speakers without a counterpart in the overlap are new speakers
+        for speaker in sorted({utterance['speaker'] for utterance in shifted}, key=str):
+            if speaker not in speaker_map:
+                speaker_map[speaker] = next_speaker
+                next_speaker += 1
+        shifted = [dict(utterance, speaker=speaker_map[utterance['speaker']]) for utterance in shifted]
+
+        last = segment.index == len(segments) - 1
+        for utterance in shifted:
+            midpoint = (utterance['start'] + utterance['end']) / 2
+            if segment.own_start <= midpoint and (midpoint < segment.own_end or last):
+                stitched.append(utterance)
+        previous, previous_segment = shifted, segment
+    return sorted(stitched, key=lambda utterance: utterance['start'])
+
+
+class SegmentedTranscriber():
+    """
+    Transcribes a long recording as segments on a thread pool.
+
+    Attributes:
+        transcribe_segment (callable): Called with the source and a Segment, returns the utterances of
+            the segment with times relative to its start. Transcribes with Gladia by default.
+        max_workers (int): Number of segments transcribed at the same time.
+    """
+
+    def __init__(self, transcribe_segment=gladia_transcribe_segment, max_workers=SEGMENT_WORKERS, segment_length=SEGMENT_LENGTH,
+                 overlap=SEGMENT_OVERLAP, min_duration=SEGMENT_MIN_DURATION) -> None:
+        self.transcribe_segment = transcribe_segment
+        self.max_workers = max_workers
+        self.segment_length = segment_length
+        self.overlap = overlap
+        self.min_duration = min_duration
+
+    def plan(self, source):
+        """
+        Returns the segments of `source`, None if it is too short or cannot be read by ffmpeg.
+        """
+        duration = probe_duration(source)
+        if duration is None or duration < self.min_duration:
+            return None
+        with time_stage('silence_detection'):
+            silences = detect_silences(source)
+        return plan_segments(duration, silences, self.segment_length, self.overlap)
+
+    def transcribe(self, source, segments):
+        """
+        Transcribes the segments concurrently and returns the stitched result in the shape of a
+        Gladia transcription, so it can be passed to `transcribe.generate_csv`.
+
+        Raises:
+            Exception: The first error of a segment, a transcript with a gap is not returned.
+        """
+        logger.info(f"Transcribing {len(segments)} segments with {self.max_workers} workers")
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(segments)))) as executor:
+            futures = [executor.submit(self.transcribe_segment, source, segment) for segment in segments]
+            segment_utterances = [future.result() for future in futures]
+        with time_stage('segment_stitch'):
+            utterances = stitch(segments, segment_utterances)
+        return {"result": {"transcription": {"utterances": utterances}}}
+
+
+def transcribe_segmented(audio_file, audio_extension, audio_url="", upload_slots=None):
+    """
+    Transcribes a long recording segment by segment, every segment upload holds one of `upload_slots`.
+
+    Returns:
+        dict: Transcription in the shape of a Gladia result, None if the recording is shorter than
+        SEGMENT_MIN_DURATION or cannot be read, in which case it is transcribed as one job.
+    """
+    transcriber = SegmentedTranscriber(functools.partial(gladia_transcribe_segment, upload_slots=upload_slots))
+    min_bytes = transcriber.min_duration * SEGMENT_MIN_BYTES_PER_SECOND
+    if audio_url:
+        # ffmpeg reads the ranges of each segment from the URL itself
+        segments = transcriber.plan(audio_url)
+        return transcriber.transcribe(audio_url, segments) if segments else None
+    if isinstance(audio_file, (str, os.PathLike)):
+        if os.path.getsize(audio_file) < min_bytes:
+            return None
+        segments = transcriber.plan(os.fspath(audio_file))
+        return transcriber.transcribe(os.fspath(audio_file), segments) if segments else None
+
+    size = audio_file.seek(0, os.SEEK_END)
+    audio_file.seek(0)
+    if size < min_bytes:
+        # Most uploads are too short to be segmented, they are not copied just to probe them
+        return None
+    # ffmpeg needs a path, uploads only exist as a file object
+    with tempfile.NamedTemporaryFile(suffix=f".{audio_extension}") as copy:
+        audio_file.seek(0)
+        shutil.copyfileobj(audio_file, copy)
+        copy.flush()
+        audio_file.seek(0)
+        segments = transcriber.plan(copy.name)
+        return transcriber.transcribe(copy.name, segments) if segments else None
@@ -0,0 +1,107 @@
+import numpy as np
+
+from ann_index import AnnIndex
+from context_builder import ContextBuilder
+
+
+class FakeResult():
+
+    def __init__(self, rows) -> None:
+        self.rows = rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def scalar(self):
+        return self.rows[0][0] if self.rows else None
+
+
+class FakeEngine():
+    """
+    Answers the queries of AnnIndex from `collections` (name -> id) and `embeddings` (id -> [(text, vector)]).
+    """
+
+    def __init__(self) -> None:
+        self.collections = {}
+        self.embeddings = {}
+
+    def connect(self):
+        return self
+
+    def begin(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, statement, params=None):
+        sql = str(statement)
+        if 'FROM langchain_pg_collection' in sql:
+            collection_id = self.collections.get(params['name'])
+            return FakeResult([(collection_id,)] if collection_id else [])
+        if 'vector_dims' in sql:
+            rows = self.embeddings.get(params['id'], [])
+            return FakeResult([(len(rows[0][1]),)] if rows else [])
+        if 'ORDER BY' in sql:
+            rows = self.embeddings.get(params['collection_id'], [])[:params['k']]
+            return FakeResult([(f"id-{i}", content, {}, 0.1, vector) for i, (content, vector) in enumerate(rows)])
+        return FakeResult([])
+
+
+class FakeEmbeddings():
+
+    def embed_query(self, text):
+        return [1.0, 0.0]
+
+
+class WordTokenizer():
+
+    def encode(self, text):
+        return text.split()
+
+
+def context_builder(index):
+    return ContextBuilder(None, FakeEmbeddings(), tokenizer=WordTokenizer(),
+                          search_fn=lambda vector, k: index.search(vector, k=k, with_embeddings=True))
+
+
+def test_missing_collection_gives_an_empty_context():
+    index = AnnIndex(FakeEngine(), 'podcasts')
+
+    assert index.search([1.0, 0.0]) == []
+    assert context_builder(index).build("What was said?")[0] == ''
+
+
+def test_empty_collection_gives_an_empty_context():
+    engine = FakeEngine()
+    engine.collections['podcasts'] = 'uuid-1'
+    index = AnnIndex(engine, 'podcasts')
+
+    context, stats = context_builder(index).build("What was said?")
+
+    assert context == ''
+    assert stats.candidates == 0
+
+
+def test_recreated_collection_is_searched_by_its_new_id():
+    engine = FakeEngine()
+    engine.collections['podcasts'] = 'uuid-1'
+    engine.embeddings['uuid-1'] = [("old comment", [1.0, 0.0])]
+    index = AnnIndex(engine, 'podcasts')
+    assert [doc.page_content for doc, _ in index.search([1.0, 0.0])] == ["old comment"]
+
+    # A reindex drops the collection and creates it again with a new id and other dimensions
+    engine.collections['podcasts'] = 'uuid-2'
+    engine.embeddings = {'uuid-2': [("new comment", [0.0, 1.0, 0.0])]}
+
+    results = index.search([1.0, 0.0, 0.0], with_embeddings=True)
+
+    assert [doc.page_content for doc, _, _ in results] == ["new comment"]
+    assert index.dimensions() == 3
+    assert np.allclose(results[0][2], [0.0, 1.0, 0.0])
@@ -0,0 +1,142 @@
+import threading
+import time
+
+import pytest
+
+import gladia_client
+from gladia_client import GladiaClient, TranscriptionError, TranscriptionTimeout
+
+
+class FakeResponse():
+
+    def __init__(self, status_code, data=None, headers=None) -> None:
+        self.status_code = status_code
+        self.data = data or {}
+        self.headers = headers or {}
+        self.text = str(self.data)
+
+    def json(self):
+        return self.data
+
+
+class FakeSession():
+    """
+    Returns the queued responses in order, the last one is repeated.
+    """
+
+    def __init__(self, responses, on_request=None) -> None:
+        self.responses = list(responses)
+        self.requests = []
+        self.on_request = on_request
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        if self.on_request:
+            self.on_request(len(self.requests))
+        return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+
+class FakeClock():
+    """
+    Replaces the time module of gladia_client, sleeping only advances the clock.
+    """
+
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return 1_700_000_000 + self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(gladia_client, 'time', clock)
+    return clock
+
+
+def client_with(*responses, on_request=None):
+    client = GladiaClient(api_key='test', base_url='https://gladia.test/v2')
+    client.session = FakeSession(responses, on_request)
+    return client
+
+
+def test_rate_limits_and_server_errors_are_retried(clock):
+    done = {"status": "done", "result": {"transcription": {"utterances": []}}}
+    client = client_with(FakeResponse(429, headers={'Retry-After': '7'}), FakeResponse(503),
+                         FakeResponse(200, {"status": "queued"}), FakeResponse(200, done))
+
+    assert client.wait_for_transcription('https://gladia.test/v2/transcription/1') == done
+
+    assert len(client.session.requests) == 4
+    # Retry-After is honored, the other waits back off exponentially with jitter
+    assert clock.sleeps[0] == 7
+    initial = gladia_client.GLADIA_POLL_INITIAL_DELAY
+    assert initial <= clock.sleeps[1] <= 2 * initial
+    assert 2 * initial <= clock.sleeps[2] <= 4 * initial
+
+
+def test_retry_after_as_http_date(clock):
+    client = client_with(FakeResponse(429, headers={'Retry-After': 'Tue, 14 Nov 2023 22:13:40 GMT'}),
+                         FakeResponse(200, {"status": "done"}))
+
+    client.wait_for_transcription('https://gladia.test/v2/transcription/1')
+
+    # 1_700_000_000 is 22:13:20
+    assert clock.sleeps == [pytest.approx(20)]
+
+
+def test_lasting_rate_limit_times_out(clock):
+    client = client_with(FakeResponse(429, headers={'Retry-After': '30'}))
+
+    with pytest.raises(TranscriptionTimeout):
+        client.wait_for_transcription('https://gladia.test/v2/transcription/1', timeout=100)
+
+    assert clock.now == 100
+    assert len(client.session.requests) == 5
+
+
+@pytest.mark.parametrize('response', [
+    FakeResponse(401, {"message": "Invalid key"}),
+    FakeResponse(200, {"status": "error", "error_code": 422}),
+])
+def test_rejected_request_and_failed_transcription_are_not_retried(clock, response):
+    client = client_with(response)
+
+    with pytest.raises(TranscriptionError) as error:
+        client.wait_for_transcription('https://gladia.test/v2/transcription/1')
+
+    assert not isinstance(error.value, TranscriptionTimeout)
+    assert len(client.session.requests) == 1
+    assert clock.sleeps == []
+
+
+def test_callback_wakes_up_the_waiting_job(monkeypatch):
+    monkeypatch.setattr(gladia_client, 'GLADIA_CALLBACK_URL', 'https://app.test/gladia-callback')
+    monkeypatch.setattr(gladia_client, 'GLADIA_CALLBACK_FALLBACK_POLL', 30)
+
+    def callback_after_first_poll(requests):
+        if requests == 2:
+            threading.Timer(0.05, gladia_client.handle_callback,
+                            [gladia_client.GLADIA_CALLBACK_SECRET, {"id": "transcription-1"}]).start()
+
+    client = client_with(FakeResponse(200, {"id": "transcription-1", "result_url": "https://gladia.test/v2/transcription/1"}),
+                         FakeResponse(200, {"status": "processing"}), FakeResponse(200, {"status": "done"}),
+                         on_request=callback_after_first_poll)
+
+    started = time.monotonic()
+    assert client.transcribe_url('https://gladia.test/audio/1')["status"] == "done"
+
+    # Woken up by the callback, long before the fallback poll
+    assert time.monotonic() - started < 5
+    assert [method for method, _ in client.session.requests] == ['POST', 'GET', 'GET']
+    assert "transcription-1" not in gladia_client._callback_events
+    assert not gladia_client.handle_callback('wrong-token', {"id": "transcription-1"})
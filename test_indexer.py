@@ -0,0 +1,147 @@
+import threading
+
+import pandas as pd
+import pytest
+
+import indexer
+from indexer import VectorBatcher, CHUNK_SIZE, UNKNOWN_SPEAKER
+
+
+class FakeVectorStore():
+    """
+    Records the add_documents calls and returns sequential ids.
+    """
+
+    def __init__(self, fail=False) -> None:
+        self.calls = []
+        self.fail = fail
+        self.release = threading.Event()
+        self.release.set()
+        self._lock = threading.Lock()
+
+    def add_documents(self, docs):
+        self.release.wait(5)
+        if self.fail:
+            raise RuntimeError("Database unavailable")
+        with self._lock:
+            start = sum(len(call) for call in self.calls)
+            self.calls.append(list(docs))
+        return [f"id-{start + i}" for i in range(len(docs))]
+
+
+@pytest.fixture
+def vectorstore(monkeypatch):
+    store = FakeVectorStore()
+    versions = []
+    monkeypatch.setattr(indexer, 'get_vectorstore', lambda connection_string, collection_name: store)
+    monkeypatch.setattr(indexer, 'bump_collection_version', lambda connection_string, collection_name: versions.append(collection_name))
+    store.versions = versions
+    return store
+
+
+def test_concurrent_adds_are_written_as_one_batch(vectorstore):
+    batcher = VectorBatcher('postgresql://test', 'test', max_batch_size=10, max_wait=0.2)
+
+    futures = [batcher.submit(f"comment {i}", {"n": i}) for i in range(5)]
+    results = [future.result(timeout=5) for future in futures]
+
+    assert len(vectorstore.calls) == 1
+    assert [doc.page_content for doc in vectorstore.calls[0]] == [f"comment {i}" for i in range(5)]
+    assert results == [[f"id-{i}"] for i in range(5)]
+    # The batch index used to map chunks back is not stored
+    assert [doc.metadata for doc in vectorstore.calls[0]] == [{"n": i, "start_index": 0} for i in range(5)]
+    assert vectorstore.versions == ['test']
+
+
+def test_batch_is_flushed_at_max_batch_size(vectorstore):
+    vectorstore.release.clear()
+    batcher = VectorBatcher('postgresql://test', 'test', max_batch_size=3, max_wait=5)
+
+    futures = [batcher.submit(f"comment {i}") for i in range(6)]
+    vectorstore.release.set()
+    for future in futures:
+        future.result(timeout=2)
+
+    # Far below max_wait, so only the size limit can have closed the batches
+    assert [len(call) for call in vectorstore.calls] == [3, 3]
+
+
+def test_batch_is_flushed_after_max_wait(vectorstore):
+    batcher = VectorBatcher('postgresql://test', 'test', max_batch_size=100, max_wait=0.05)
+
+    assert batcher.submit("first").result(timeout=5) == ['id-0']
+    assert batcher.submit("second").result(timeout=5) == ['id-1']
+    assert len(vectorstore.calls) == 2
+
+
+def test_long_document_gets_the_ids_of_all_its_chunks(vectorstore):
+    batcher = VectorBatcher('postgresql://test', 'test', max_batch_size=10, max_wait=0.2)
+    long_text = ' '.join(['word'] * CHUNK_SIZE)
+
+    short, long = batcher.submit("short"), batcher.submit(long_text)
+
+    assert short.result(timeout=5) == ['id-0']
+    long_ids = long.result(timeout=5)
+    assert len(long_ids) > 1
+    assert long_ids == [f"id-{i}" for i in range(1, 1 + len(long_ids))]
+
+
+def test_failed_write_fails_every_request_of_the_batch(vectorstore):
+    vectorstore.fail = True
+    batcher = VectorBatcher('postgresql://test', 'test', max_batch_size=10, max_wait=0.2)
+
+    futures = [batcher.submit(f"comment {i}") for i in range(3)]
+
+    for future in futures:
+        with pytest.raises(RuntimeError, match="Database unavailable"):
+            future.result(timeout=5)
+    assert vectorstore.versions == []
+
+    # The batcher keeps running after a failed batch
+    vectorstore.fail = False
+    assert batcher.submit("retry").result(timeout=5) == ['id-0']
+
+
+@pytest.mark.parametrize('content', [{"a": 1}, ["a", "b"], None])
+def test_invalid_document_fails_only_its_own_request(vectorstore, content):
+    batcher = VectorBatcher('postgresql://test', 'test', max_batch_size=10, max_wait=0.2)
+
+    good, bad = batcher.submit("comment"), batcher.submit(content)
+
+    assert good.result(timeout=5) == ['id-0']
+    with pytest.raises(Exception):
+        bad.result(timeout=5)
+    # The batcher thread survives and serves the next request
+    assert batcher.submit("next").result(timeout=5) == ['id-1']
+    assert batcher._thread.is_alive()
+
+
+def test_unexpected_error_does_not_end_the_batcher(vectorstore):
+    batcher = VectorBatcher('postgresql://test', 'test', max_batch_size=10, max_wait=0.05)
+    flush, calls = batcher._flush, []
+
+    def flaky_flush(batch):
+        calls.append(len(batch))
+        if len(calls) == 1:
+            raise ZeroDivisionError("unexpected")
+        flush(batch)
+
+    batcher._flush = flaky_flush
+
+    with pytest.raises(ZeroDivisionError):
+        batcher.submit("comment").result(timeout=5)
+    assert batcher.submit("next").result(timeout=5) == ['id-0']
+
+
+def test_utterances_without_speaker_get_the_unknown_speaker():
+    data = pd.DataFrame({
+        "text": ["Hello", "Who is this?", "It's me"],
+        "speaker": [0, None, ''],
+        "start": [0.0, 2.0, 4.0],
+        "end": [1.5, 3.5, 5.0],
+    })
+
+    windows = indexer.window_utterances(data, by_speaker=True)
+
+    assert [window.page_content for window in windows] == ["Speaker 0: Hello", "Speaker -1: Who is this?\nSpeaker -1: It's me"]
+    assert [window.metadata["speakers"] for window in windows] == [[0], [UNKNOWN_SPEAKER]]
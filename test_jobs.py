@@ -0,0 +1,163 @@
+import socket
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from jobs import JobStore, JobRunner, JobQueueFull, STATUS_QUEUED, STATUS_RUNNING, STATUS_DONE, STATUS_FAILED
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / 'jobs.sqlite3'))
+
+
+def wait_for(store, job_id, status, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = store.get(job_id)
+        if job['status'] == status:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} is {store.get(job_id)['status']}, expected {status}")
+
+
+def test_create_queues_job_with_stages(store):
+    job_id = store.create('analyze-audio', ['upload', 'transcription'])
+
+    job = store.get(job_id)
+    assert job['kind'] == 'analyze-audio'
+    assert job['status'] == STATUS_QUEUED
+    assert [stage['name'] for stage in job['stages']] == ['upload', 'transcription']
+    assert all(stage['status'] == STATUS_QUEUED and stage['started_at'] is None for stage in job['stages'])
+    assert job['result'] is None and job['error'] is None
+
+
+def test_get_unknown_job(store):
+    assert store.get('missing') is None
+
+
+def test_finished_job_has_result_and_stage_times(store):
+    def job_fn(job, value):
+        with job.stage('upload'):
+            pass
+        with job.stage('transcription'):
+            pass
+        return {"value": value}
+
+    runner = JobRunner(store)
+    job_id = runner.submit('analyze-audio', ['upload', 'transcription'], job_fn, 42)
+
+    job = wait_for(store, job_id, STATUS_DONE)
+    assert job['result'] == {"value": 42}
+    for stage in job['stages']:
+        assert stage['status'] == STATUS_DONE
+        assert stage['started_at'] <= stage['finished_at']
+
+
+def test_running_stage_is_reported(store):
+    started, release = threading.Event(), threading.Event()
+
+    def job_fn(job):
+        with job.stage('transcription'):
+            started.set()
+            release.wait(5)
+
+    runner = JobRunner(store)
+    job_id = runner.submit('analyze-url', ['transcription'], job_fn)
+    assert started.wait(5)
+
+    job = store.get(job_id)
+    assert job['status'] == STATUS_RUNNING
+    assert job['stages'][0]['status'] == STATUS_RUNNING
+    release.set()
+    wait_for(store, job_id, STATUS_DONE)
+
+
+def test_failed_stage_fails_job(store):
+    def job_fn(job):
+        with job.stage('upload'):
+            pass
+        with job.stage('transcription'):
+            raise RuntimeError("Transcription failed")
+
+    runner = JobRunner(store)
+    job_id = runner.submit('analyze-audio', ['upload', 'transcription', 'indexing'], job_fn)
+
+    job = wait_for(store, job_id, STATUS_FAILED)
+    assert job['error'] == "Transcription failed"
+    assert [stage['status'] for stage in job['stages']] == [STATUS_DONE, STATUS_FAILED, STATUS_QUEUED]
+
+
+def test_on_done_runs_after_success_and_failure(store):
+    calls = []
+
+    def failing(job):
+        raise ValueError("broken")
+
+    runner = JobRunner(store)
+    ok_id = runner.submit('analyze-audio', [], lambda job: None, on_done=lambda: calls.append('ok'))
+    failed_id = runner.submit('analyze-audio', [], failing, on_done=lambda: calls.append('failed'))
+
+    wait_for(store, ok_id, STATUS_DONE)
+    wait_for(store, failed_id, STATUS_FAILED)
+    deadline = time.monotonic() + 5
+    while len(calls) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(calls) == ['failed', 'ok']
+
+
+def test_queue_limit(store):
+    release = threading.Event()
+    runner = JobRunner(store, max_workers=1, max_pending=2)
+    job_ids = [runner.submit('analyze-audio', [], lambda job: release.wait(5)) for _ in range(2)]
+
+    with pytest.raises(JobQueueFull):
+        runner.submit('analyze-audio', [], lambda job: None)
+
+    release.set()
+    for job_id in job_ids:
+        wait_for(store, job_id, STATUS_DONE)
+    # Finished jobs free their slots
+    wait_for(store, runner.submit('analyze-audio', [], lambda job: None), STATUS_DONE)
+
+
+def test_new_runner_keeps_jobs_of_live_runner(store):
+    release = threading.Event()
+    runner = JobRunner(store)
+    job_id = runner.submit('analyze-audio', [], lambda job: release.wait(5))
+    wait_for(store, job_id, STATUS_RUNNING)
+
+    JobRunner(JobStore(store.path))
+
+    assert store.get(job_id)['status'] == STATUS_RUNNING
+    release.set()
+    wait_for(store, job_id, STATUS_DONE)
+
+
+def test_new_runner_fails_jobs_of_exited_process(store):
+    job_id = store.create('analyze-audio', ['upload'], owner=f"{socket.gethostname()}:999999999:0000")
+    legacy_id = store.create('analyze-audio', ['upload'])
+    other_host_id = store.create('analyze-audio', ['upload'], owner='other-host:1:0000')
+
+    JobRunner(store)
+
+    assert store.get(job_id)['status'] == STATUS_FAILED
+    assert store.get(job_id)['error'] == "Interrupted by a server restart"
+    assert store.get(legacy_id)['status'] == STATUS_FAILED
+    assert store.get(other_host_id)['status'] == STATUS_QUEUED
+
+
+def test_adds_owner_column_to_existing_database(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    with sqlite3.connect(path) as conn:
+        conn.execute("""
+            CREATE TABLE jobs (id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, stages TEXT NOT NULL,
+                               result TEXT, error TEXT, created_at TEXT NOT NULL, updated_at TEXT NOT NULL)
+        """)
+    conn.close()
+
+    store = JobStore(path)
+
+    assert store.get(store.create('analyze-audio', [], owner='host:1:0000'))['status'] == STATUS_QUEUED
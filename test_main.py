@@ -0,0 +1,98 @@
+import itertools
+import json
+from types import SimpleNamespace
+
+import pytest
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+
+import main
+import rag
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+@pytest.mark.parametrize('body', [
+    {"content": {"a": 1}},
+    {"content": ["a", "b"]},
+    {"content": None},
+    {"content": "   "},
+    {},
+    ["content"],
+    {"content": "comment", "metadata": ["a"]},
+])
+def test_add_vector_rejects_invalid_body(client, body):
+    assert client.post('/add-vector', json=body).status_code == 400
+
+
+@pytest.mark.parametrize('documents', [
+    None,
+    [],
+    [{"content": {"a": 1}}],
+    [{"content": None}],
+    ["comment", 1],
+    [{"content": "comment", "metadata": "a"}],
+])
+def test_add_vectors_rejects_invalid_documents(client, documents):
+    assert client.post('/add-vectors', json={"documents": documents}).status_code == 400
+
+
+class FailingChatModel(GenericFakeChatModel):
+    """
+    Streams its first message, then fails like a dropped connection to the model.
+    """
+
+    def _stream(self, *args, **kwargs):
+        yield from itertools.islice(super()._stream(*args, **kwargs), 2)
+        raise RuntimeError("Model unavailable")
+
+
+def parse_events(body):
+    events = []
+    for frame in body.decode().split('\n\n'):
+        if frame:
+            lines = dict(line.split(': ', 1) for line in frame.split('\n'))
+            events.append((lines.get('event'), json.loads(lines['data'])))
+    return events
+
+
+@pytest.fixture
+def stream_with(monkeypatch):
+    questions = []
+
+    def context_fn(question):
+        questions.append(question)
+        return "The host talked about bees."
+
+    def use(llm):
+        chain = rag.build_rag_chain(llm, context_fn=context_fn)
+        fake_rag = SimpleNamespace(stream_answer=lambda question: rag.stream_answer(question, chain=chain))
+        monkeypatch.setattr(main.components, 'get', lambda name: fake_rag)
+        return questions
+
+    return use
+
+
+def test_ask_stream_sends_tokens_then_done(client, stream_with):
+    questions = stream_with(GenericFakeChatModel(messages=iter([AIMessage(content="Bees make honey")])))
+
+    response = client.post('/ask/stream', json={"question": "What about bees?"})
+
+    assert response.mimetype == 'text/event-stream'
+    events = parse_events(response.data)
+    assert [event for event, _ in events] == [None] * 5 + ['done']
+    assert "".join(data["token"] for _, data in events[:-1]) == "Bees make honey"
+    assert events[-1][1]["time_to_first_token"] <= events[-1][1]["total_time"]
+    assert questions == ["What about bees?"]
+
+
+def test_ask_stream_sends_error_event_when_the_model_fails(client, stream_with):
+    stream_with(FailingChatModel(messages=iter([AIMessage(content="Bees make honey")])))
+
+    events = parse_events(client.post('/ask/stream', json={"question": "What about bees?"}).data)
+
+    assert events[:2] == [(None, {"token": "Bees"}), (None, {"token": " "})]
+    assert events[2:] == [('error', {"error": "Model unavailable"})]
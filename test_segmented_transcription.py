@@ -0,0 +1,181 @@
+import functools
+import io
+import os
+import threading
+import time
+
+import pytest
+
+import segmented_transcription
+from segmented_transcription import Segment, SegmentedTranscriber, plan_segments, stitch, transcribe_segmented
+
+
+def utterance(text, speaker, start, end, **extra):
+    return {"text": text, "speaker": speaker, "start": start, "end": end, **extra}
+
+
+def relative(utterances, segment):
+    # What the transcription of `segment` returns: cut at its edges, times relative to its start
+    result = []
+    for u in utterances:
+        start, end = max(u['start'], segment.start), min(u['end'], segment.end)
+        if end > start:
+            result.append(dict(u, start=start - segment.start, end=end - segment.start))
+    return result
+
+
+def test_plan_without_silences_cuts_at_segment_length():
+    segments = plan_segments(1900, [], segment_length=600, overlap=30)
+
+    assert [(s.own_start, s.own_end) for s in segments] == [(0, 600), (600, 1200), (1200, 1900)]
+    assert [(s.start, s.end) for s in segments] == [(0, 630), (570, 1230), (1170, 1900)]
+    assert [s.index for s in segments] == [0, 1, 2]
+
+
+def test_plan_cuts_in_the_closest_silence():
+    silences = [(540, 542), (610, 614), (1300, 1302)]
+
+    segments = plan_segments(1900, silences, segment_length=600, overlap=30, search_window=60)
+
+    # 612 is closer to 600 than 541, no silence lies within 60 seconds of 1212
+    assert [s.own_end for s in segments] == [612, 1212, 1900]
+
+
+def test_plan_keeps_a_short_remainder_in_the_last_segment():
+    segments = plan_segments(1300, [], segment_length=600, overlap=30)
+
+    assert [(s.own_start, s.own_end) for s in segments] == [(0, 600), (600, 1300)]
+
+
+def test_plan_short_recording_is_one_segment():
+    assert plan_segments(300, [], segment_length=600, overlap=30) == [Segment(0, 0, 300, 0, 300)]
+
+
+def test_stitch_shifts_times_by_segment_start():
+    segments = [Segment(0, 0, 130, 0, 100), Segment(1, 70, 200, 100, 200)]
+    words = [{"word": "hello", "start": 10.0, "end": 10.5}]
+
+    stitched = stitch(segments, [
+        [utterance("a", 0, 10, 20, words=words)],
+        [utterance("b", 0, 40, 50)],
+    ])
+
+    assert [(u['text'], u['start'], u['end']) for u in stitched] == [("a", 10, 20), ("b", 110, 120)]
+    assert stitched[0]['words'] == [{"word": "hello", "start": 10.0, "end": 10.5}]
+
+
+def test_stitch_drops_duplicates_from_the_overlap():
+    recording = [
+        utterance("before the cut", 0, 80, 95),
+        utterance("across the cut", 0, 97, 108),
+        utterance("after the cut", 1, 110, 125),
+    ]
+    segments = [Segment(0, 0, 130, 0, 100), Segment(1, 70, 200, 100, 200)]
+
+    stitched = stitch(segments, [relative(recording, segment) for segment in segments])
+
+    # Each utterance is kept by the segment its midpoint falls in, with its times from that segment
+    assert [(u['text'], u['start'], u['end']) for u in stitched] == [
+        ("before the cut", 80, 95), ("across the cut", 97, 108), ("after the cut", 110, 125)]
+
+
+def test_stitch_matches_speakers_across_segments():
+    recording = [
+        utterance("first", 'A', 10, 60),
+        utterance("second", 'B', 60, 115),
+        utterance("third", 'A', 115, 160),
+        utterance("fourth", 'B', 160, 190),
+    ]
+    segments = [Segment(0, 0, 130, 0, 100), Segment(1, 70, 200, 100, 200)]
+    # Every job numbers its speakers from 0 in order of appearance
+    numbering = [{'A': 0, 'B': 1}, {'B': 0, 'A': 1}]
+    segment_utterances = [[dict(u, speaker=local[u['speaker']]) for u in relative(recording, segment)]
+                          for segment, local in zip(segments, numbering)]
+
+    stitched = stitch(segments, segment_utterances)
+
+    assert [(u['text'], u['speaker']) for u in stitched] == [("first", 0), ("second", 1), ("third", 0), ("fourth", 1)]
+
+
+def test_stitch_gives_new_label_to_speaker_silent_in_the_overlap():
+    segments = [Segment(0, 0, 130, 0, 100), Segment(1, 70, 200, 100, 200)]
+
+    stitched = stitch(segments, [
+        [utterance("first", 0, 10, 50)],
+        [utterance("second", 0, 80, 100)],
+    ])
+
+    assert [u['speaker'] for u in stitched] == [0, 1]
+
+
+def test_transcriber_stitches_segments_in_order():
+    recording = [utterance(f"utterance {i}", i % 2, i * 50.0, i * 50.0 + 40) for i in range(40)]
+    segments = plan_segments(2000, [], segment_length=600, overlap=30)
+
+    transcriber = SegmentedTranscriber(lambda source, segment: relative(recording, segment), max_workers=3)
+    result = transcriber.transcribe('recording.wav', segments)
+
+    utterances = result['result']['transcription']['utterances']
+    assert [(u['text'], u['start'], u['end']) for u in utterances] == [(u['text'], u['start'], u['end']) for u in recording]
+
+
+def test_transcriber_fails_on_a_failed_segment():
+    def transcribe_segment(source, segment):
+        if segment.index == 1:
+            raise RuntimeError("Segment failed")
+        return []
+
+    transcriber = SegmentedTranscriber(transcribe_segment, max_workers=2)
+
+    with pytest.raises(RuntimeError, match="Segment failed"):
+        transcriber.transcribe('recording.wav', plan_segments(2000, [], segment_length=600, overlap=30))
+
+
+def test_small_upload_is_not_probed(monkeypatch):
+    planned = []
+    monkeypatch.setattr(SegmentedTranscriber, 'plan', lambda self, source: planned.append(source))
+
+    assert transcribe_segmented(io.BytesIO(b'\0' * 1000), 'wav') is None
+    assert planned == []
+
+    size = int(segmented_transcription.SEGMENT_MIN_DURATION * segmented_transcription.SEGMENT_MIN_BYTES_PER_SECOND)
+    upload = io.BytesIO(b'\0' * size)
+    assert transcribe_segmented(upload, 'wav') is None
+    assert len(planned) == 1
+    assert upload.tell() == 0
+
+
+def test_segment_uploads_hold_an_upload_slot(monkeypatch):
+    slots = threading.BoundedSemaphore(2)
+    running, peak = 0, 0
+    lock = threading.Lock()
+
+    class FakeClient():
+
+        def upload(self, audio, filename, content_type, size):
+            nonlocal running, peak
+            with lock:
+                running += 1
+                peak = max(peak, running)
+            time.sleep(0.02)
+            with lock:
+                running -= 1
+            return f"https://gladia.test/audio/{filename}"
+
+        def transcribe_url(self, audio_url):
+            return {"result": {"transcription": {"utterances": []}}}
+
+    def extract_segment(source, segment, directory):
+        path = os.path.join(directory, f"segment_{segment.index}.flac")
+        with open(path, 'wb') as file:
+            file.write(b'\0' * 10)
+        return path
+
+    monkeypatch.setattr(segmented_transcription, 'extract_segment', extract_segment)
+    monkeypatch.setattr(segmented_transcription, 'get_client', FakeClient)
+    transcribe_segment = functools.partial(segmented_transcription.gladia_transcribe_segment, upload_slots=slots)
+
+    SegmentedTranscriber(transcribe_segment, max_workers=6).transcribe('recording.wav', plan_segments(3600, [], segment_length=600, overlap=30))
+
+    # Six segments transcribed at once, but only as many uploads as slots
+    assert peak == 2
@@ -0,0 +1,58 @@
+import threading
+import time
+
+from utils import map_concurrently
+
+
+def test_results_keep_the_order_of_the_items():
+    def slow_for_small(n):
+        time.sleep(0.01 * (5 - n))
+        return n * 10
+
+    assert map_concurrently(slow_for_small, range(5), max_workers=5) == [0, 10, 20, 30, 40]
+
+
+def test_empty_items():
+    assert map_concurrently(lambda item: item, [], max_workers=4) == []
+
+
+def test_failed_call_gives_none():
+    def fail_on_two(n):
+        if n == 2:
+            raise ValueError("broken")
+        return n
+
+    assert map_concurrently(fail_on_two, [1, 2, 3], max_workers=2) == [1, None, 3]
+
+
+def test_concurrency_is_limited_to_max_workers():
+    running, peak = 0, 0
+    lock = threading.Lock()
+
+    def track(item):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.02)
+        with lock:
+            running -= 1
+        return item
+
+    assert map_concurrently(track, range(12), max_workers=3) == list(range(12))
+    assert peak == 3
+
+
+def test_calls_run_concurrently():
+    barrier = threading.Barrier(4, timeout=5)
+
+    def wait_for_all(item):
+        # Times out unless all four calls run at the same time
+        barrier.wait()
+        return item
+
+    assert map_concurrently(wait_for_all, range(4), max_workers=4) == [0, 1, 2, 3]
+
+
+def test_zero_workers_still_runs():
+    assert map_concurrently(lambda item: item + 1, [1, 2], max_workers=0) == [2, 3]
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+from vector_snapshot import VectorSnapshot
+
+
+class FakeResult():
+
+    def __init__(self, rows) -> None:
+        self.rows = rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def scalar(self):
+        return self.rows[0][0] if self.rows else None
+
+
+class FakeEngine():
+    """
+    Answers the snapshot queries from `rows` (id -> (document, metadata, embedding)), without a version table.
+    """
+
+    def __init__(self) -> None:
+        self.rows = {}
+        self.fetches = 0
+
+    def connect(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def _hash(self, row_id):
+        document, metadata, _ = self.rows[row_id]
+        return hashlib.md5((document + json.dumps(metadata)).encode()).hexdigest()
+
+    def execute(self, statement, params=None):
+        sql = str(statement)
+        if 'FROM langchain_pg_collection' in sql:
+            return FakeResult([('uuid-1',)])
+        if 'to_regclass' in sql:
+            return FakeResult([(None,)])
+        if 'string_agg' in sql:
+            fingerprint = ','.join(row_id + self._hash(row_id) for row_id in sorted(self.rows))
+            return FakeResult([(hashlib.md5(fingerprint.encode()).hexdigest(),)])
+        if 'embedding::text' in sql:
+            self.fetches += 1
+            return FakeResult([(row_id, self.rows[row_id][0], self.rows[row_id][1], json.dumps(self.rows[row_id][2]).replace(' ', ''))
+                               for row_id in params['ids']])
+        if 'SELECT id, md5' in sql:
+            return FakeResult([(row_id, self._hash(row_id)) for row_id in sorted(self.rows)])
+        raise AssertionError(f"Unexpected query {sql}")
+
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+@pytest.fixture
+def engine():
+    engine = FakeEngine()
+    engine.rows = {f"id-{i}": (f"comment {i}", {"n": i}, [float(i), 1.0]) for i in range(5)}
+    return engine
+
+
+def test_unchanged_collection_without_version_is_not_rebuilt(engine, tmp_path):
+    snapshot = VectorSnapshot(engine, 'test', directory=str(tmp_path))
+
+    snapshot.refresh()
+    for _ in range(3):
+        snapshot.refresh()
+
+    assert snapshot.refreshes == 1
+    assert engine.fetches == 1
+
+    engine.rows['id-5'] = ("comment 5", {"n": 5}, [5.0, 1.0])
+    snapshot.refresh()
+
+    assert snapshot.refreshes == 2
+    assert snapshot.stats()["rows"] == 6
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason="needs /proc")
+def test_refreshes_do_not_leak_file_descriptors(engine, tmp_path):
+    snapshot = VectorSnapshot(engine, 'test', directory=str(tmp_path))
+    snapshot.refresh()
+    snapshot.search([1.0, 0.0])
+    fds = open_fds()
+    # Kept alive like by a pending traceback, the replaced generations must be closed explicitly
+    generations = [snapshot._generation]
+
+    for i in range(5, 15):
+        engine.rows[f"id-{i}"] = (f"comment {i}", {"n": i}, [float(i), 1.0])
+        snapshot.refresh()
+        snapshot.search([1.0, 0.0])
+        generations.append(snapshot._generation)
+
+    assert snapshot.refreshes == 11
+    assert open_fds() == fds
+
+
+def test_search_in_flight_keeps_the_previous_generation_open(engine, tmp_path):
+    snapshot = VectorSnapshot(engine, 'test', directory=str(tmp_path))
+    snapshot.refresh()
+    generation = snapshot._generation.acquire()
+
+    engine.rows['id-5'] = ("comment 5", {"n": 5}, [5.0, 1.0])
+    snapshot.refresh()
+
+    # Still readable until released
+    assert generation.row(0)["document"] == "comment 0"
+    generation.release()
+    assert generation._documents_file.closed
+    assert [doc.page_content for doc, _ in snapshot.search([1.0, 0.0], k=1)] == ["comment 5"]
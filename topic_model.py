@@ -6,24 +6,164 @@ from hdbscan import HDBSCAN
 from bertopic.representation import KeyBERTInspired, MaximalMarginalRelevance, OpenAI, PartOfSpeech
 from bertopic import BERTopic
 import logging
-import openai
 from bertopic.backend import OpenAIBackend
-from bertopic.vectorizers import ClassTfidfTransformer
-import psycopg2
-from sqlalchemy import create_engine
-from openai_client import prompt_chatgpt, prompt_dalle
+from bertopic.vectorizers import ClassTfidfTransformer, OnlineCountVectorizer
+from sklearn.decomposition import IncrementalPCA
+from sklearn.cluster import MiniBatchKMeans
+from db import get_posts_engine
+from openai_client import prompt_chatgpt, generate_image, client as openai_client
+import numpy as np
 import pandas as pd
 import uuid
 from datetime import datetime
 import os
-from utils import upload_to_minio
+import threading
+from utils import upload_image_bytes, get_image_url, map_concurrently
+from embedding_cache import get_cache, EMBEDDING_MODEL
+from metrics import time_stage
 
 OPEN_AI_API_KEY = os.getenv('OPEN_AI_API_KEY')
+# Maximum number of ChatGPT and DALL-E calls running at the same time
+TOPIC_MODEL_LLM_CONCURRENCY = int(os.getenv('TOPIC_MODEL_LLM_CONCURRENCY', '4'))
+IMAGE_UPLOAD_CONCURRENCY = int(os.getenv('IMAGE_UPLOAD_CONCURRENCY', '4'))
+# 'fit' fits a new model per transcript which is not saved, only 'online' updates one persisted model
+# with every transcript so that topics build up across podcasts
+TOPIC_MODEL_MODE = os.getenv('TOPIC_MODEL_MODE', 'fit')
+TOPIC_MODEL_DIR = os.getenv('TOPIC_MODEL_DIR', 'models')
+TOPIC_MODEL_ONLINE_CLUSTERS = int(os.getenv('TOPIC_MODEL_ONLINE_CLUSTERS', '20'))
+TOPIC_MODEL_ONLINE_DECAY = float(os.getenv('TOPIC_MODEL_ONLINE_DECAY', '0.01'))
+NUM_REPRESENTATIVE_DOCS = 3
 logger = logging.getLogger(__name__)
 
 # Configure logging to write to the console
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+class CachedOpenAIBackend(OpenAIBackend):
+    """
+    OpenAIBackend which serves repeated documents from the local embedding cache.
+    """
+
+    def embed(self, documents, verbose=False):
+        embed_fn = lambda docs: super(CachedOpenAIBackend, self).embed(docs, verbose)
+        return np.vstack(get_cache().embed(self.embedding_model, None, list(documents), embed_fn))
+
+
+class InstrumentedBERTopic(BERTopic):
+    """
+    BERTopic recording the duration of its dimensionality reduction (UMAP), clustering (HDBSCAN)
+    and topic representation steps.
+    """
+
+    def _reduce_dimensionality(self, *args, **kwargs):
+        with time_stage('dimensionality_reduction'):
+            return super()._reduce_dimensionality(*args, **kwargs)
+
+    def _cluster_embeddings(self, *args, **kwargs):
+        with time_stage('clustering'):
+            return super()._cluster_embeddings(*args, **kwargs)
+
+    def _extract_topics(self, *args, **kwargs):
+        with time_stage('representation'):
+            return super()._extract_topics(*args, **kwargs)
+
+    def partial_fit(self, *args, **kwargs):
+        # partial_fit extracts the topic words itself instead of calling _extract_topics
+        self._partial_fit = True
+        try:
+            return super().partial_fit(*args, **kwargs)
+        finally:
+            self._partial_fit = False
+
+    def _extract_words_per_topic(self, *args, **kwargs):
+        if not getattr(self, '_partial_fit', False):
+            # Already timed by _extract_topics
+            return super()._extract_words_per_topic(*args, **kwargs)
+        with time_stage('representation'):
+            return super()._extract_words_per_topic(*args, **kwargs)
+
+
+def get_embedding_backend():
+    # The shared client goes through the rate limits and retries of openai_client
+    return CachedOpenAIBackend(openai_client, EMBEDDING_MODEL)
+
+
+class OnlineTopicModelStore():
+    """
+    Persisted BERTopic model which is updated with every new transcript instead of being refitted.
+
+    UMAP, HDBSCAN and the CountVectorizer are replaced by their incremental counterparts
+    IncrementalPCA, MiniBatchKMeans and OnlineCountVectorizer, so `partial_fit` only processes
+    the new documents. The model, including its topic embeddings and c-TF-IDF state, is pickled
+    to TOPIC_MODEL_DIR after every update.
+
+    Attributes:
+        path (str): Path of the pickled model.
+    """
+
+    def __init__(self, directory=TOPIC_MODEL_DIR, n_clusters=TOPIC_MODEL_ONLINE_CLUSTERS) -> None:
+        self.path = os.path.join(directory, 'online_topic_model.pkl')
+        self.n_clusters = n_clusters
+        self.topic_model = None
+        self._lock = threading.Lock()
+
+    def _new_model(self, embedding_model):
+        return InstrumentedBERTopic(representation_model=KeyBERTInspired(),
+                        embedding_model=embedding_model,
+                        umap_model=IncrementalPCA(n_components=5),
+                        hdbscan_model=MiniBatchKMeans(n_clusters=self.n_clusters, random_state=42),
+                        vectorizer_model=OnlineCountVectorizer(stop_words="english", decay=TOPIC_MODEL_ONLINE_DECAY),
+                        ctfidf_model=ClassTfidfTransformer(),
+                        top_n_words=10,
+                        )
+
+    def _load(self, embedding_model):
+        if self.topic_model is None:
+            if os.path.exists(self.path):
+                logger.info(f"Loading topic model from {self.path}...")
+                self.topic_model = InstrumentedBERTopic.load(self.path)
+                self.topic_model.embedding_model = embedding_model
+            else:
+                self.topic_model = self._new_model(embedding_model)
+        return self.topic_model
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        # The OpenAI client is not picklable, it is attached again after loading
+        self.topic_model.save(tmp_path, serialization="pickle", save_embedding_model=False)
+        os.replace(tmp_path, self.path)
+
+    def update(self, docs, embeddings, embedding_model):
+        """
+        Updates the model with new documents and returns the model and the topics of these documents.
+        """
+        with self._lock:
+            topic_model = self._load(embedding_model)
+            is_new = not getattr(topic_model, 'topic_representations_', None)
+            if is_new and len(docs) < self.n_clusters:
+                raise ValueError(f"The first transcript of an online topic model needs at least {self.n_clusters} utterances")
+            if len(docs) < topic_model.umap_model.n_components:
+                raise ValueError(f"A transcript needs at least {topic_model.umap_model.n_components} utterances")
+
+            logger.info(f"Updating online topic model with {len(docs)} documents...")
+            topic_model.partial_fit(docs, embeddings)
+            topics, _ = topic_model.transform(docs, embeddings)
+            self._save()
+            return topic_model, topics
+
+
+_online_store = None
+_online_store_lock = threading.Lock()
+
+
+def get_online_store():
+    global _online_store
+    with _online_store_lock:
+        if _online_store is None:
+            _online_store = OnlineTopicModelStore()
+        return _online_store
+
+
 class TopicModel():
     """
     Class for topic modeling based on BERTopic.
@@ -34,13 +174,36 @@ class TopicModel():
         topic_model (BERTopic): BERTopic model instance.
     """
     
-    def __init__(self, data) -> None:
+    def __init__(self, data, mode=TOPIC_MODEL_MODE, embeddings=None) -> None:
         """
         Initialize the TopicModel class.
+
+        Args:
+            data (numpy.ndarray): Documents to model.
+            mode (str): 'fit' to fit a new model, 'online' to update the persisted online model.
+            embeddings (numpy.ndarray): Precomputed EMBEDDING_MODEL embeddings of the documents, embedded here when None.
         """
         self.is_fitted = False
         self.data = data
-        self._fit_topic_model(self)
+        self.mode = mode
+        self.embeddings = embeddings
+        self.doc_topics = None
+        if mode == 'online':
+            self._update_online_model()
+        else:
+            self._fit_topic_model()
+
+    def _update_online_model(self):
+        """
+        Update the persisted online model with the documents and assign them to topics.
+        """
+        docs = list(self._get_docs())
+        embedding_model = get_embedding_backend()
+        if self.embeddings is None:
+            with time_stage('embedding'):
+                self.embeddings = embedding_model.embed(docs)
+        self.topic_model, self.doc_topics = get_online_store().update(docs, self.embeddings, embedding_model)
+        self.is_fitted = True
 
     def _fit_topic_model(self, mmr_diversity=0.3, pos_model='en_core_web_sm'):
         """
@@ -71,10 +234,7 @@ class TopicModel():
             # embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
             # embeddings = embedding_model.encode(docs, show_progress_bar=True)
 
-            EMBEDDING_MODEL = "text-embedding-3-large"
-
-            client = openai.OpenAI(api_key=OPEN_AI_API_KEY)
-            embedding_model = OpenAIBackend(client, EMBEDDING_MODEL)
+            embedding_model = get_embedding_backend()
 
             ctfidf_model = ClassTfidfTransformer()
 
@@ -82,14 +242,14 @@ class TopicModel():
             umap_model = UMAP(n_neighbors=15, n_components=5, min_dist=0.0, metric='cosine', random_state=42)
             hdbscan_model = HDBSCAN(min_cluster_size=15, metric='euclidean', cluster_selection_method='eom', prediction_data=True)
 
-            self.topic_model = BERTopic(representation_model=keybert_model,
+            self.topic_model = InstrumentedBERTopic(representation_model=keybert_model,
                                         embedding_model=embedding_model,
                                         umap_model=umap_model,
                                         top_n_words=10,
                                         ctfidf_model=ctfidf_model,
                                         hdbscan_model=hdbscan_model,
                                         )
-            self.topic_model.fit(docs)
+            self.topic_model.fit(docs, embeddings=self.embeddings)
         except Exception as e: 
             raise e
 
@@ -98,7 +258,7 @@ class TopicModel():
         if not self.is_fitted:
             self._fit_topic_model()
     
-        topics = self.topic_model.fit(self._get_docs())
+        topics = self.topic_model.fit(self._get_docs(), embeddings=self.embeddings)
         self.is_fitted = True
         return topics
     
@@ -143,14 +303,10 @@ class TopicModel():
             list: List of prompts for each topic.
         """
         logger.info("Generating topic prompts...")
-        topics = self.topic_model.get_topic_info()
         prompts = []
 
         # For each topic, prompt ChatGPT for summary
-        for topic_num in range(len(topics)):
-            docs_list = topics.iloc[topic_num]['Representative_Docs']
-            keywords = topics.iloc[topic_num]['Representation']
-            
+        for docs_list, keywords in self._topic_descriptions():
             prompt = f"""I have a topic that contains the following documents:  {docs_list}
 
             The topic is described by the following keywords: {keywords}
@@ -164,72 +320,111 @@ class TopicModel():
         return prompts
     
 
-    def get_summaries(self):
-        summaries = []
-        sum2post = []
-        prompts = self.generate_topic_prompts()
-        for prompt in prompts:
-            messages = [
-                {"role": "system", "content": prompt}
-            ]
-            new_topic = prompt_chatgpt(messages=messages).choices[0].message.content
+    def _summarize_topic(self, prompt):
+        """
+        Summarizes a topic and converts the summary to social media posts.
+
+        Returns:
+            list: List of posts in the format 'Title:<post_title> [SEP] Post:<post_caption>'.
+        """
+        messages = [
+            {"role": "system", "content": prompt}
+        ]
+        new_topic = prompt_chatgpt(messages=messages).choices[0].message.content
 
-            num_posts = 2
+        num_posts = 2
 
-            post_conversion_prompt = f"""I have the following summary of a document after analyzing and performing topic modeling into it. The modeling was done on a podcast transcript and the theme of the conversation is represented in the following - {new_topic}. Generate {num_posts} distinct social media posts for this given topic. This post should consist of a thought provoking scenario, demanding user's engagement and contribution towards the theme. Make sure the topic represents the topic and the context appropriately and does not drift away from it. Use a small title of at most 5 words that perfectly describes the theme of the post. Consider [SEP] to be a special separation character, [EOP] represents End of post character, and make sure it is in the following format:
+        post_conversion_prompt = f"""I have the following summary of a document after analyzing and performing topic modeling into it. The modeling was done on a podcast transcript and the theme of the conversation is represented in the following - {new_topic}. Generate {num_posts} distinct social media posts for this given topic. This post should consist of a thought provoking scenario, demanding user's engagement and contribution towards the theme. Make sure the topic represents the topic and the context appropriately and does not drift away from it. Use a small title of at most 5 words that perfectly describes the theme of the post. Consider [SEP] to be a special separation character, [EOP] represents End of post character, and make sure it is in the following format:
             Title:<post_title> [SEP] Post:<post_caption>
             [EOP]
             """
-            summaries.append(new_topic)
-            messages = [
-                    {"role": "system", "content": post_conversion_prompt}
-                ]
-            final_response = prompt_chatgpt(messages=messages).choices[0].message.content
-            ext_posts = final_response.split("[EOP]")[:-1] # Skip the last [EOP]
-            for post in ext_posts:
-                sum2post.append(post)
-            
+        messages = [
+                {"role": "system", "content": post_conversion_prompt}
+            ]
+        final_response = prompt_chatgpt(messages=messages).choices[0].message.content
+        return final_response.split("[EOP]")[:-1] # Skip the last [EOP]
+
+
+    def _topic_descriptions(self):
+        """
+        Get representative documents and keywords per topic.
+
+        In online mode only the topics of the current documents are described, with the documents
+        closest to the topic centroid as representative documents.
+
+        Returns:
+            list: List of (representative docs, keywords) tuples.
+        """
+        if self.doc_topics is None:
+            topics = self.topic_model.get_topic_info()
+            return [(topics.iloc[topic_num]['Representative_Docs'], topics.iloc[topic_num]['Representation'])
+                    for topic_num in range(len(topics))]
+
+        docs = np.asarray(self._get_docs())
+        doc_topics = np.asarray(self.doc_topics)
+        descriptions = []
+        for topic in sorted(set(doc_topics.tolist()) - {-1}):
+            members = np.where(doc_topics == topic)[0]
+            centroid = self.embeddings[members].mean(axis=0)
+            closest = members[np.argsort(np.linalg.norm(self.embeddings[members] - centroid, axis=1))[:NUM_REPRESENTATIVE_DOCS]]
+            keywords = [word for word, _ in self.topic_model.get_topic(topic) or []]
+            descriptions.append((docs[closest].tolist(), keywords))
+        return descriptions
+
+
+    def get_summaries(self):
+        prompts = self.generate_topic_prompts()
+        # Topics are summarized concurrently, a failed topic is skipped
+        results = map_concurrently(self._summarize_topic, prompts, TOPIC_MODEL_LLM_CONCURRENCY)
+        sum2post = [post for ext_posts in results if ext_posts for post in ext_posts]
+
         # return final_response.split('[SEP]')
         print('SUM2POSt -> \n', sum2post)
         return sum2post
     
 
+    def _create_post(self, summary):
+        split_summary = summary.split('[SEP]')
+        post_theme = split_summary[0]
+        post_content = split_summary[1]
+        post_prompt = f"You are a content creator of a social media forum. You lead a community of people who are interested in the topic: \"{post_theme}\". As your next post, I have the following post content: \"{post_content}\". To make this post capable of inducing a thought provoking scenario, that demands user\'s engagement and contribution towards the theme, you need to create an appropriate image artwork which captures the essence of the post. "
+        # Make sure the artwork represents an abstract artifact and supports the users to think at a meta level."
+
+        # The image bytes are kept until export_posts uploads them to MinIO
+        post = {
+            'content': post_content,
+            'image': generate_image(post_prompt)
+        }
+        return post_theme, post
+
+
     def get_posts(self):
         summaries = self.get_summaries()
         print(summaries)
         logger.info('Generating post images...')
+        # Images are generated concurrently, posts keep the order of the summaries
+        results = map_concurrently(self._create_post, summaries, TOPIC_MODEL_LLM_CONCURRENCY)
         posts = {}
-        for summary in summaries:
-            split_summary = summary.split('[SEP]')
-            post_theme = split_summary[0]
-            post_content = split_summary[1]
-            post_prompt = f"You are a content creator of a social media forum. You lead a community of people who are interested in the topic: \"{post_theme}\". As your next post, I have the following post content: \"{post_content}\". To make this post capable of inducing a thought provoking scenario, that demands user\'s engagement and contribution towards the theme, you need to create an appropriate image artwork which captures the essence of the post. "
-            # Make sure the artwork represents an abstract artifact and supports the users to think at a meta level."
-            
-            post_url = prompt_dalle(post_prompt)
-            post = {
-                'content': post_content,
-                'image_url': post_url
-            }
-            posts[post_theme] = post
+        for result in results:
+            if result is not None:
+                post_theme, post = result
+                posts[post_theme] = post
         self.export_posts(posts)
         return posts
 
 
     def export_posts(self, posts):
         """
-        Export topics to PostgreSQL table.
+        Upload post images to MinIO and export posts to PostgreSQL table.
+
+        The image bytes of every post are replaced by its 'image_id' and a presigned 'image_url'.
         """
         print("exporting posts...")
-        # Database credentials
-        POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
-        POSTGRES_USER = os.getenv('POSTGRES_USER')
-        POSTGRES_HOST = os.getenv('POSTGRES_HOST')
-        POSTGRES_DB_NAME = os.getenv('POSTGRES_DB_NAME')
-        POSTGRES_PORT = os.getenv('POSTGRES_PORT')
-
-        # Create the database connection
-        engine = create_engine(f'postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB_NAME}')
+        # Upload the images concurrently, a failed upload gives an empty image id
+        image_ids = map_concurrently(upload_image_bytes, [post.pop('image') for post in posts.values()], IMAGE_UPLOAD_CONCURRENCY)
+        for post, image_id in zip(posts.values(), image_ids):
+            post['image_id'] = image_id or ''
+            post['image_url'] = get_image_url(post['image_id'])
 
         TABLE_NAME = 'posts'
         df_posts = []
@@ -245,9 +440,10 @@ class TopicModel():
                 "type": "Story",
                 "author_id": "clwaic21v000btf01eydoklol",
                 "status": "ai_generated_unreviewed",
-                "image_id": upload_to_minio(image_url=post['image_url']) 
+                "image_id": post['image_id']
             }
             df_posts.append(post)
         df = pd.DataFrame(df_posts)
-        df.to_sql(TABLE_NAME, engine, if_exists='append', index=False)
-        print('Exported to PostgreSQL.')
\ No newline at end of file
+        with time_stage('sql_export'):
+            df.to_sql(TABLE_NAME, get_posts_engine(), if_exists='append', index=False)
+        print('Exported to PostgreSQL.')
@@ -1,167 +1,130 @@
 import pandas as pd
+import pyarrow as pa
 import argparse
-import requests
-import time
-import json 
+import contextlib
 import os 
-import datetime
-from indexer import add_data
+from indexer import split, create_and_get_vectorstore, add_embedded_documents, window_utterances
+from gladia_client import GladiaClient, get_client
+from metrics import time_stage
+from segmented_transcription import SEGMENTED_TRANSCRIPTION_ENABLED, transcribe_segmented
 
 GLADIA_API_KEY = os.getenv('GLADIA_API_KEY')
 PGVECTOR_COLLECTION = os.getenv('PGVECTOR_COLLECTION')
 CONNECTION_STRING = os.getenv('DATABASE_URL')
 
+# Utterance fields kept from the Gladia result, other fields such as the words are dropped
+UTTERANCE_SCHEMA = pa.schema([
+    ('text', pa.string()),
+    ('speaker', pa.int64()),
+    ('start', pa.float64()),
+    ('end', pa.float64()),
+])
+
 def generate_csv(json_data):
-     # Initialize a list to hold our data tuples
-    data_tuples = []
-    
-     # Iterate over each utterance in the provided JSON data
-    for utterance in json_data['result']['transcription']['utterances']:
-        text = utterance['text']
-        speaker = utterance['speaker']
-        timestamp = utterance['start']
-        
-        # Append each found tuple to the list
-        data_tuples.append((text, speaker, timestamp))
-        
-    # Create a DataFrame from the list of tuples
-    df = pd.DataFrame(data_tuples, columns=['text', 'speaker', 'timestamp'])
-
-    # Convert the 'timestamp' column to datetime format
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
-
-    # Return the completed DataFrame
+    """
+    Builds the utterance table of a Gladia transcription.
+
+    The columns are filled from the utterance list by Arrow in one pass instead of row by row,
+    start and end stay in seconds for the utterance windows.
+    """
+    utterances = pa.Table.from_pylist(json_data['result']['transcription']['utterances'], schema=UTTERANCE_SCHEMA)
+    df = utterances.to_pandas()
+
+    # The 'timestamp' column keeps the start converted to datetime
+    df.insert(2, 'timestamp', pd.to_datetime(df['start']))
     return df
 
 
-def upload_audio(file_path, audio_extension, api_key=GLADIA_API_KEY):
+def upload_audio(audio_file, audio_extension, api_key=GLADIA_API_KEY):
     """
     Uploads an audio file to the Gladia API.
 
     Args:
-        file_path (str): The path to the audio file.
+        audio_file (str or file): The path to the audio file or a binary file object positioned at its start.
         api_key (str): Your Gladia API token.
     """
 
     print('called upload_audio')
-    
-    # Prepare the headers for the request
-    headers = {
-        'x-gladia-key': api_key
-    }
-
-    # Prepare the file data as a dictionary where the key matches the name in the form data
-    files = {
-        'audio': ('test_audio', open(file_path, 'rb'), f'audio/{audio_extension}')
-    } 
-
-    url = 'https://api.gladia.io/v2/upload'
-
-    try:
-        response = requests.post(url, headers=headers, files=files)
-        print("Response from server:")
-        response_data = json.loads(response.text)
-        print(response_data['audio_url'])
 
-        return response_data['audio_url']
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    client = _get_client(api_key)
+    content_type = f'audio/{audio_extension}'
+    with time_stage('upload'):
+        if isinstance(audio_file, (str, os.PathLike)):
+            with open(audio_file, 'rb') as audio:
+                audio_url = client.upload(audio, 'test_audio', content_type, os.fstat(audio.fileno()).st_size)
+        else:
+            size = audio_file.seek(0, os.SEEK_END)
+            audio_file.seek(0)
+            audio_url = client.upload(audio_file, 'test_audio', content_type, size)
+    print(audio_url)
+    return audio_url
 
 
 def request_transcription_from_audio_url(audio_url, api_key=GLADIA_API_KEY):
-    headers = {
-        'Content-Type': 'application/json',
-        'x-gladia-key': api_key
-    }
-
     print('called request_transcription_from_audio_url')
 
-    # Prepare the JSON payload for the request.
-    data = {
-        'audio_url': audio_url,
-        "diarization": True
-    }
+    _, result_url = _get_client(api_key).request_transcription(audio_url)
+    return result_url
+
 
-    # Specify the URL for the transcription API endpoint.
-    url = 'https://api.gladia.io/v2/transcription'
+def get_transcription(result_url, api_key=GLADIA_API_KEY):
+    return _get_client(api_key).get_transcription(result_url)
 
-    try:
-        # Send the POST request with the JSON data.
-        response = requests.post(url, headers=headers, json=data)
-        print(response.text)
-        response_data = json.loads(response.text)
-        return response_data['result_url']
-    except Exception as e:
-        print(f"An error occurred: {e}")
 
+def _get_client(api_key):
+    if api_key == GLADIA_API_KEY:
+        return get_client()
+    return GladiaClient(api_key=api_key)
 
-def get_transcription(result_url, api_key=GLADIA_API_KEY):
-    # Set up the headers including your API key.
-    headers = {
-        'x-gladia-key': api_key
-    }
-
-    # Specify the URL for the transcription API endpoint including the specific resource ID.
-    url = result_url
-
-    try:
-        # Send the GET request.
-        response = requests.get(url, headers=headers)
-
-        # print(response.text)
-        transcription = json.loads(response.text)
-        return transcription
-    
-    except Exception as e:
-        print(f"An error occurred: {e}")
-
-def transcribe(audio_file, audio_extension, audio_url=""):
+
+def index_transcript(windows, embeddings=None):
     """
-    Wrapper function that uploads an audio file to the Gladia API, preprocesses transcription and dumps to postgres.
+    Adds the utterance windows of a transcript (see `indexer.window_utterances`) to the vector store,
+    reusing their embeddings when given.
     """
-    if not audio_url:
-        # Upload audio
-        audio_url = upload_audio(audio_file, audio_extension)
+    if embeddings is None:
+        with time_stage('vector_insert'):
+            return create_and_get_vectorstore(split(windows), CONNECTION_STRING, PGVECTOR_COLLECTION)
+    return add_embedded_documents(windows, embeddings, CONNECTION_STRING, PGVECTOR_COLLECTION)
 
-    # Request transcription
-    result_url = request_transcription_from_audio_url(audio_url)
 
-    # Get transcription
-    transcription = ""
+def transcribe(audio_file, audio_extension, audio_url="", index=True, upload_slots=None):
+    """
+    Wrapper function that uploads an audio file to the Gladia API, preprocesses transcription and dumps to postgres.
 
+    `audio_file` is either a path or a binary file object, it is ignored when `audio_url` is given.
+    With `index=False` the caller adds the utterances to the vector store with `index_transcript`
+    and stores the returned table in the transcript store, see `pipeline.analyze_audio`.
+    With SEGMENTED_TRANSCRIPTION_ENABLED recordings longer than SEGMENT_MIN_DURATION are transcribed
+    as concurrent segments, see `segmented_transcription`.
+    Every upload, of the file or of one of its segments, holds one of `upload_slots` when given.
+    """
     print('called transcribe')
 
-    while True: 
-        poll_response = get_transcription(result_url)
+    transcription = None
+    if SEGMENTED_TRANSCRIPTION_ENABLED:
+        with time_stage('segmented_transcription'):
+            transcription = transcribe_segmented(audio_file, audio_extension, audio_url, upload_slots)
 
-        print(poll_response)
+    if transcription is None:
+        if not audio_url:
+            # Upload audio
+            with upload_slots or contextlib.nullcontext():
+                audio_url = upload_audio(audio_file, audio_extension)
 
-        if poll_response['status'] == 'queued':
-            time.sleep(1)
-            print("Polling for results...")
-
-        elif poll_response['status'] == 'done':
-            transcription = poll_response
-            print("Transcription done.")
-            break
+        # Request transcription and wait for the result
+        with time_stage('transcription_wait'):
+            transcription = get_client().transcribe_url(audio_url)
+    print("Transcription done.")
 
     # Preprocess
-    df = generate_csv(transcription)
+    with time_stage('csv_build'):
+        df = generate_csv(transcription)
     print(df.head())
 
-    current_timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-
-    # filename = "output.csv"
-
-    # TODO : Use a better naming scheme to keep track of multiple transcriptions
-    filename = f"transcription_{current_timestamp}.csv"
-
-    # Export to Postgres and dump as csv
-    df.to_csv(filename)
-
     # Export to vector db
-    connection_string = CONNECTION_STRING
-    vectordb = add_data(df[['text', 'speaker']], connection_string, PGVECTOR_COLLECTION, pre_delete_collection=False)
+    if index:
+        index_transcript(window_utterances(df))
 
     print('transcription and export done')
 
@@ -169,40 +132,21 @@ def transcribe(audio_file, audio_extension, audio_url=""):
 
 
 def main():
-    # Dont remove, following code is useful to use the script as a CLI
-    parser = argparse.ArgumentParser(description="Upload an audio file to the Gladia API.")
+    # Dont remove, following code is useful to use the script as a CLI, see batch_transcribe.py for many files
+    parser = argparse.ArgumentParser(description="Transcribe an audio file with the Gladia API.")
     parser.add_argument('file_path', type=str, help='The path to the audio file to upload.')
     parser.add_argument('file_type', type=str, help='The file type of the audio file to upload.')
+    parser.add_argument('--output', type=str, help='Write the utterances to this CSV file.')
+    parser.add_argument('--index', action='store_true', help='Also add the utterances to the vector store.')
     args = parser.parse_args()
 
-    # Upload audio
-    audio_url = upload_audio(args.file_path, args.file_type)
-
-    # Request transcription
-    result_url = request_transcription_from_audio_url(audio_url)
-
-    # Get transcription
-    transcription = ""
-
-    while True:
-        poll_response = get_transcription(result_url)
-
-        if poll_response['status'] == 'queued':
-            time.sleep(1)
-            print("Polling for results...")
-
-        elif poll_response['status'] == 'done':
-            transcription = poll_response
-            print("Transcription done.")
-            break
-
-    # Preprocess
-    df = generate_csv(transcription)
-    print(df.head())
+    # Upload, transcribe and preprocess, waiting at most GLADIA_TRANSCRIPTION_TIMEOUT seconds
+    df = transcribe(args.file_path, args.file_type, index=args.index)
 
-    # Export to Postgres and dump as csv
-    df.to_csv('data/output.csv')
+    if args.output:
+        df.to_csv(args.output, index=False)
+        print(f"Wrote {len(df)} utterances to {args.output}")
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,254 @@
+"""
+Store of transcript artifacts, the utterance table of every finished transcription.
+
+Every transcript is written once as an uncompressed Arrow IPC file, `<transcript id>.arrow`, and
+listed in the manifest table of `manifest.sqlite3` with its source, size and number of
+utterances. Reprocessing memory-maps the file instead of calling Gladia again, and audio submitted
+again is neither transcribed nor indexed twice.
+
+Uploads are keyed by the sha256 of their content, computed while the upload is spooled. URLs are
+keyed by the normalized URL together with the ETag or Last-Modified header of the file, a URL
+without either header is stored without a key and is never reused.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import pyarrow as pa
+import requests
+
+TRANSCRIPT_STORE_ENABLED = os.getenv('TRANSCRIPT_STORE_ENABLED', 'true').lower() == 'true'
+TRANSCRIPT_STORE_DIR = os.getenv('TRANSCRIPT_STORE_DIR', 'transcripts')
+# Least recently used transcripts are evicted above this total size
+TRANSCRIPT_STORE_MAX_BYTES = int(os.getenv('TRANSCRIPT_STORE_MAX_BYTES', str(1024 * 1024 * 1024)))
+# Transcripts not used for this many seconds are evicted, 0 keeps them until the size limit
+TRANSCRIPT_STORE_MAX_AGE = float(os.getenv('TRANSCRIPT_STORE_MAX_AGE', str(90 * 24 * 3600)))
+URL_VALIDATOR_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_url(url):
+    """
+    Lowercases scheme and host, drops default ports and the fragment and sorts the query parameters.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and not (scheme, parts.port) in (('http', 80), ('https', 443)):
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+
+def url_validator(url):
+    """
+    Returns the ETag or Last-Modified of `url`, None if the server sends neither.
+    """
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=URL_VALIDATOR_TIMEOUT)
+    except requests.RequestException as e:
+        logger.info(f"HEAD {url} failed: {e}")
+        return None
+    if response.status_code >= 400:
+        return None
+    etag = response.headers.get('ETag')
+    if etag:
+        return f"etag:{etag}"
+    last_modified = response.headers.get('Last-Modified')
+    if last_modified:
+        return f"modified:{last_modified}:{response.headers.get('Content-Length', '')}"
+    return None
+
+
+class TranscriptStore():
+    """
+    Arrow files of finished transcripts with an SQLite manifest and LRU eviction.
+
+    Attributes:
+        directory (str): Directory of the transcript files and the manifest.
+        max_bytes (int): Total size of the stored transcripts before the least recently used ones are evicted.
+        max_age (float): Seconds after the last use after which a transcript is evicted, 0 to disable.
+    """
+
+    def __init__(self, directory=TRANSCRIPT_STORE_DIR, max_bytes=TRANSCRIPT_STORE_MAX_BYTES, max_age=TRANSCRIPT_STORE_MAX_AGE) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(directory, 'manifest.sqlite3'), timeout=30, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS manifest (
+                    id TEXT PRIMARY KEY,
+                    key TEXT UNIQUE,
+                    source TEXT,
+                    filename TEXT NOT NULL,
+                    utterances INTEGER NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS manifest_last_used ON manifest (last_used)")
+
+    def upload_key(self, content_hash):
+        return f"sha256:{content_hash}"
+
+    def url_key(self, url):
+        """
+        Returns the key of `url`, None if its content cannot be validated.
+        """
+        validator = url_validator(url)
+        if validator is None:
+            return None
+        return f"url:{normalize_url(url)}#{validator}"
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def get(self, key):
+        """
+        Returns the id and the utterance table of the transcript stored under `key`, (None, None) if there is none.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT id FROM manifest WHERE key = ?", (key,)).fetchone()
+        df = self.load(row[0]) if row else None
+        with self._lock:
+            if df is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return (row[0], df) if df is not None else (None, None)
+
+    def load_table(self, transcript_id):
+        """
+        Returns the utterances of a transcript as an Arrow table backed by the memory-mapped file, None if it is not stored.
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT filename FROM manifest WHERE id = ?", (transcript_id,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE manifest SET last_used = ? WHERE id = ?", (time.time(), transcript_id))
+        if row is None:
+            return None
+        try:
+            with pa.memory_map(self._path(row[0])) as source:
+                return pa.ipc.open_file(source).read_all()
+        except (FileNotFoundError, pa.ArrowInvalid) as e:
+            logger.info(f"Dropping unreadable transcript {transcript_id}: {e}")
+            self.delete(transcript_id)
+            return None
+
+    def load(self, transcript_id):
+        """
+        Returns the utterance table of a transcript as a DataFrame, None if it is not stored.
+        """
+        table = self.load_table(transcript_id)
+        return table.to_pandas() if table is not None else None
+
+    def put(self, df, key=None, source=None):
+        """
+        Stores an utterance table and evicts expired and least recently used transcripts.
+
+        Returns:
+            str: The id of the stored transcript.
+        """
+        transcript_id = uuid.uuid4().hex
+        filename = f"{transcript_id}.arrow"
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        tmp_path = self._path(f"{filename}.tmp")
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, self._path(filename))
+        now = time.time()
+        with self._lock, self._conn:
+            # A transcript stored again under the same key replaces the earlier one
+            replaced = self._conn.execute("SELECT filename FROM manifest WHERE key = ?", (key,)).fetchone() if key else None
+            if replaced:
+                self._conn.execute("DELETE FROM manifest WHERE key = ?", (key,))
+            self._conn.execute(
+                "INSERT INTO manifest (id, key, source, filename, utterances, bytes, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (transcript_id, key, source, filename, table.num_rows, os.path.getsize(self._path(filename)), now, now)
+            )
+        if replaced:
+            self._remove_file(replaced[0])
+        self.evict()
+        return transcript_id
+
+    def _remove_file(self, filename):
+        try:
+            os.remove(self._path(filename))
+        except FileNotFoundError:
+            pass
+
+    def delete(self, transcript_id):
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT filename FROM manifest WHERE id = ?", (transcript_id,)).fetchone()
+            self._conn.execute("DELETE FROM manifest WHERE id = ?", (transcript_id,))
+        if row:
+            self._remove_file(row[0])
+
+    def evict(self):
+        expired = []
+        with self._lock, self._conn:
+            if self.max_age:
+                expired = [transcript_id for transcript_id, in self._conn.execute("SELECT id FROM manifest WHERE last_used < ?", (time.time() - self.max_age,))]
+            total = 0
+            for transcript_id, size in self._conn.execute("SELECT id, bytes FROM manifest ORDER BY last_used DESC").fetchall():
+                total += size
+                if total > self.max_bytes and transcript_id not in expired:
+                    expired.append(transcript_id)
+        for transcript_id in expired:
+            self.delete(transcript_id)
+        with self._lock:
+            self.evictions += len(expired)
+
+    def manifest(self, limit=100):
+        """
+        Returns the most recently stored transcripts with their source, number of utterances and size.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, source, utterances, bytes, created_at, last_used FROM manifest ORDER BY created_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [{"id": transcript_id, "source": source, "utterances": utterances, "bytes": size, "created_at": created_at, "last_used": last_used}
+                for transcript_id, source, utterances, size, created_at, last_used in rows]
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM manifest").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "bytes": size,
+                "evictions": self.evictions,
+            }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_transcript_store():
+    """
+    Returns the process-wide TranscriptStore, None if TRANSCRIPT_STORE_ENABLED is false.
+    """
+    global _store
+    if not TRANSCRIPT_STORE_ENABLED:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = TranscriptStore()
+        return _store
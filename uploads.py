@@ -0,0 +1,65 @@
+import hashlib
+import io
+import os
+import tempfile
+
+from flask import Request
+
+# Uploads up to this size stay in memory, larger ones are spooled to an anonymous per-request temp file
+AUDIO_SPOOL_MAX_MEMORY = int(os.getenv('AUDIO_SPOOL_MAX_MEMORY', str(8 * 1024 * 1024)))
+
+
+class HashingSpooledFile(tempfile.SpooledTemporaryFile):
+    """
+    SpooledTemporaryFile computing the sha256 of everything written to it.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return super().write(data)
+
+
+class SpoolingRequest(Request):
+    """
+    Flask request class which keeps uploaded files in memory up to AUDIO_SPOOL_MAX_MEMORY bytes.
+
+    Werkzeug writes every upload above 500KB to a temporary file by default. The content hash is
+    computed while spooling, see `upload_hash`.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingSpooledFile(max_size=AUDIO_SPOOL_MAX_MEMORY, mode='w+b')
+
+
+def detach_upload(file_storage):
+    """
+    Takes over the stream of an uploaded file so it outlives the request.
+
+    Werkzeug closes all uploaded files when the request ends, the caller is responsible for closing
+    the returned stream instead.
+
+    Returns:
+        tuple: Tuple containing the stream positioned at the start and its size in bytes.
+    """
+    stream = file_storage.stream
+    file_storage.stream = io.BytesIO()
+    size = stream.seek(0, io.SEEK_END)
+    stream.seek(0)
+    return stream, size
+
+
+def upload_hash(stream):
+    """
+    Returns the sha256 hex digest of a detached upload, read from the stream if it was not computed while spooling.
+    """
+    if isinstance(stream, HashingSpooledFile):
+        return stream.sha256.hexdigest()
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+        sha256.update(chunk)
+    stream.seek(0)
+    return sha256.hexdigest()
@@ -1,6 +1,12 @@
 
 from minio import Minio
 from minio.error import S3Error
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from metrics import time_stage
+import io
+import logging
+import threading
 import requests 
 import uuid
 import os 
@@ -9,14 +15,23 @@ S3_URL = os.getenv("S3_URL")
 S3_USERNAME = os.getenv("S3_USERNAME")
 S3_PASSWORD = os.getenv("S3_PASSWORD")
 S3_BUCKET = os.getenv("S3_BUCKET")
+# Set to false for a local MinIO without TLS
+S3_SECURE = os.getenv("S3_SECURE", "true").lower() != "false"
+# Part size used for multipart uploads of streams without a known length
+S3_PART_SIZE = 10 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
 
 minio_client = Minio(
             S3_URL,
             access_key=S3_USERNAME,
             secret_key=S3_PASSWORD,
-            secure=True
+            secure=S3_SECURE
         )
 
+_checked_buckets = set()
+_bucket_lock = threading.Lock()
+
 def generate_html(posts):
     # Only for testing : Generates HTML page with the currently generated posts and stores them as 'index.html' file
     html_content = """
@@ -83,6 +98,16 @@ def generate_html(posts):
         file.write(html_content)
  
 
+def ensure_bucket(bucket=S3_BUCKET):
+    # The bucket is checked and created once per process
+    with _bucket_lock:
+        if bucket in _checked_buckets:
+            return
+        if not minio_client.bucket_exists(bucket):
+            minio_client.make_bucket(bucket)
+        _checked_buckets.add(bucket)
+
+
 def upload_to_minio(image_url,
                     bucket=S3_BUCKET,
                     ):
@@ -92,17 +117,19 @@ def upload_to_minio(image_url,
         response = requests.get(image_url, stream=True)
         response.raise_for_status()
 
-        if not minio_client.bucket_exists(bucket):
-            minio_client.make_bucket(bucket)
+        ensure_bucket(bucket)
 
-        # Upload the file 
-        minio_client.put_object(
-            bucket,
-            object_name,
-            data=response.raw,
-            length=int(response.headers.get('content-length')),
-            content_type=response.headers.get('content-type')
-        )
+        # Upload the file, streams without content-length are uploaded in parts
+        content_length = response.headers.get('content-length')
+        with time_stage('minio_upload'):
+            minio_client.put_object(
+                bucket,
+                object_name,
+                data=response.raw,
+                length=int(content_length) if content_length else -1,
+                part_size=0 if content_length else S3_PART_SIZE,
+                content_type=response.headers.get('content-type')
+            )
         print(f"Image is successfully uploaded with id='{object_name}' to bucket '{bucket}'.")
         return object_name
     except S3Error as e:
@@ -110,6 +137,39 @@ def upload_to_minio(image_url,
         return '' # Returns an empty string in case the upload was unsuccessful
 
 
+def upload_image_bytes(image,
+                       content_type='image/png',
+                       bucket=S3_BUCKET,
+                       ):
+    try:
+        object_name = str(uuid.uuid4())
+        ensure_bucket(bucket)
+        with time_stage('minio_upload'):
+            minio_client.put_object(
+                bucket,
+                object_name,
+                data=io.BytesIO(image),
+                length=len(image),
+                content_type=content_type
+            )
+        print(f"Image is successfully uploaded with id='{object_name}' to bucket '{bucket}'.")
+        return object_name
+    except S3Error as e:
+        print(f"File upload failed: {e}")
+        return '' # Returns an empty string in case the upload was unsuccessful
+
+
+def get_image_url(object_name, bucket=S3_BUCKET, expires=timedelta(days=7)):
+    # Presigned URL of an uploaded image, empty if the upload failed
+    if not object_name:
+        return ''
+    try:
+        return minio_client.presigned_get_object(bucket, object_name, expires=expires)
+    except S3Error as e:
+        print(f"Presigning image '{object_name}' failed: {e}")
+        return ''
+
+
 def download_image_from_url(url):
     try:
         # Download the image from url
@@ -135,3 +195,25 @@ def list_objects_in_bucket(bucket_name=S3_BUCKET):
             print(f"Object: {obj.object_name} - Size: {obj.size} bytes")
     except S3Error as e:
         print(f"Error occurred: {e}")
+
+
+def map_concurrently(fn, items, max_workers):
+    """
+    Calls `fn` for every item on a thread pool of at most `max_workers` threads.
+
+    Results keep the order of `items`. A call raising an exception is logged and gives None,
+    so one failure does not lose the whole batch.
+    """
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        futures = [executor.submit(fn, item) for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f"{getattr(fn, '__name__', fn)} failed: {e}")
+                results.append(None)
+    return results
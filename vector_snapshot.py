@@ -0,0 +1,351 @@
+"""
+Memory-mapped local copy of a pgvector collection for in-process retrieval.
+
+A snapshot generation is a directory holding:
+
+    vectors.npy     normalized embeddings, float32 or float16, opened with mmap_mode='r'
+    documents.jsonl one JSON object per row with id, document and metadata
+    offsets.npy     byte offset of every row in documents.jsonl
+    ids.json        id and content hash per row, only read when refreshing
+
+`manifest.json` next to the generations names the current one. It is replaced atomically, so
+worker processes always open a complete generation and share its pages through the page cache.
+One process at a time (the holder of an flock) refreshes the snapshot from Postgres, copying
+unchanged rows from the previous generation and fetching only new or changed rows.
+"""
+import fcntl
+import json
+import logging
+import mmap
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+from sqlalchemy import text
+
+from db import get_engine
+
+PGVECTOR_COLLECTION = os.getenv('PGVECTOR_COLLECTION')
+CONNECTION_STRING = os.getenv('DATABASE_URL')
+VECTOR_SNAPSHOT_DIR = os.getenv('VECTOR_SNAPSHOT_DIR', 'snapshots')
+# float16 halves memory and disk at a small precision cost
+VECTOR_SNAPSHOT_DTYPE = os.getenv('VECTOR_SNAPSHOT_DTYPE', 'float32')
+# Seconds between checks of the collection version
+VECTOR_SNAPSHOT_REFRESH = float(os.getenv('VECTOR_SNAPSHOT_REFRESH', '60'))
+VECTOR_SNAPSHOT_KEEP = 2
+FETCH_BATCH = 5000
+# Rows scored per block, bounds the float32 temporary of float16 snapshots
+SEARCH_BLOCK = 65536
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_vector(value):
+    return np.array(value[1:-1].split(','), dtype=np.float32)
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class SnapshotGeneration():
+    """
+    Read-only view of one snapshot generation.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self._documents_file = open(os.path.join(path, 'documents.jsonl'), 'rb')
+        size = os.fstat(self._documents_file.fileno()).st_size
+        self._documents = mmap.mmap(self._documents_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        # Searches in flight, a retired generation is closed when the last of them releases it
+        self._users = 0
+        self._retired = False
+        self._users_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def row(self, i):
+        end = int(self.offsets[i + 1]) if i + 1 < len(self.offsets) else len(self._documents)
+        return json.loads(self._documents[int(self.offsets[i]):end])
+
+    def top_k(self, query_vector, k):
+        """
+        Returns the (row, cosine similarity) pairs of the k most similar rows.
+        """
+        if not len(self):
+            return []
+        best_rows, best_scores = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        for start in range(0, len(self), SEARCH_BLOCK):
+            scores = np.asarray(self.vectors[start:start + SEARCH_BLOCK], dtype=np.float32) @ query_vector
+            top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+            best_rows = np.concatenate([best_rows, top + start])
+            best_scores = np.concatenate([best_scores, scores[top]])
+        order = np.argsort(-best_scores)[:k]
+        return [(int(best_rows[i]), float(best_scores[i])) for i in order]
+
+    def acquire(self):
+        with self._users_lock:
+            self._users += 1
+        return self
+
+    def release(self):
+        with self._users_lock:
+            self._users -= 1
+            unused = self._retired and not self._users
+        if unused:
+            self.close()
+
+    def retire(self):
+        """
+        Closes the generation once no search uses it anymore.
+        """
+        with self._users_lock:
+            self._retired = True
+            unused = not self._users
+        if unused:
+            self.close()
+
+    def close(self):
+        if isinstance(self._documents, mmap.mmap):
+            self._documents.close()
+        self._documents_file.close()
+        # The vector maps are unmapped once the embeddings returned by searches are gone
+        self.vectors = self.offsets = None
+
+
+class VectorSnapshot():
+    """
+    Retrieval backend answering top-k queries from a memory-mapped snapshot of a collection.
+
+    Attributes:
+        directory (str): Directory of the snapshots of this collection.
+        dtype (str): 'float32' or 'float16'.
+        refresh_interval (float): Seconds between two refresh checks of the background thread.
+    """
+
+    def __init__(self, engine, collection_name=PGVECTOR_COLLECTION, directory=None, dtype=VECTOR_SNAPSHOT_DTYPE,
+                 refresh_interval=VECTOR_SNAPSHOT_REFRESH) -> None:
+        self.engine = engine
+        self.collection_name = collection_name
+        self.directory = directory or os.path.join(VECTOR_SNAPSHOT_DIR, collection_name)
+        self.dtype = np.dtype(dtype)
+        self.refresh_interval = refresh_interval
+        self._generation = None
+        self._manifest = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self.refreshes = 0
+        self.rows_fetched = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.directory, 'manifest.json')
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        """
+        Opens the generation named by the manifest if it changed.
+        """
+        manifest = self._read_manifest()
+        if manifest is None or (self._manifest and manifest["generation"] == self._manifest["generation"]):
+            return
+        generation = SnapshotGeneration(os.path.join(self.directory, manifest["generation"]))
+        with self._lock:
+            previous, self._generation, self._manifest = self._generation, generation, manifest
+        if previous is not None:
+            # Searches which already hold the previous generation finish on it before it is closed
+            previous.retire()
+        logger.info(f"Opened vector snapshot {manifest['generation']} with {manifest['rows']} rows")
+
+    def search(self, query_vector, k=4, with_embeddings=False):
+        """
+        Returns the k nearest (Document, cosine distance) pairs, same as PGVector.similarity_search_with_score_by_vector.
+
+        Args:
+            with_embeddings (bool): Return (Document, cosine distance, normalized embedding) triples instead.
+        """
+        if self._generation is None:
+            self.refresh()
+        with self._lock:
+            generation = self._generation.acquire()
+        try:
+            query = _normalize(np.asarray(query_vector, dtype=np.float32))
+            results = []
+            for i, similarity in generation.top_k(query, k):
+                row = generation.row(i)
+                doc = Document(page_content=row["document"] or '', metadata=row["metadata"] or {})
+                results.append((doc, 1 - similarity, np.array(generation.vectors[i], dtype=np.float32)) if with_embeddings else (doc, 1 - similarity))
+            return results
+        finally:
+            generation.release()
+
+    def _collection_state(self, conn):
+        row = conn.execute(text("SELECT uuid FROM langchain_pg_collection WHERE name = :name"), {"name": self.collection_name}).fetchone()
+        if row is None:
+            raise ValueError(f"Collection {self.collection_name} not found")
+        version = conn.execute(text("SELECT version FROM vector_collection_version WHERE collection_name = :name"),
+                               {"name": self.collection_name}).scalar() if self._has_version_table(conn) else None
+        return str(row[0]), version
+
+    def _fingerprint(self, conn, collection_id):
+        # Computed in Postgres, only used when no collection version is recorded
+        return conn.execute(text("""
+            SELECT md5(string_agg(id || md5(coalesce(document, '') || coalesce(cmetadata::text, '')), ',' ORDER BY id))
+            FROM langchain_pg_embedding WHERE collection_id = :collection_id
+        """), {"collection_id": collection_id}).scalar()
+
+    def _has_version_table(self, conn):
+        return conn.execute(text("SELECT to_regclass('vector_collection_version')")).scalar() is not None
+
+    def refresh(self, force=False):
+        """
+        Brings the snapshot up to date with the collection if this process holds the refresh lock,
+        then opens the newest generation.
+        """
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if self._generation is None else fcntl.LOCK_NB))
+            except BlockingIOError:
+                # Another process is refreshing, its generation is picked up on the next check
+                self._load()
+                return
+            try:
+                self._refresh_locked(force)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self._load()
+
+    def _refresh_locked(self, force):
+        manifest = self._read_manifest()
+        with self.engine.connect() as conn:
+            collection_id, version = self._collection_state(conn)
+            if not force and manifest and version is not None and manifest.get("version") == version:
+                return
+            # Without a version the rows are compared by a fingerprint, an unchanged collection is not rebuilt
+            fingerprint = self._fingerprint(conn, collection_id) if version is None else None
+            if not force and manifest and fingerprint is not None and manifest.get("fingerprint") == fingerprint:
+                return
+            start = time.perf_counter()
+            current = conn.execute(text("""
+                SELECT id, md5(coalesce(document, '') || coalesce(cmetadata::text, '')) FROM langchain_pg_embedding
+                WHERE collection_id = :collection_id ORDER BY id
+            """), {"collection_id": collection_id}).fetchall()
+
+            previous_rows = {}
+            previous = None
+            if manifest:
+                previous = SnapshotGeneration(os.path.join(self.directory, manifest["generation"]))
+                with open(os.path.join(previous.path, 'ids.json')) as file:
+                    previous_rows = {row_id: (position, row_hash) for position, (row_id, row_hash) in enumerate(json.load(file))}
+
+            missing = [row_id for row_id, row_hash in current if previous_rows.get(row_id, (None, None))[1] != row_hash]
+            fetched = self._fetch(conn, collection_id, missing)
+
+        name = f"gen-{int(time.time() * 1000)}"
+        path = os.path.join(self.directory, name)
+        os.makedirs(path)
+        dimensions = len(next(iter(fetched.values()))[0]) if fetched else (previous.vectors.shape[1] if previous is not None and len(previous) else 0)
+        vectors = np.lib.format.open_memmap(os.path.join(path, 'vectors.npy'), mode='w+', dtype=self.dtype, shape=(len(current), dimensions))
+        offsets = np.zeros(len(current), dtype=np.int64)
+        with open(os.path.join(path, 'documents.jsonl'), 'wb') as documents:
+            for i, (row_id, row_hash) in enumerate(current):
+                if row_id in fetched:
+                    vector, row = fetched[row_id]
+                else:
+                    position = previous_rows[row_id][0]
+                    vector, row = previous.vectors[position], previous.row(position)
+                vectors[i] = vector
+                offsets[i] = documents.tell()
+                documents.write(json.dumps(row).encode('utf-8') + b'\n')
+        vectors.flush()
+        del vectors
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        with open(os.path.join(path, 'ids.json'), 'w') as file:
+            json.dump([[row_id, row_hash] for row_id, row_hash in current], file)
+        if previous is not None:
+            previous.close()
+
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump({"generation": name, "version": version, "fingerprint": fingerprint, "rows": len(current), "dimensions": dimensions,
+                       "dtype": self.dtype.name, "created_at": time.time()}, file)
+        os.replace(tmp_path, self.manifest_path)
+        self.refreshes += 1
+        self.rows_fetched += len(fetched)
+        logger.info(f"Vector snapshot {name}: {len(current)} rows, {len(fetched)} fetched in {time.perf_counter() - start:.1f}s")
+        self._remove_old_generations(name)
+
+    def _fetch(self, conn, collection_id, ids):
+        fetched = {}
+        for start in range(0, len(ids), FETCH_BATCH):
+            rows = conn.execute(text("""
+                SELECT id, document, cmetadata, embedding::text FROM langchain_pg_embedding
+                WHERE collection_id = :collection_id AND id = ANY(:ids)
+            """), {"collection_id": collection_id, "ids": ids[start:start + FETCH_BATCH]}).fetchall()
+            for row_id, document, metadata, embedding in rows:
+                fetched[row_id] = (_normalize(_parse_vector(embedding)), {"id": row_id, "document": document, "metadata": metadata})
+        return fetched
+
+    def _remove_old_generations(self, current):
+        generations = sorted(name for name in os.listdir(self.directory) if name.startswith('gen-') and name != current)
+        # Processes which have not switched yet keep reading the previous generation
+        for name in generations[:-(VECTOR_SNAPSHOT_KEEP - 1) or None]:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Vector snapshot refresh failed: {e}")
+
+    def start_refresh(self):
+        """
+        Refreshes the snapshot in a daemon thread every `refresh_interval` seconds.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='vector-snapshot', daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stats(self):
+        manifest = self._manifest or {}
+        return {
+            "generation": manifest.get("generation"),
+            "collection_version": manifest.get("version"),
+            "rows": manifest.get("rows", 0),
+            "age": time.time() - manifest["created_at"] if manifest else None,
+            "refreshes": self.refreshes,
+            "rows_fetched": self.rows_fetched,
+        }
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot(connection_string=CONNECTION_STRING, collection_name=PGVECTOR_COLLECTION):
+    """
+    Returns the process-wide VectorSnapshot of a collection.
+    """
+    key = (connection_string, collection_name)
+    with _snapshots_lock:
+        if key not in _snapshots:
+            _snapshots[key] = VectorSnapshot(get_engine(connection_string), collection_name)
+        return _snapshots[key]
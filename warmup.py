@@ -0,0 +1,110 @@
+"""
+Lazily loaded heavy subsystems of the service.
+
+Importing bertopic, umap, hdbscan and the langchain stack, and connecting the vector store, takes
+tens of seconds. main.py only imports light modules, components are loaded on first use or by the
+background warm-up thread started with the server, and /ready reports which of them are warm.
+"""
+import importlib
+import logging
+import os
+import threading
+import time
+
+# Components loaded by the warm-up thread, in this order
+WARMUP_COMPONENTS = [name.strip() for name in os.getenv('WARMUP_COMPONENTS', 'rag,indexer,topic_model').split(',') if name.strip()]
+# Components which must be warm for /ready to succeed
+READY_COMPONENTS = [name.strip() for name in os.getenv('READY_COMPONENTS', 'rag').split(',') if name.strip()]
+
+STATUS_COLD = 'cold'
+STATUS_LOADING = 'loading'
+STATUS_WARM = 'warm'
+STATUS_FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+def _load_rag():
+    rag = importlib.import_module('rag')
+    # Connects the vector store and builds the chain
+    rag.get_rag_chain()
+    return rag
+
+
+LOADERS = {
+    'rag': _load_rag,
+    'indexer': lambda: importlib.import_module('indexer'),
+    'topic_model': lambda: importlib.import_module('topic_model'),
+}
+
+
+class Components():
+    """
+    Registry loading each component once, on first use or from the warm-up thread.
+
+    Attributes:
+        loaders (dict): Component name -> function loading it and returning the loaded object.
+    """
+
+    def __init__(self, loaders=LOADERS) -> None:
+        self.loaders = loaders
+        self._loaded = {}
+        self._state = {name: {"status": STATUS_COLD, "load_time": None, "error": None} for name in loaders}
+        self._locks = {name: threading.Lock() for name in loaders}
+        self._state_lock = threading.Lock()
+        self._thread = None
+
+    def _set_state(self, name, **state):
+        with self._state_lock:
+            self._state[name].update(state)
+
+    def get(self, name):
+        """
+        Returns the loaded component, loading it first if needed. A failed load is retried on the next call.
+        """
+        if name in self._loaded:
+            return self._loaded[name]
+        with self._locks[name]:
+            if name not in self._loaded:
+                self._set_state(name, status=STATUS_LOADING, error=None)
+                start = time.perf_counter()
+                try:
+                    component = self.loaders[name]()
+                except Exception as e:
+                    self._set_state(name, status=STATUS_FAILED, error=str(e))
+                    raise
+                self._loaded[name] = component
+                self._set_state(name, status=STATUS_WARM, load_time=time.perf_counter() - start)
+                logger.info(f"Loaded {name} in {time.perf_counter() - start:.2f}s")
+        return self._loaded[name]
+
+    def is_warm(self, name):
+        return name in self._loaded
+
+    def _warm_up(self, names):
+        for name in names:
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.error(f"Warm-up of {name} failed: {e}")
+
+    def start_warmup(self, names=None):
+        """
+        Loads the components in a daemon thread, requests for other components are served meanwhile.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._warm_up, args=(names or WARMUP_COMPONENTS,), name='warmup', daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def status(self, required=None):
+        """
+        Returns whether all `required` components are warm and the state of every component.
+        """
+        required = READY_COMPONENTS if required is None else required
+        with self._state_lock:
+            state = {name: dict(entry) for name, entry in self._state.items()}
+        return all(self.is_warm(name) for name in required), state
+
+
+components = Components()